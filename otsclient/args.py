@@ -50,6 +50,22 @@ def make_common_options_arg_parser():
                              dest='cache_path',
                              help="Disable the timestamp cache")
 
+    parser.add_argument("--cache-size", metavar='N', action="store", type=int,
+                        dest='cache_size',
+                        default=10000,
+                        help="Number of cache lookups to remember in memory; 0 to disable. Default: %(default)d")
+
+    parser.add_argument("--calendar-timeout", metavar='SECONDS', action="store", type=float,
+                        dest='calendar_timeout',
+                        default=30,
+                        help="Give up on a remote calendar if it stops responding for SECONDS. Default: %(default)d")
+
+    parser.add_argument("--negative-cache-ttl", metavar='SECONDS', action="store", type=int,
+                        dest='negative_cache_ttl',
+                        default=300,
+                        help="Skip asking a remote calendar for a timestamp if it told us it didn't have it "
+                             "less than SECONDS ago; 0 to disable. Default: %(default)d")
+
     btc_net_group  = parser.add_mutually_exclusive_group()
     btc_net_group.add_argument('--btc-testnet', dest='btc_net', action='store_const',
                                const='testnet', default='mainnet',
@@ -67,7 +83,7 @@ def make_common_options_arg_parser():
                              "committed in the Bitcoin blockchain is available "
                              "instead of returning immediately.")
     parser.add_argument("--wait-interval", action="store", type=int, default=30,
-                        help=argparse.SUPPRESS) # best if users don't change this and DoS attack the calendars...
+                        help=argparse.SUPPRESS) # minimum delay between polls; best if users don't change this and DoS attack the calendars...
 
     return parser
 
@@ -77,7 +93,7 @@ def handle_common_options(args, parser):
 
     if args.cache_path is not None:
         args.cache_path = os.path.normpath(os.path.expanduser(args.cache_path))
-    args.cache = otsclient.cache.TimestampCache(args.cache_path)
+    args.cache = otsclient.cache.TimestampCache(args.cache_path, lru_size=args.cache_size)
 
     if args.whitelist is not None:
         if not args.whitelist:
@@ -126,9 +142,23 @@ def parse_ots_args(raw_args):
                               default=[],
                               help='Create timestamp with the aid of a remote calendar. May be specified multiple times.')
 
+    parser_stamp.add_argument('-m', metavar='M', dest='m', action='store', type=int,
+                              default=1,
+                              help='Stop waiting once M calendars have replied, and fail if fewer than M reply '
+                                   'before the deadline. Default: %(default)d')
+
+    parser_stamp.add_argument('--deadline', metavar='SECONDS', dest='deadline', action='store', type=float,
+                              default=None,
+                              help='Wait at most SECONDS in total for M remote calendars to reply. '
+                                   'Default: no deadline')
+
     parser_stamp.add_argument('-b', '--btc-wallet', dest='use_btc_wallet', action='store_true',
                               help='Create timestamp locally with the local Bitcoin wallet.')
 
+    parser_stamp.add_argument('-j', '--jobs', metavar='N', dest='jobs', action='store', type=int,
+                              default=1,
+                              help='Hash up to N files in parallel, and use up to N processes to hash large merkle trees. Default: %(default)d')
+
     parser_stamp.add_argument('files', metavar='FILE', type=argparse.FileType('rb'),
                               nargs='+',
                               help='Filename')
@@ -143,6 +173,13 @@ def parse_ots_args(raw_args):
                                 nargs='+',
                                 help='Existing timestamp(s); moved to FILE.bak')
 
+    # ----- prune -----
+    parser_prune = subparsers.add_parser('prune',
+                                         help='Remove everything but the earliest Bitcoin attestation from complete timestamps')
+    parser_prune.add_argument('files', metavar='FILE', type=argparse.FileType('rb'),
+                              nargs='+',
+                              help='Existing timestamp(s); moved to FILE.bak')
+
     # ----- verify -----
     parser_verify = subparsers.add_parser('verify', aliases=['v'],
                                           help="Verify a timestamp")
@@ -161,15 +198,31 @@ def parse_ots_args(raw_args):
     # ----- info -----
     parser_info = subparsers.add_parser('info', aliases=['i'],
                                         help='Show information on a timestamp')
+    parser_info.add_argument('--lazy', dest='lazy', action='store_true',
+                             help="Don't calculate the result of every operation. Faster for large timestamps, "
+                                  "but timestamps with invalid operations aren't detected")
     parser_info.add_argument('file', metavar='FILE', type=argparse.FileType('rb'),
                              help='Filename')
 
+    # ----- scan -----
+    parser_scan = subparsers.add_parser('scan',
+                                        help='Summarize the status of the timestamps in one or more directories')
+    parser_scan.add_argument('dirs', metavar='DIR', type=str, nargs='+',
+                             help='Directory to search for .ots files, recursively')
+
+    # ----- migrate-cache -----
+    parser_migrate_cache = subparsers.add_parser('migrate-cache',
+                                                 help='Convert the timestamp cache to the current storage format')
+
 
 
     parser_stamp.set_defaults(cmd_func=otsclient.cmds.stamp_command)
     parser_upgrade.set_defaults(cmd_func=otsclient.cmds.upgrade_command)
+    parser_prune.set_defaults(cmd_func=otsclient.cmds.prune_command)
     parser_verify.set_defaults(cmd_func=otsclient.cmds.verify_command)
     parser_info.set_defaults(cmd_func=otsclient.cmds.info_command)
+    parser_scan.set_defaults(cmd_func=otsclient.cmds.scan_command)
+    parser_migrate_cache.set_defaults(cmd_func=otsclient.cmds.migrate_cache_command)
 
     try:
         import git
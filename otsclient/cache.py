@@ -9,45 +9,582 @@
 # modified, propagated, or distributed except according to the terms contained
 # in the LICENSE file.
 
+import collections
+import contextlib
+import hashlib
+import logging
+import mmap
 import os
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 from opentimestamps.core.timestamp import Timestamp
-from opentimestamps.core.serialize import StreamSerializationContext, StreamDeserializationContext
+from opentimestamps.core.serialize import BufferSerializationContext, BufferDeserializationContext, DeserializationError
 
 from bitcoin.core import b2x
 
-class TimestampCache:
-    """Persistant cache of timestamps"""
+class FileCacheBackend:
+    """Version 1 cache storage: one file per entry
+
+    Entries are stored in a 4-level hex directory fan-out, with each table
+    other than 'timestamps' in its own subdirectory. Entries are written to a
+    temporary file that's then renamed into place, so readers never see a
+    partially written entry.
+
+    Read-modify-write cycles are protected by advisory locks on one of
+    NUM_LOCKS lock files, picked by the first byte of the key; on platforms
+    without fcntl, such as Windows, locking is skipped.
+    """
+
+    MAJOR_VERSION = 1
+
+    NUM_LOCKS = 256
 
     def __init__(self, path):
         self.path = path
 
-        if path is not None:
-            # Simple version scheme
+    def __key_to_filename(self, table, key):
+        assert len(key) >= 20
+        prefix = '' if table == 'timestamps' else table + '/'
+        return (self.path + '/' + prefix +
+                b2x(key[0:1]) + '/' +
+                b2x(key[1:2]) + '/' +
+                b2x(key[2:3]) + '/' +
+                b2x(key[3:4]) + '/' +
+                b2x(key))
+
+    def get(self, table, key):
+        """Get the value of an entry; KeyError if missing"""
+        if len(key) > 64: # FIXME: hack to avoid filename-too-long errors
+            raise KeyError
+
+        try:
+            with open(self.__key_to_filename(table, key), 'rb') as fd:
+                return fd.read()
+        except FileNotFoundError:
+            raise KeyError
+
+    def get_many(self, table, keys):
+        """Get the values of many entries
+
+        Returns a dict of key -> value for the entries that exist.
+        """
+        r = {}
+        for key in keys:
             try:
-                with open(self.path + '/version', 'r') as fd:
+                r[key] = self.get(table, key)
+            except KeyError:
+                pass
+        return r
+
+    def put(self, table, key, value):
+        """Set the value of an entry"""
+        if len(key) > 64:
+            return
+
+        path = self.__key_to_filename(table, key)
+        dirname = os.path.dirname(path)
+        os.makedirs(dirname, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+        try:
+            with open(fd, 'wb') as tmp_fd:
+                tmp_fd.write(value)
+                tmp_fd.flush()
+                os.fsync(tmp_fd.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def delete(self, table, key):
+        """Delete an entry, if it exists"""
+        if len(key) > 64:
+            return
+
+        try:
+            os.remove(self.__key_to_filename(table, key))
+        except FileNotFoundError:
+            pass
+
+    @contextlib.contextmanager
+    def locked(self, table, keys):
+        """Hold exclusive locks covering a set of entries
+
+        Other processes and threads using locked() on the same entries wait
+        until the locks are released.
+        """
+        if fcntl is None:
+            yield
+            return
+
+        lock_dir = self.path + '/locks'
+        os.makedirs(lock_dir, exist_ok=True)
+
+        # Always acquire stripes in the same order, to avoid deadlocks.
+        stripes = sorted(set(key[0] % self.NUM_LOCKS for key in keys))
+        with contextlib.ExitStack() as stack:
+            for stripe in stripes:
+                lock_fd = stack.enter_context(open(lock_dir + '/%02x' % stripe, 'ab'))
+                fcntl.flock(lock_fd.fileno(), fcntl.LOCK_EX)
+            yield
+
+    def keys(self, table):
+        """Iterate over the keys of all entries in a table"""
+        table_path = self.path if table == 'timestamps' else self.path + '/' + table
+        for dirpath, dirnames, filenames in os.walk(table_path):
+            if dirpath == table_path:
+                # Only descend into the hex fan-out directories, not other
+                # tables.
+                dirnames[:] = [dirname for dirname in dirnames if len(dirname) == 2]
+
+            for filename in filenames:
+                if len(filename) >= 40 and dirpath != table_path:
                     try:
-                        major, minor = fd.read().strip().split('.')
-                        major = int(major)
-                        minor = int(minor)
-                        if major != 1:
-                            raise Exception
-                    except Exception:
-                        raise Exception("Unknown timestamp cache version")
-
-            except FileNotFoundError:
+                        yield bytes.fromhex(filename)
+                    except ValueError:
+                        continue
+
+class SQLiteCacheBackend:
+    """Version 2 cache storage: a single, indexed, SQLite database
+
+    Lookups are index probes in one file, rather than a file open per entry.
+    SQLite's own locking and journaling make the database safe to share
+    between processes, and to crash while writing to; within a process the
+    connection is shared by all threads.
+    """
+
+    MAJOR_VERSION = 2
+
+    TABLES = ('timestamps', 'negative')
+
+    MAX_VARIABLES = 500
+    """Maximum number of keys to look up in a single query"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.in_transaction = False
+
+        # Transactions are managed explicitly, rather than by the sqlite3
+        # module.
+        self.db = sqlite3.connect(path + '/cache.sqlite', timeout=60, check_same_thread=False,
+                                  isolation_level=None)
+        with self.__transaction():
+            for table in self.TABLES:
+                self.db.execute('CREATE TABLE IF NOT EXISTS %s (key BLOB PRIMARY KEY, value BLOB NOT NULL)' % table)
+
+    @contextlib.contextmanager
+    def __transaction(self):
+        """Run a write transaction, unless we're already in one"""
+        with self.lock:
+            if self.in_transaction:
+                yield
+                return
+
+            # IMMEDIATE takes the database's write lock at the start, so a
+            # read-modify-write can't be interleaved with another writer.
+            self.db.execute('BEGIN IMMEDIATE')
+            self.in_transaction = True
+            try:
+                yield
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            else:
+                self.db.execute('COMMIT')
+            finally:
+                self.in_transaction = False
+
+    def get(self, table, key):
+        """Get the value of an entry; KeyError if missing"""
+        assert table in self.TABLES
+        with self.lock:
+            row = self.db.execute('SELECT value FROM %s WHERE key = ?' % table, (key,)).fetchone()
+        if row is None:
+            raise KeyError
+        return bytes(row[0])
+
+    def get_many(self, table, keys):
+        """Get the values of many entries
+
+        Returns a dict of key -> value for the entries that exist.
+        """
+        assert table in self.TABLES
+        keys = list(keys)
+        r = {}
+        with self.lock:
+            for i in range(0, len(keys), self.MAX_VARIABLES):
+                chunk = keys[i:i+self.MAX_VARIABLES]
+                query = 'SELECT key, value FROM %s WHERE key IN (%s)' % (table, ','.join('?' * len(chunk)))
+                for key, value in self.db.execute(query, chunk):
+                    r[bytes(key)] = bytes(value)
+        return r
+
+    def put(self, table, key, value):
+        """Set the value of an entry"""
+        self.put_many(table, ((key, value),))
+
+    def put_many(self, table, items):
+        """Set the values of many entries in a single transaction"""
+        assert table in self.TABLES
+        with self.__transaction():
+            self.db.executemany('INSERT OR REPLACE INTO %s (key, value) VALUES (?, ?)' % table, items)
+            if table == 'timestamps':
+                self.db.execute('PRAGMA user_version = %d' % ((self.generation() + 1) % 2**31))
+
+    def generation(self):
+        """Get the generation of the timestamps table
+
+        The generation changes with every write to the table, in the same
+        transaction as the write, so a BloomFilter can tell whether it has
+        seen every write.
+        """
+        with self.lock:
+            return self.db.execute('PRAGMA user_version').fetchone()[0]
+
+    def delete(self, table, key):
+        """Delete an entry, if it exists"""
+        assert table in self.TABLES
+        with self.__transaction():
+            self.db.execute('DELETE FROM %s WHERE key = ?' % table, (key,))
+
+    def locked(self, table, keys):
+        """Hold exclusive locks covering a set of entries
+
+        The whole database is locked, in a single transaction.
+        """
+        return self.__transaction()
+
+    def keys(self, table):
+        """Iterate over the keys of all entries in a table"""
+        assert table in self.TABLES
+        with self.lock:
+            keys = [bytes(row[0]) for row in self.db.execute('SELECT key FROM %s' % table)]
+        return iter(keys)
+
+BACKENDS_BY_MAJOR_VERSION = {FileCacheBackend.MAJOR_VERSION: FileCacheBackend,
+                             SQLiteCacheBackend.MAJOR_VERSION: SQLiteCacheBackend}
+
+DEFAULT_BACKEND = SQLiteCacheBackend
+"""Backend used for newly created caches"""
+
+def read_cache_version(path):
+    """Read the version of the cache at path
+
+    Returns (major, minor), or None if there's no cache there yet.
+    """
+    try:
+        with open(path + '/version', 'r') as fd:
+            try:
+                major, minor = fd.read().strip().split('.')
+                return (int(major), int(minor))
+            except Exception:
+                raise Exception("Unknown timestamp cache version")
+
+    except FileNotFoundError:
+        return None
+
+def write_cache_version(path, major, minor):
+    tmp_path = path + '/version.tmp'
+    with open(tmp_path, 'w') as fd:
+        fd.write('%d.%d\n' % (major, minor))
+    os.replace(tmp_path, path + '/version')
+
+class BloomFilter:
+    """Persistant Bloom filter over the commitments in a cache
+
+    Lets most lookups of commitments that aren't in the cache - the common
+    case - be answered without touching the backend. False positives just cost
+    a backend lookup.
+
+    False negatives would cost cache hits, so the filter is only used with
+    backends that have a generation(), and stores the generation of the last
+    write it was told about. If that doesn't match the backend's when the
+    filter is opened - say a process crashed between writing to the backend
+    and to the filter - the filter is rebuilt.
+
+    The filter is stored in a file that's mmapped, so adding a commitment is
+    just setting a few bits in memory. When more commitments have been added
+    than it was sized for it's rebuilt, twice as large, from the backend.
+
+    Adds and rebuilds are done while holding an advisory lock on a lock file
+    next to the filter, so concurrent writers never lose each other's bits;
+    as with FileCacheBackend, on platforms without fcntl only threads within
+    the process are excluded.
+    """
+
+    MAGIC = b'OTSBLOOM'
+    REPLACED_MAGIC = b'REPLACED'
+    """Written over the magic of a filter file once it's been replaced"""
+
+    HEADER_FORMAT = '<8sIIQ'
+    """Magic, log2 of the number of bits, count of entries, backend generation"""
+    HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+    NUM_HASHES = 7
+    BITS_PER_ENTRY = 10
+    """About 1% false positives at capacity"""
+
+    MIN_LOG2_BITS = 23
+
+    def __init__(self, path, backend):
+        self.path = path
+        self.backend = backend
+        self.lock = threading.RLock()
+        self.fd = None
+        self.map = None
+
+        with self.__locked():
+            try:
+                self.__open()
+            except (FileNotFoundError, ValueError):
+                self.__rebuild()
+            else:
+                if self.__get_generation() != backend.generation():
+                    logging.debug("Cache Bloom filter is out of date")
+                    self.__rebuild()
+
+    @contextlib.contextmanager
+    def __locked(self):
+        """Hold the lock on the filter, excluding other writers"""
+        with self.lock:
+            if fcntl is None:
+                yield
+                return
+
+            # A separate lock file, as the filter file itself is replaced by
+            # rebuilds.
+            with open(self.path + '.lock', 'ab') as lock_fd:
+                fcntl.flock(lock_fd.fileno(), fcntl.LOCK_EX)
+                yield
+
+    def __open(self):
+        fd = open(self.path, 'r+b')
+        try:
+            header = fd.read(self.HEADER_SIZE)
+            if len(header) != self.HEADER_SIZE:
+                raise ValueError('truncated header')
+            magic, log2_bits, count, generation = struct.unpack(self.HEADER_FORMAT, header)
+            if magic != self.MAGIC or not self.MIN_LOG2_BITS <= log2_bits < 40:
+                raise ValueError('bad header')
+            if os.fstat(fd.fileno()).st_size != self.HEADER_SIZE + 2**log2_bits // 8:
+                raise ValueError('wrong size')
+
+            new_map = mmap.mmap(fd.fileno(), 0)
+        except Exception:
+            fd.close()
+            raise
+
+        self.close()
+        self.fd = fd
+        self.map = new_map
+        self.mask = 2**log2_bits - 1
+        self.log2_bits = log2_bits
+
+    def __reopen_if_replaced(self):
+        """Switch to the current filter file, if another process rebuilt it
+
+        Rebuilds mark the file they replace, so checking is just a read of the
+        mapping. Returns False if the filter was replaced, but the current
+        filter file can't be opened.
+        """
+        if self.map[:len(self.MAGIC)] == self.MAGIC:
+            return True
+
+        try:
+            self.__open()
+            return True
+        except (FileNotFoundError, ValueError):
+            return False
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.fd.close()
+                self.map = self.fd = None
+
+    def __get_count(self):
+        return struct.unpack_from('<I', self.map, 12)[0]
+
+    def __set_count(self, count):
+        struct.pack_into('<I', self.map, 12, min(count, 2**32-1))
+
+    def __get_generation(self):
+        return struct.unpack_from('<Q', self.map, 16)[0]
+
+    def __set_generation(self, generation):
+        struct.pack_into('<Q', self.map, 16, generation)
+
+    def __positions(self, commitment, mask):
+        digest = hashlib.sha256(commitment).digest()
+        return [n & mask for n in struct.unpack('<8I', digest)[:self.NUM_HASHES]]
+
+    def __contains__(self, commitment):
+        with self.lock:
+            # Bits added since another process rebuilt the filter are only in
+            # the new file.
+            if not self.__reopen_if_replaced():
+                return True
+
+            for pos in self.__positions(commitment, self.mask):
+                if not self.map[self.HEADER_SIZE + (pos >> 3)] & (1 << (pos & 7)):
+                    return False
+            return True
+
+    def add(self, commitment):
+        """Add a commitment to the filter"""
+        self.add_many((commitment,))
+
+    def add_many(self, commitments, generation=None):
+        """Add many commitments to the filter, taking the lock once
+
+        generation is the backend's generation once the commitments were
+        written to it. Call with the backend's lock held, so that
+        generations are recorded in the order they were written.
+        """
+        with self.__locked():
+            if not self.__reopen_if_replaced():
+                self.__rebuild()
+
+            count = self.__get_count()
+            for commitment in commitments:
+                new = False
+                for pos in self.__positions(commitment, self.mask):
+                    i = self.HEADER_SIZE + (pos >> 3)
+                    byte = self.map[i]
+                    if not byte & (1 << (pos & 7)):
+                        self.map[i] = byte | (1 << (pos & 7))
+                        new = True
+                count += new
+
+            self.__set_count(count)
+            if generation is not None:
+                self.__set_generation(generation)
+
+            if count > 2**self.log2_bits // self.BITS_PER_ENTRY:
+                self.__rebuild()
+
+    def rebuild(self):
+        """Rebuild the filter from the commitments in the backend
+
+        The new filter is built in full before replacing the old one, so
+        other processes using the cache never see it partially built.
+        """
+        with self.__locked():
+            self.__reopen_if_replaced()
+            self.__rebuild()
+
+    def __rebuild(self):
+        # Called with the lock held. Any commitment written to the backend
+        # after the keys are read here is added to the filter by its writer
+        # once we release the lock, so it ends up in the new filter, along
+        # with the writer's generation.
+        generation = self.backend.generation()
+        keys = list(self.backend.keys('timestamps'))
+
+        log2_bits = self.MIN_LOG2_BITS
+        while 2**log2_bits // self.BITS_PER_ENTRY < len(keys) * 2:
+            log2_bits += 1
+        mask = 2**log2_bits - 1
+
+        logging.debug("Building cache Bloom filter for %d commitments" % len(keys))
+
+        bits = bytearray(2**log2_bits // 8)
+        for key in keys:
+            for pos in self.__positions(key, mask):
+                bits[pos >> 3] |= 1 << (pos & 7)
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.tmp-')
+        try:
+            with open(fd, 'wb') as tmp_fd:
+                tmp_fd.write(struct.pack(self.HEADER_FORMAT, self.MAGIC, log2_bits, min(len(keys), 2**32-1), generation))
+                tmp_fd.write(bits)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        # Tell other processes still using the old filter to switch.
+        if self.map is not None:
+            self.map[:len(self.REPLACED_MAGIC)] = self.REPLACED_MAGIC
+
+        self.__open()
+
+class TimestampCache:
+    """Persistant cache of timestamps
+
+    In addition to timestamps, negative responses from remote calendars -
+    commitment not found, or still pending - are cached so that they can be
+    skipped for a while, rather than asking the calendar again.
+
+    The storage itself is done by a backend, chosen by the cache's version;
+    new caches use DEFAULT_BACKEND.
+
+    If the backend supports it, commitments in the cache are tracked by a
+    BloomFilter, so most lookups of commitments that aren't in it never touch
+    the backend at all. The filter is only opened once it's first needed.
+
+    Lookups go through an in-memory LRU of up to lru_size entries, recording
+    both hits and misses, so repeatedly probing the same commitments - common
+    when upgrading timestamps that share a calendar commitment - doesn't go to
+    the backend every time. Hit and miss counts are kept in lru_hits and
+    lru_misses.
+    """
+
+    def __init__(self, path, lru_size=10000):
+        self.path = path
+        self.backend = None
+
+        # commitment -> serialized timestamp, or None if not in the cache
+        self.lru = collections.OrderedDict()
+        self.lru_size = lru_size
+        self.lru_hits = 0
+        self.lru_misses = 0
+
+        if path is not None:
+            # Simple version scheme
+            version = read_cache_version(self.path)
+            if version is None:
                 os.makedirs(self.path, exist_ok=True)
-                with open(self.path + '/version', 'w') as fd:
-                    fd.write('%d.%d\n' % (1,0))
-
-    def __commitment_to_filename(self, commitment):
-        assert len(commitment) >= 20
-        return (self.path + '/' +
-                b2x(commitment[0:1]) + '/' +
-                b2x(commitment[1:2]) + '/' +
-                b2x(commitment[2:3]) + '/' +
-                b2x(commitment[3:4]) + '/' +
-                b2x(commitment))
+                version = (DEFAULT_BACKEND.MAJOR_VERSION, 0)
+                self.backend = DEFAULT_BACKEND(self.path)
+                write_cache_version(self.path, *version)
+
+            else:
+                try:
+                    backend_cls = BACKENDS_BY_MAJOR_VERSION[version[0]]
+                except KeyError:
+                    raise Exception("Unknown timestamp cache version")
+                self.backend = backend_cls(self.path)
+
+        self.__bloom = None
+
+    @property
+    def bloom(self):
+        """The BloomFilter of the cache, or None if the backend doesn't support one"""
+        if self.__bloom is None and hasattr(self.backend, 'generation'):
+            self.__bloom = BloomFilter(self.path + '/bloom', self.backend)
+        return self.__bloom
+
+    def __might_contain(self, commitment):
+        bloom = self.bloom
+        return bloom is None or commitment in bloom
 
     def __contains__(self, commitment):
         try:
@@ -56,37 +593,281 @@ class TimestampCache:
         except KeyError:
             return False
 
+    def __deserialize(self, commitment, serialized, memoize=False):
+        ctx = BufferDeserializationContext(serialized)
+        timestamp = Timestamp.deserialize(ctx, commitment, memoize=memoize)
+        ctx.assert_eof()
+        return timestamp
+
+    def __serialize(self, timestamp):
+        ctx = BufferSerializationContext()
+        timestamp.serialize(ctx, memoize=True)
+        return ctx.getbytes()
+
+    def __load(self, commitment, serialized):
+        """Deserialize a timestamp read from the backend
+
+        Corrupt entries, such as ones truncated by a crash, are deleted so
+        that they can be replaced by good data. Returns None in that case.
+        """
+        try:
+            return self.__deserialize(commitment, serialized)
+        except DeserializationError as exp:
+            logging.warning("Deleting corrupt cache entry %s: %s" % (b2x(commitment), exp))
+
+        with self.backend.locked('timestamps', [commitment]):
+            # Someone else may have replaced it with good data already
+            try:
+                if self.backend.get('timestamps', commitment) == serialized:
+                    self.backend.delete('timestamps', commitment)
+            except KeyError:
+                pass
+        return None
+
+    def __lru_get(self, commitment):
+        """Get the serialized timestamp for a commitment from the LRU
+
+        Returns None for commitments known not to be in the cache; KeyError if
+        the LRU doesn't know.
+        """
+        try:
+            serialized = self.lru[commitment]
+        except KeyError:
+            self.lru_misses += 1
+            raise
+
+        self.lru.move_to_end(commitment)
+        self.lru_hits += 1
+        return serialized
+
+    def __lru_put(self, commitment, serialized):
+        if self.lru_size <= 0:
+            return
+
+        self.lru[commitment] = serialized
+        self.lru.move_to_end(commitment)
+        while len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
+
     def __getitem__(self, commitment):
-        if self.path is None:
+        if self.backend is None:
             raise KeyError
 
-        elif len(commitment) > 64: # FIXME: hack to avoid filename-too-long errors
+        try:
+            serialized = self.__lru_get(commitment)
+        except KeyError:
+            pass
+        else:
+            if serialized is None:
+                raise KeyError
+
+            # Always deserialize a new Timestamp, as callers are free to
+            # modify what they're given.
+            return self.__deserialize(commitment, serialized)
+
+        timestamp = None
+        if self.__might_contain(commitment):
+            try:
+                serialized = self.backend.get('timestamps', commitment)
+            except KeyError:
+                pass
+            else:
+                timestamp = self.__load(commitment, serialized)
+
+        self.__lru_put(commitment, serialized if timestamp is not None else None)
+        if timestamp is None:
             raise KeyError
+        return timestamp
+
+    def get_many(self, commitments):
+        """Get many timestamps at once
+
+        Returns a dict of commitment -> Timestamp for the commitments that are
+        in the cache.
+        """
+        if self.backend is None:
+            return {}
+
+        r = {}
+        uncached = []
+        for commitment in commitments:
+            try:
+                serialized = self.__lru_get(commitment)
+            except KeyError:
+                uncached.append(commitment)
+                continue
+
+            if serialized is not None:
+                r[commitment] = self.__deserialize(commitment, serialized)
+
+        if uncached:
+            from_backend = self.backend.get_many('timestamps',
+                                                 [commitment for commitment in uncached if self.__might_contain(commitment)])
+            for commitment in uncached:
+                serialized = from_backend.get(commitment)
+                if serialized is not None:
+                    timestamp = self.__load(commitment, serialized)
+                    if timestamp is not None:
+                        r[commitment] = timestamp
+                    else:
+                        serialized = None
+                self.__lru_put(commitment, serialized)
+
+        return r
+
+    def __merged(self, existing, new_timestamp):
+        if existing is None:
+            existing = Timestamp(new_timestamp.msg)
+        existing.merge(new_timestamp)
+        return existing
+
+    def merge(self, new_timestamp):
+        self.merge_many([new_timestamp])
+
+    def merge_many(self, new_timestamps):
+        """Merge many timestamps into the cache at once
+
+        The existing entries are read, merged with, and written back while
+        holding the backend's locks on them, so concurrent merges from other
+        processes sharing the cache aren't lost.
+        """
+        if self.backend is None:
+            return
+
+        merged = {}
+        for new_timestamp in new_timestamps:
+            merged[new_timestamp.msg] = self.__merged(merged.get(new_timestamp.msg), new_timestamp)
+
+        if not merged:
+            return
+
+        with self.backend.locked('timestamps', merged.keys()):
+            # Read directly from the backend: the LRU may be out of date if
+            # other processes have written to the cache.
+            existing_serialized = self.backend.get_many('timestamps', merged.keys())
+            existing = {}
+            for commitment, serialized in existing_serialized.items():
+                try:
+                    existing[commitment] = self.__deserialize(commitment, serialized, memoize=True)
+                except DeserializationError as exp:
+                    logging.warning("Replacing corrupt cache entry %s: %s" % (b2x(commitment), exp))
+
+            # The existing timestamps have their serializations memoized, so
+            # only the parts that changed in the merge are serialized again.
+            items = [(commitment, self.__serialize(self.__merged(existing.get(commitment), stamp)))
+                     for commitment, stamp in merged.items()]
+
+            # Nothing to write for timestamps we already had all of.
+            changed_items = [(commitment, serialized) for commitment, serialized in items
+                             if existing_serialized.get(commitment) != serialized]
+
+            if hasattr(self.backend, 'put_many'):
+                self.backend.put_many('timestamps', changed_items)
+            else:
+                for commitment, serialized in changed_items:
+                    self.backend.put('timestamps', commitment, serialized)
+
+            bloom = self.bloom
+            if bloom is not None:
+                bloom.add_many(merged.keys(), self.backend.generation())
 
+        for commitment, serialized in items:
+            self.__lru_put(commitment, serialized)
+
+    def __read_negatives(self, commitment):
+        """Read negative responses for a commitment
+
+        Returns a list of (time, calendar_url, reason) tuples.
+        """
         try:
-            with open(self.__commitment_to_filename(commitment), 'rb') as stamp_fd:
-                ctx = StreamDeserializationContext(stamp_fd)
-                stamp = Timestamp.deserialize(ctx, commitment)
-                return stamp
-        except FileNotFoundError:
+            lines = self.backend.get('negative', commitment).decode('utf8').splitlines()
+        except (KeyError, UnicodeDecodeError):
+            return []
+
+        r = []
+        for line in lines:
+            try:
+                when, calendar_url, reason = line.split(' ', 2)
+                r.append((float(when), calendar_url, reason))
+            except ValueError:
+                # Corrupt line; ignore it
+                continue
+        return r
+
+    def get_negative(self, calendar_url, commitment, ttl):
+        """Get a cached negative response from a calendar
+
+        Returns the reason the calendar gave, if that calendar responded
+        negatively for the commitment less than ttl seconds ago. Raises
+        KeyError otherwise.
+        """
+        if self.backend is None:
             raise KeyError
 
-    def __save(self, timestamp):
-        if self.path is None:
+        now = time.time()
+        for when, negative_url, reason in self.__read_negatives(commitment):
+            if negative_url == calendar_url and when <= now < when + ttl:
+                return reason
+
+        raise KeyError
+
+    def add_negative(self, calendar_url, commitment, reason, ttl):
+        """Record a negative response from a calendar
+
+        Entries older than ttl seconds are removed at the same time.
+        """
+        if self.backend is None or ' ' in calendar_url:
             return
 
-        # FIXME: should do this atomically
-        path = self.__commitment_to_filename(timestamp.msg)
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(self.__commitment_to_filename(timestamp.msg), 'wb') as stamp_fd:
-            ctx = StreamSerializationContext(stamp_fd)
-            timestamp.serialize(ctx)
+        with self.backend.locked('negative', [commitment]):
+            now = time.time()
+            negatives = [(when, negative_url, negative_reason)
+                         for when, negative_url, negative_reason in self.__read_negatives(commitment)
+                         if negative_url != calendar_url and when <= now < when + ttl]
+            negatives.append((now, calendar_url, reason.replace('\n', ' ')))
 
-    def merge(self, new_timestamp):
-        try:
-            existing = self[new_timestamp.msg]
-        except KeyError:
-            existing = Timestamp(new_timestamp.msg)
+            serialized = ''.join('%f %s %s\n' % negative for negative in negatives)
+            self.backend.put('negative', commitment, serialized.encode('utf8'))
 
-        existing.merge(new_timestamp)
-        self.__save(existing)
+
+def migrate_cache(path, new_backend_cls=DEFAULT_BACKEND):
+    """Migrate the cache at path to a different backend, in place
+
+    Every entry is copied to the new backend before the version file is
+    updated, so an interrupted migration leaves the old cache usable. The old
+    entries are not deleted.
+
+    Returns the number of timestamps migrated.
+    """
+    version = read_cache_version(path)
+    if version is None:
+        raise Exception("No timestamp cache found at %r" % path)
+
+    try:
+        old_backend = BACKENDS_BY_MAJOR_VERSION[version[0]](path)
+    except KeyError:
+        raise Exception("Unknown timestamp cache version")
+
+    if old_backend.__class__ == new_backend_cls:
+        return 0
+
+    new_backend = new_backend_cls(path)
+
+    n = 0
+    for table in ('timestamps', 'negative'):
+        keys = list(old_backend.keys(table))
+        for i in range(0, len(keys), 1000):
+            items = list(old_backend.get_many(table, keys[i:i+1000]).items())
+            if hasattr(new_backend, 'put_many'):
+                new_backend.put_many(table, items)
+            else:
+                for key, value in items:
+                    new_backend.put(table, key, value)
+
+            if table == 'timestamps':
+                n += len(items)
+                logging.debug("Migrated %d of %d timestamps" % (n, len(keys)))
+
+    write_cache_version(path, new_backend_cls.MAJOR_VERSION, 0)
+
+    return n
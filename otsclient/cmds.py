@@ -13,6 +13,7 @@ import sys
 
 import argparse
 import binascii
+import concurrent.futures
 import logging
 import os
 import time
@@ -20,7 +21,7 @@ import urllib.request
 import threading
 import bitcoin
 import bitcoin.rpc
-from queue import Queue
+from queue import Queue, Empty
 
 from bitcoin.core import b2x, b2lx, lx, CTxOut, CTransaction
 from bitcoin.core.script import CScript, OP_RETURN
@@ -37,18 +38,33 @@ from opentimestamps.bitcoin import *
 import opentimestamps.calendar
 
 import otsclient
+import otsclient.scheduler
 
-def remote_calendar(calendar_uri):
+def remote_calendar(calendar_uri, timeout=None):
     """Create a remote calendar with User-Agent set appropriately"""
     return opentimestamps.calendar.RemoteCalendar(calendar_uri,
-                                                  user_agent="OpenTimestamps-Client/%s" % otsclient.__version__)
+                                                  user_agent="OpenTimestamps-Client/%s" % otsclient.__version__,
+                                                  timeout=timeout)
 
-def create_timestamp(timestamp, calendar_urls, setup_bitcoin=False):
+def create_timestamp(timestamp, calendar_urls, setup_bitcoin=False, m=None, calendar_timeout=None, deadline=None):
     """Create a timestamp
 
-    calendar_urls - List of calendar's to use
-    setup_bitcoin - False if Bitcoin timestamp not desired; set to
-                    args.setup_bitcoin() otherwise.
+    calendar_urls    - List of calendar's to use
+    setup_bitcoin    - False if Bitcoin timestamp not desired; set to
+                       args.setup_bitcoin() otherwise.
+    m                - Number of calendars that must reply; None for all of
+                       them.
+    calendar_timeout - Socket timeout, in seconds, for each calendar; None
+                       for no timeout.
+    deadline         - Seconds to wait for m calendars to reply in total;
+                       None to wait until they have, or have failed.
+
+    Calendars are submitted to in parallel, and we stop waiting as soon as m
+    of them have replied, or the deadline is reached, so the time taken is
+    set by the m-th fastest calendar. Replies that have already arrived by
+    then are used too. Calendars that fail or time out are logged.
+
+    Returns True if at least m calendars replied, False otherwise.
     """
 
     if setup_bitcoin:
@@ -89,78 +105,186 @@ def create_timestamp(timestamp, calendar_urls, setup_bitcoin=False):
         assert block_timestamp is not None
         timestamp.merge(block_timestamp)
 
+    if m is None:
+        m = len(calendar_urls)
+    m = min(m, len(calendar_urls))
+
     q = Queue()
     for calendar_url in calendar_urls:
-        submit_async(calendar_url, timestamp.msg, q)
+        submit_async(calendar_url, timestamp.msg, q, calendar_timeout)
 
-    for calendar_url in calendar_urls:
-        timestamp.merge(q.get())
+    start = time.time()
+    outstanding = list(calendar_urls)
+    replies = 0
+    while outstanding:
+        try:
+            if replies >= m:
+                # Only take the replies that are already here
+                calendar_url, result = q.get_nowait()
+            elif deadline is None:
+                calendar_url, result = q.get()
+            else:
+                calendar_url, result = q.get(timeout=max(0, deadline - (time.time() - start)))
+        except Empty:
+            break
+
+        outstanding.remove(calendar_url)
+        if isinstance(result, Exception):
+            logging.warning("Failed to submit to remote calendar %s: %s" % (calendar_url, result))
+        else:
+            logging.debug("Got timestamp from remote calendar %s after %.3f sec" % (calendar_url, time.time() - start))
+            timestamp.merge(result)
+            replies += 1
+
+    for calendar_url in outstanding:
+        if replies < m:
+            logging.warning("Remote calendar %s did not reply within %g sec" % (calendar_url, deadline))
+        else:
+            logging.debug("Not waiting for remote calendar %s" % calendar_url)
+
+    if replies < m:
+        logging.error("Only %d of %d required calendar(s) replied" % (replies, m))
+        return False
+
+    return True
 
 
-def submit_async(calendar_url, msg, q):
+def submit_async(calendar_url, msg, q, calendar_timeout=None):
 
     def submit_async_thread(remote, msg, q):
-        calendar_timestamp = remote.submit(msg)
-        q.put(calendar_timestamp)
+        try:
+            calendar_timestamp = remote.submit(msg)
+        except Exception as exp:
+            # Report the failure, rather than leaving the caller waiting
+            # forever for a reply that will never come.
+            q.put((calendar_url, exp))
+        else:
+            q.put((calendar_url, calendar_timestamp))
 
     logging.info('Submitting to remote calendar %s' % calendar_url)
-    remote = remote_calendar(calendar_url)
-    t = threading.Thread(target=submit_async_thread, args=(remote, msg, q))
+    remote = remote_calendar(calendar_url, timeout=calendar_timeout)
+
+    # Daemon threads, so that a calendar we've given up on can't prevent us
+    # from exiting.
+    t = threading.Thread(target=submit_async_thread, args=(remote, msg, q), daemon=True)
     t.start()
 
 
+def hash_file(file_hash_op, fd):
+    """Hash an open file, returning a DetachedTimestampFile for it
+
+    Safe to call from worker threads; timing information is logged at debug
+    level.
+    """
+    start = time.time()
+    # Files being timestamped aren't expected to be truncated while we're
+    # hashing them, so the risk of SIGBUS that comes with mmap is accepted.
+    file_timestamp = DetachedTimestampFile.from_fd(file_hash_op, fd, use_mmap=True)
+    elapsed = time.time() - start
+
+    try:
+        size = fd.tell()
+    except OSError:
+        # Pipes and other unseekable files don't know how much we read
+        size = None
+
+    if size is not None and elapsed > 0:
+        logging.debug("Hashed %s: %d bytes in %.3f sec (%.1f MiB/s)" % (fd.name, size, elapsed, size / elapsed / 2**20))
+    else:
+        logging.debug("Hashed %s in %.3f sec" % (fd.name, elapsed))
+
+    return file_timestamp
+
+
 def stamp_command(args):
+    if args.jobs < 1:
+        args.parser.error('--jobs must be at least 1')
+    if args.m < 1:
+        args.parser.error('-m must be at least 1')
+
+    # Hash all files, possibly in parallel; hashlib releases the GIL while
+    # hashing, so worker threads scale with the number of cores and disks.
+    # The results are collected in input order, so the order of the leaves
+    # in the merkle tree is unaffected by the number of jobs.
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(hash_file, OpSHA256(), fd) for fd in args.files]
+
+        file_timestamps = []
+        for fd, future in zip(args.files, futures):
+            try:
+                file_timestamps.append(future.result())
+            except OSError as exp:
+                # Most IO errors such as a missing file or bad permissions are
+                # caught by argparse; we'll only get to this point if we can open
+                # the file, yet there's still an IO error reading the contents of
+                # it, which is a tricky thing to test.
+                #
+                # A neat trick is to try to timestamp a /proc/<pid>/mem file that
+                # you have permissions for. On Linux at least, actually reading the
+                # contents of these files is still not allowed, as you need the
+                # correct magic sysctls or something, which gives us a nice OSError
+                # to test with.
+                logging.error("Could not read %r: %s" % (fd.name, exp))
+                for pending in futures:
+                    pending.cancel()
+                sys.exit(1)
+
+    logging.debug("Hashed %d file(s) in %.3f sec using %d job(s)" % (len(file_timestamps), time.time() - start, args.jobs))
+
     # Create initial commitment ops for all files
-    file_timestamps = []
+    nonces = []
     merkle_roots = []
-    for fd in args.files:
-        try:
-            file_timestamp = DetachedTimestampFile.from_fd(OpSHA256(), fd)
-        except OSError as exp:
-            # Most IO errors such as a missing file or bad permissions are
-            # caught by argparse; we'll only get to this point if we can open
-            # the file, yet there's still an IO error reading the contents of
-            # it, which is a tricky thing to test.
-            #
-            # A neat trick is to try to timestamp a /proc/<pid>/mem file that
-            # you have permissions for. On Linux at least, actually reading the
-            # contents of these files is still not allowed, as you need the
-            # correct magic sysctls or something, which gives us a nice OSError
-            # to test with.
-            logging.error("Could not read %r: %s" % (fd.name, exp))
-            sys.exit(1)
-
+    for file_timestamp in file_timestamps:
         # Add nonce
         #
         # Remember that the files - and their timestamps - might get separated
         # later, so if we didn't use a nonce for every file, the timestamp
         # would leak information on the digests of adjacent files.
-        nonce_appended_stamp = file_timestamp.timestamp.ops.add(OpAppend(os.urandom(16)))
-        merkle_root = nonce_appended_stamp.ops.add(OpSHA256())
-
-        merkle_roots.append(merkle_root)
-        file_timestamps.append(file_timestamp)
-
-    merkle_tip = make_merkle_tree(merkle_roots)
+        nonce = os.urandom(16)
+        nonces.append(nonce)
+        merkle_roots.append(OpSHA256()(OpAppend(nonce)(file_timestamp.file_digest)))
+
+    # The merkle tree is stored compactly, and the timestamp for each file
+    # only created when it's saved, so stamping lots of files at once doesn't
+    # need lots of memory. Wide levels of the tree are hashed by worker
+    # processes; they're only started if the tree is big enough to need them.
+    if args.jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            merkle_tree = MerkleTree(merkle_roots, executor=executor)
+    else:
+        merkle_tree = MerkleTree(merkle_roots)
+    del merkle_roots
+    merkle_tip = Timestamp(merkle_tree.tip_digest)
 
     if not args.calendar_urls:
         # Neither calendar nor wallet specified; add defaults
         args.calendar_urls.append('https://a.pool.opentimestamps.org')
         args.calendar_urls.append('https://b.pool.opentimestamps.org')
 
-    create_timestamp(merkle_tip, args.calendar_urls, args.setup_bitcoin if args.use_btc_wallet else False)
+    if not create_timestamp(merkle_tip, args.calendar_urls, args.setup_bitcoin if args.use_btc_wallet else False,
+                            m=args.m, calendar_timeout=args.calendar_timeout, deadline=args.deadline):
+        logging.error("Failed to create timestamp")
+        sys.exit(1)
 
     if args.wait:
         upgrade_timestamp(merkle_tip, args)
         logging.info("Timestamp complete; saving")
 
-    for (in_file, file_timestamp) in zip(args.files, file_timestamps):
+    for (i, (in_file, file_timestamp, nonce)) in enumerate(zip(args.files, file_timestamps, nonces)):
         timestamp_file_path = in_file.name + '.ots'
 
+        # Every file shares the tip, so its serialization is memoized after
+        # the first file.
+        file_stamp = Timestamp(file_timestamp.file_digest)
+        file_stamp.ops.add(OpAppend(nonce)).ops[OpSHA256()] = merkle_tree.leaf_timestamp(i, merkle_tip)
+        file_timestamp = DetachedTimestampFile(file_timestamp.file_hash_op, file_stamp)
+
         try:
             with open(timestamp_file_path, 'xb') as timestamp_fd:
-                ctx = StreamSerializationContext(timestamp_fd)
+                ctx = BufferSerializationContext()
                 file_timestamp.serialize(ctx)
+                timestamp_fd.write(ctx.getbytes())
         except IOError as exp:
             logging.error("Failed to create timestamp %r: %s" % (timestamp_file_path, exp))
             sys.exit(1)
@@ -175,107 +299,169 @@ def is_timestamp_complete(stamp, args):
     else:
         return False
 
-def upgrade_timestamp(timestamp, args):
-    """Attempt to upgrade an incomplete timestamp to make it verifiable
-
-    Returns True if the timestamp has changed, False otherwise.
+def calendar_urls_for_attestation(attestation, args):
+    """Determine which remote calendar(s) to ask about a pending attestation
 
-    Note that this means if the timestamp that is already complete, False will
-    be returned as nothing has changed.
+    Returns a (possibly empty) list of calendar URLs.
     """
+    if args.calendar_urls:
+        # FIXME: this message is incorrectly displayed, disabling for now.
+        #
+        # logging.debug("Attestation URI %s overridden by user-specified remote calendar(s)" % attestation.uri)
+        return args.calendar_urls
 
-    def directly_verified(stamp):
-        if stamp.attestations:
-            yield stamp
-        else:
-            for result_stamp in stamp.ops.values():
-                yield from directly_verified(result_stamp)
-        yield from ()
+    elif args.whitelist is None:
+        logging.warning("Ignoring attestation from calendar %s: Remote calendars disabled" % attestation.uri)
+        return []
 
-    def get_attestations(stamp):
-        return set(attest for msg, attest in stamp.all_attestations())
+    elif attestation.uri in args.whitelist:
+        return [attestation.uri]
 
+    else:
+        logging.warning("Ignoring attestation from calendar %s: Calendar not in whitelist" % attestation.uri)
+        return []
 
-    changed = False
 
-    # First, check the cache for upgrades to this timestamp. Since the cache is
-    # local, we do this very agressively, checking every single sub-timestamp
-    # against the cache.
-    def walk_stamp(stamp):
-        yield stamp
-        for sub_stamp in stamp.ops.values():
-            yield from walk_stamp(sub_stamp)
+def upgrade_timestamps(timestamps, args):
+    """Attempt to upgrade incomplete timestamps to make them verifiable
 
-    existing_attestations = get_attestations(timestamp)
-    for sub_stamp in walk_stamp(timestamp):
-        try:
-            cached_stamp = args.cache[sub_stamp.msg]
-        except KeyError:
-            continue
-        sub_stamp.merge(cached_stamp)
+    Pending attestations are collected across all timestamps, and each unique
+    (calendar, commitment) pair is fetched only once, with the result merged
+    into every timestamp that needs it. Timestamps created by the same ots
+    stamp run share a merkle tip, so upgrading them costs roughly one request
+    per calendar, rather than one per timestamp.
+
+    Returns a list of bools, True if the corresponding timestamp has changed,
+    False otherwise.
+
+    Note that this means if a timestamp that is already complete, False will
+    be returned for it as nothing has changed.
+    """
+
+    # Every timestamp is indexed, with the indexes kept up to date as
+    # upgrades are merged in, so neither finding sub-timestamps nor finding
+    # new attestations needs a walk of every tree.
+    indexes = [TimestampIndex(timestamp) for timestamp in timestamps]
+    existing_attestations = [set(index.attestations()) for index in indexes]
 
-    new_attestations_from_cache = get_attestations(timestamp).difference(existing_attestations)
-    if len(new_attestations_from_cache):
-        changed = True
-        logging.info("Got %d attestation(s) from cache" % len(new_attestations_from_cache))
-        existing_attestations.update(new_attestations_from_cache)
-        for new_att in new_attestations_from_cache:
-            logging.debug("    %r" % new_att)
+    def get_new_attestations(i):
+        """Attestations added to timestamps[i] since last called"""
+        new_attestations = indexes[i].attestations() - existing_attestations[i]
+        existing_attestations[i].update(new_attestations)
+        return new_attestations
+
+    def is_complete(i):
+        return any(attestation.__class__ == BitcoinBlockHeaderAttestation
+                   for attestation in indexes[i].attestations())
+
+
+    changed = [False for timestamp in timestamps]
+
+    # First, check the cache for upgrades to these timestamps. Since the cache
+    # is local, we do this very agressively, checking every single
+    # sub-timestamp against the cache.
+    #
+    # Lookups are done in batches, one per level of newly discovered
+    # sub-timestamps: merging a cached timestamp can add nodes that are
+    # themselves in the cache. Timestamps can share sub-timestamps - those
+    # created by the same ots stamp run share everything from their merkle tip
+    # up - so each is only merged into once.
+    probed = set()
+    while True:
+        unprobed = {}
+        for index in indexes:
+            for msg in index.msgs() - probed:
+                for sub_stamp in index.find(msg):
+                    unprobed.setdefault(msg, {})[id(sub_stamp)] = sub_stamp
+        if not unprobed:
+            break
+        probed.update(unprobed.keys())
+
+        for msg, cached_stamp in args.cache.get_many(unprobed.keys()).items():
+            for sub_stamp in unprobed[msg].values():
+                sub_stamp.merge(cached_stamp)
+
+    for i in range(len(timestamps)):
+        new_attestations_from_cache = get_new_attestations(i)
+        if new_attestations_from_cache:
+            changed[i] = True
+            logging.info("Got %d attestation(s) from cache" % len(new_attestations_from_cache))
+            for new_att in new_attestations_from_cache:
+                logging.debug("    %r" % new_att)
+
+    # Remote calendars are polled with bounded concurrency, rate-limited per
+    # calendar, and with exponentially increasing delays between rounds.
+    #
+    # Negative responses are cached, and only honored in the first round:
+    # after that we're deliberately polling for changes.
+    scheduler = otsclient.scheduler.CalendarFetchScheduler(remote_calendar, initial_poll_delay=args.wait_interval,
+                                                           cache=args.cache, negative_ttl=args.negative_cache_ttl,
+                                                           timeout=args.calendar_timeout)
+
+    # Each calendar is only resolved once, so that attestations from calendars
+    # that are ignored are only warned about once.
+    attestation_calendar_urls = {}
+
+    first_round = True
+    while True:
+        incomplete = [i for i in range(len(timestamps)) if not is_complete(i)]
+        if not incomplete:
+            break
 
-    while not is_timestamp_complete(timestamp, args):
         # Check remote calendars for upgrades.
         #
         # This time we only check PendingAttestations - we can't be as
-        # agressive.
-        found_new_attestations = False
-        for sub_stamp in directly_verified(timestamp):
-            for attestation in sub_stamp.attestations:
-                if attestation.__class__ == PendingAttestation:
-                    calendar_urls = args.calendar_urls
-                    if calendar_urls:
-                        # FIXME: this message is incorrectly displayed, disabling for now.
-                        #
-                        # logging.debug("Attestation URI %s overridden by user-specified remote calendar(s)" % attestation.uri)
-                        pass
-                    else:
-                        if args.whitelist is None:
-                            logging.warning("Ignoring attestation from calendar %s: Remote calendars disabled" % attestation.uri)
-                            continue
-                        elif attestation.uri in args.whitelist:
-                            calendar_urls = [attestation.uri]
-                        else:
-                            logging.warning("Ignoring attestation from calendar %s: Calendar not in whitelist" % attestation.uri)
-                            continue
-
-                    commitment = sub_stamp.msg
+        # agressive - and only those that aren't below other attestations.
+        #
+        # Plan all requests first, so that each (calendar, commitment) pair is
+        # only fetched once no matter how many timestamps share it.
+        planned = {}
+        for i in incomplete:
+            for attestation in indexes[i].attestations():
+                if attestation.__class__ != PendingAttestation:
+                    continue
+
+                for sub_stamp in indexes[i].find_attestation(attestation):
+                    if not indexes[i].is_directly_attested(sub_stamp):
+                        continue
+
+                    try:
+                        calendar_urls = attestation_calendar_urls[attestation]
+                    except KeyError:
+                        calendar_urls = calendar_urls_for_attestation(attestation, args)
+                        attestation_calendar_urls[attestation] = calendar_urls
+
                     for calendar_url in calendar_urls:
-                        logging.debug("Checking calendar %s for %s" % (attestation.uri, b2x(commitment)))
-                        calendar = remote_calendar(calendar_url)
-
-                        try:
-                            upgraded_stamp = calendar.get_timestamp(commitment)
-                        except opentimestamps.calendar.CommitmentNotFoundError as exp:
-                            logging.warning("Calendar %s: %s" % (attestation.uri, exp.reason))
-                            continue
-                        except urllib.error.URLError as exp:
-                            logging.warning("Calendar %s: %s" % (attestation.uri, exp.reason))
-                            continue
-
-                        atts_from_remote = get_attestations(upgraded_stamp)
-                        if atts_from_remote:
-                            logging.info("Got %d attestation(s) from %s" % (len(atts_from_remote), calendar_url))
-                            for att in get_attestations(upgraded_stamp):
-                                logging.debug("    %r" % att)
-
-                        new_attestations = get_attestations(upgraded_stamp).difference(existing_attestations)
-                        if new_attestations:
-                            changed = True
-                            found_new_attestations = True
-                            existing_attestations.update(new_attestations)
-
-                            # FIXME: need to think about DoS attacks here
-                            args.cache.merge(upgraded_stamp)
-                            sub_stamp.merge(upgraded_stamp)
+                        planned.setdefault((calendar_url, sub_stamp.msg), []).append((i, sub_stamp))
+
+        logging.debug("Checking %d pending commitment(s) for %d timestamp(s)" % (len(planned), len(incomplete)))
+
+        found_new_attestations = False
+        results = scheduler.fetch(planned, use_negative_cache=first_round)
+        first_round = False
+
+        # FIXME: need to think about DoS attacks here
+        new_cache_stamps = []
+        for (calendar_url, commitment), upgraded_stamp in results.items():
+            atts_from_remote = set()
+            merged = set()
+            for i, sub_stamp in planned[(calendar_url, commitment)]:
+                if id(sub_stamp) not in merged:
+                    merged.add(id(sub_stamp))
+                    atts_from_remote.update(attestation for ops, attestation in sub_stamp.merge(upgraded_stamp))
+
+            if atts_from_remote:
+                found_new_attestations = True
+                logging.info("Got %d attestation(s) from %s" % (len(atts_from_remote), calendar_url))
+                for att in atts_from_remote:
+                    logging.debug("    %r" % att)
+                new_cache_stamps.append(upgraded_stamp)
+
+        for i in incomplete:
+            if get_new_attestations(i):
+                changed[i] = True
+
+        args.cache.merge_many(new_cache_stamps)
 
         if not args.wait:
             break
@@ -283,62 +469,140 @@ def upgrade_timestamp(timestamp, args):
         elif found_new_attestations:
             # We got something new, so loop around immediately to check if
             # we're now complete
+            scheduler.reset_poll_delay()
             continue
 
         else:
             # Nothing new, so wait
-            logging.info("Timestamp not complete; waiting %d sec before trying again" % args.wait_interval)
-            time.sleep(args.wait_interval)
+            delay = scheduler.poll_delay()
+            logging.info("Timestamp not complete; waiting %d sec before trying again" % delay)
+            time.sleep(delay)
+
+    logging.debug("Cache lookups: %d in-memory hit(s), %d miss(es)" % (args.cache.lru_hits, args.cache.lru_misses))
 
     return changed
 
 
-def upgrade_command(args):
-    for old_stamp_fd in args.files:
-        logging.debug("Upgrading %s" % old_stamp_fd.name)
+def upgrade_timestamp(timestamp, args):
+    """Attempt to upgrade an incomplete timestamp to make it verifiable
 
-        ctx = StreamDeserializationContext(old_stamp_fd)
-        try:
-            detached_timestamp = DetachedTimestampFile.deserialize(ctx)
+    Returns True if the timestamp has changed, False otherwise.
 
-        # IOError's are already handled by argparse
-        except BadMagicError:
-            logging.error("Error! %r is not a timestamp file" % old_stamp_fd.name)
-            sys.exit(1)
-        except DeserializationError as exp:
-            logging.error("Invalid timestamp file %r: %s" % (old_stamp_fd.name, exp))
-            sys.exit(1)
+    Note that this means if the timestamp that is already complete, False will
+    be returned as nothing has changed.
+    """
+    return upgrade_timestamps([timestamp], args)[0]
 
-        changed = upgrade_timestamp(detached_timestamp.timestamp, args)
 
-        if changed:
-            backup_name = old_stamp_fd.name + '.bak'
-            logging.debug("Got new timestamp data; renaming existing timestamp to %r" % backup_name)
+def read_timestamp_file(stamp_fd, memoize=False):
+    """Deserialize a timestamp file, exiting if it's invalid
 
-            if os.path.exists(backup_name):
-                logging.error("Could not backup timestamp: %r already exists" % backup_name)
-                sys.exit(1)
+    If memoize is True the timestamp's serialization is memoized, making
+    writing it back out after a small change cheaper; see
+    Timestamp.deserialize().
+    """
+    ctx = BufferDeserializationContext(stamp_fd.read())
+    try:
+        return DetachedTimestampFile.deserialize(ctx, memoize=memoize)
 
-            try:
-                os.rename(old_stamp_fd.name, backup_name)
-            except IOError as exp:
-                logging.error("Could not backup timestamp: %s" % exp)
-                sys.exit(1)
+    # IOError's are already handled by argparse
+    except BadMagicError:
+        logging.error("Error! %r is not a timestamp file" % stamp_fd.name)
+        sys.exit(1)
+    except DeserializationError as exp:
+        logging.error("Invalid timestamp file %r: %s" % (stamp_fd.name, exp))
+        sys.exit(1)
 
-            try:
-                with open(old_stamp_fd.name, 'xb') as new_stamp_fd:
-                    ctx = StreamSerializationContext(new_stamp_fd)
-                    detached_timestamp.serialize(ctx)
-            except IOError as exp:
-                # FIXME: should we try to restore the old file here?
-                logging.error("Could not upgrade timestamp %s: %s" % (old_stamp_fd.name, exp))
-                sys.exit(1)
+
+def replace_timestamp_file(old_stamp_fd, detached_timestamp):
+    """Replace a timestamp file with a changed timestamp
+
+    The existing file is renamed to FILE.bak first; exits if that, or writing
+    the new file, fails.
+    """
+    backup_name = old_stamp_fd.name + '.bak'
+    logging.debug("Renaming existing timestamp to %r" % backup_name)
+
+    if os.path.exists(backup_name):
+        logging.error("Could not backup timestamp: %r already exists" % backup_name)
+        sys.exit(1)
+
+    try:
+        os.rename(old_stamp_fd.name, backup_name)
+    except IOError as exp:
+        logging.error("Could not backup timestamp: %s" % exp)
+        sys.exit(1)
+
+    try:
+        with open(old_stamp_fd.name, 'xb') as new_stamp_fd:
+            ctx = BufferSerializationContext()
+            detached_timestamp.serialize(ctx)
+            new_stamp_fd.write(ctx.getbytes())
+    except IOError as exp:
+        # FIXME: should we try to restore the old file here?
+        logging.error("Could not write timestamp %s: %s" % (old_stamp_fd.name, exp))
+        sys.exit(1)
+
+
+def upgrade_command(args):
+    # Upgraded timestamps are written back out, mostly unchanged
+    detached_timestamps = [read_timestamp_file(old_stamp_fd, memoize=True) for old_stamp_fd in args.files]
+
+    logging.debug("Upgrading %d timestamp(s)" % len(detached_timestamps))
+    changed = upgrade_timestamps([detached_timestamp.timestamp for detached_timestamp in detached_timestamps], args)
+
+    all_complete = True
+    for old_stamp_fd, detached_timestamp, stamp_changed in zip(args.files, detached_timestamps, changed):
+        if stamp_changed:
+            logging.debug("Got new timestamp data")
+            replace_timestamp_file(old_stamp_fd, detached_timestamp)
 
         if is_timestamp_complete(detached_timestamp.timestamp, args):
-            logging.info("Success! Timestamp complete")
+            logging.info("Success! Timestamp %s complete" % old_stamp_fd.name)
         else:
-            logging.warning("Failed! Timestamp not complete")
-            sys.exit(1)
+            logging.warning("Failed! Timestamp %s not complete" % old_stamp_fd.name)
+            all_complete = False
+
+    if not all_complete:
+        sys.exit(1)
+
+
+def prune_timestamp(timestamp):
+    """Prune a complete timestamp down to its earliest Bitcoin attestation
+
+    Everything that doesn't lead to the Bitcoin attestation with the lowest
+    block height - pending attestations, and later Bitcoin attestations - is
+    removed; that's all verification needs.
+
+    Returns the attestations removed, as Timestamp.prune() does. Incomplete
+    timestamps are left as they are.
+    """
+    bitcoin_attestations = [attestation for msg, attestation in timestamp.all_attestations()
+                                        if attestation.__class__ == BitcoinBlockHeaderAttestation]
+    if not bitcoin_attestations:
+        return []
+
+    earliest = min(bitcoin_attestations, key=lambda attestation: attestation.height)
+    return timestamp.prune({earliest})
+
+
+def prune_command(args):
+    for old_stamp_fd in args.files:
+        detached_timestamp = read_timestamp_file(old_stamp_fd)
+
+        if not is_timestamp_complete(detached_timestamp.timestamp, args):
+            logging.warning("Not pruning %s: timestamp not complete; upgrade it first" % old_stamp_fd.name)
+            continue
+
+        removed = prune_timestamp(detached_timestamp.timestamp)
+        if removed:
+            logging.info("Pruned %d attestation(s) from %s" % (len(removed), old_stamp_fd.name))
+            for ops, attestation in removed:
+                logging.debug("    %r" % attestation)
+            replace_timestamp_file(old_stamp_fd, detached_timestamp)
+
+        else:
+            logging.info("Nothing to prune in %s" % old_stamp_fd.name)
 
 
 def verify_timestamp(timestamp, args):
@@ -396,7 +660,7 @@ def verify_timestamp(timestamp, args):
 
 
 def verify_command(args):
-    ctx = StreamDeserializationContext(args.timestamp_fd)
+    ctx = BufferDeserializationContext(args.timestamp_fd.read())
     try:
         detached_timestamp = DetachedTimestampFile.deserialize(ctx)
     except BadMagicError:
@@ -430,7 +694,7 @@ def verify_command(args):
             args.target_fd = open(target_filename, 'rb')
 
         logging.debug("Hashing file, algorithm %s" % detached_timestamp.file_hash_op.TAG_NAME)
-        actual_file_digest = detached_timestamp.file_hash_op.hash_fd(args.target_fd)
+        actual_file_digest = detached_timestamp.file_hash_op.hash_fd(args.target_fd, use_mmap=True)
         logging.debug("Got digest %s" % b2x(actual_file_digest))
 
         if actual_file_digest != detached_timestamp.file_digest:
@@ -443,9 +707,11 @@ def verify_command(args):
 
 
 def info_command(args):
-    ctx = StreamDeserializationContext(args.file)
+    ctx = BufferDeserializationContext(args.file.read())
     try:
-        detached_timestamp = DetachedTimestampFile.deserialize(ctx)
+        # Nothing we print needs the messages, but calculating them is how
+        # invalid operations are found.
+        detached_timestamp = DetachedTimestampFile.deserialize(ctx, lazy=args.lazy)
     except BadMagicError:
         logging.error("Error! %r is not a timestamp file." % args.file.name)
         sys.exit(1)
@@ -459,6 +725,81 @@ def info_command(args):
     print(detached_timestamp.timestamp.str_tree())
 
 
+def scan_timestamp_file(path):
+    """Classify a timestamp file by the attestations in it
+
+    Returns (status, attestations), where status is one of 'complete',
+    'pending', or 'unknown'.
+    """
+    with open(path, 'rb') as fd:
+        ctx = BufferDeserializationContext(fd.read())
+        attestations = set(DetachedTimestampFile.scan(ctx))
+
+    if any(attestation.__class__ == BitcoinBlockHeaderAttestation for attestation in attestations):
+        status = 'complete'
+    elif any(attestation.__class__ == PendingAttestation for attestation in attestations):
+        status = 'pending'
+    else:
+        status = 'unknown'
+
+    return (status, attestations)
+
+
+def scan_command(args):
+    start = time.time()
+    counts = {'complete': 0, 'pending': 0, 'unknown': 0, 'invalid': 0}
+    pending_counts = {}
+    heights = []
+
+    for top in args.dirs:
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if not filename.endswith('.ots'):
+                    continue
+
+                path = os.path.join(dirpath, filename)
+                try:
+                    status, attestations = scan_timestamp_file(path)
+                except (OSError, DeserializationError) as exp:
+                    logging.warning("Invalid timestamp file %r: %s" % (path, exp))
+                    counts['invalid'] += 1
+                    continue
+
+                logging.debug("%s: %s" % (path, status))
+                counts[status] += 1
+
+                for attestation in attestations:
+                    if attestation.__class__ == BitcoinBlockHeaderAttestation:
+                        heights.append(attestation.height)
+                    elif attestation.__class__ == PendingAttestation and status == 'pending':
+                        pending_counts[attestation.uri] = pending_counts.get(attestation.uri, 0) + 1
+
+    logging.debug("Scanned %d timestamp file(s) in %.3f sec" % (sum(counts.values()), time.time() - start))
+
+    print("Timestamp files: %d" % sum(counts.values()))
+    for status in ('complete', 'pending', 'unknown', 'invalid'):
+        print("    %s: %d" % (status, counts[status]))
+
+    if heights:
+        print("Bitcoin block heights: %d to %d" % (min(heights), max(heights)))
+
+    if pending_counts:
+        print("Pending timestamps by calendar:")
+        for uri, count in sorted(pending_counts.items()):
+            print("    %s: %d" % (uri, count))
+
+
+def migrate_cache_command(args):
+    import otsclient.cache
+
+    if args.cache_path is None:
+        args.parser.error('migrate-cache requires a cache')
+
+    start = time.time()
+    n = otsclient.cache.migrate_cache(args.cache_path)
+    logging.info("Migrated %d timestamp(s) to %s in %.1f sec" % (n, args.cache_path, time.time() - start))
+
 
 def git_extract_command(args):
     import git
@@ -535,11 +876,13 @@ def git_extract_command(args):
 
     # Merge the two timestamps
 
-    # First, we need to find the tip of the file timestamp
-    tip = file_stamp.timestamp
-    while tip.ops:
-        assert len(tip.ops) == 1 # FIXME: should handle divergence
-        tip = tuple(tip.ops.values())[0]
+    # First, we need to find the tip of the file timestamp: the timestamp for
+    # the tree, whatever else the file timestamp leads to.
+    tips = TimestampIndex(file_stamp.timestamp).find(stamper.timestamp.msg)
+    if not tips:
+        logging.error("Timestamp for %r doesn't commit to the tree of %s" % (args.path, args.commit))
+        sys.exit(1)
+    tip = tips[0]
 
     # Second, splice it to the commit timestamp.
     #
@@ -553,5 +896,6 @@ def git_extract_command(args):
         args.timestamp_file = open(args.path + '.ots', 'xb')
 
     with args.timestamp_file as fd:
-        ctx = StreamSerializationContext(fd)
+        ctx = BufferSerializationContext()
         file_stamp.serialize(ctx)
+        fd.write(ctx.getbytes())
@@ -14,7 +14,7 @@ import logging
 
 from opentimestamps.core.timestamp import Timestamp
 from opentimestamps.core.op import OpAppend, OpSHA256
-from opentimestamps.core.serialize import BytesSerializationContext, BytesDeserializationContext
+from opentimestamps.core.serialize import BufferSerializationContext, BufferDeserializationContext
 
 # FIXME: This code should be added to python-opentimestamps, although it needs
 # some more refactoring to be ready for that.
@@ -26,7 +26,7 @@ def hash_signed_commit(git_commit, gpg_sig):
     return OpSHA256()(OpSHA256()(git_commit) + OpSHA256()(gpg_sig))
 
 def write_ascii_armored(timestamp, fd, minor_version):
-    ctx = BytesSerializationContext()
+    ctx = BufferSerializationContext()
     timestamp.serialize(ctx)
     serialized_timestamp = ctx.getbytes()
 
@@ -65,7 +65,7 @@ def deserialize_ascii_armored_timestamp(git_commit, gpg_sig):
 
         logging.debug("Git timestamp is version %d.%d" % (major_version, minor_version))
 
-        ctx = BytesDeserializationContext(serialized_stamp[2:])
+        ctx = BufferDeserializationContext(memoryview(serialized_stamp)[2:])
         timestamp = Timestamp.deserialize(ctx, initial_msg)
     except Exception as err:
         logging.error("Bad timestamp: %r" % err)
@@ -0,0 +1,214 @@
+# Copyright (C) 2016 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Client.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Client including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import concurrent.futures
+import logging
+import threading
+import time
+import urllib.error
+
+from bitcoin.core import b2x
+
+import opentimestamps.calendar
+
+from opentimestamps.core.notary import PendingAttestation
+
+class CalendarFetchScheduler:
+    """Concurrent, rate-limited fetching of timestamps from remote calendars
+
+    Lookups are run by a bounded pool of worker threads. Requests to any one
+    calendar are limited to max_per_calendar at a time, and to starting at
+    most one every min_interval seconds, so a large batch doesn't hammer a
+    single calendar. Calendars that fail - network errors, server errors,
+    timeouts - are skipped for an exponentially increasing backoff period,
+    including by requests already queued for them. Only a request started
+    after the last failure can end the backoff by succeeding.
+
+    If a cache is provided, negative responses - commitment not found, or
+    only pending attestations - are recorded in it, and requests that got a
+    negative response less than negative_ttl seconds ago are skipped.
+
+    The scheduler also provides the delay between polling rounds when
+    waiting for timestamps to complete; see poll_delay().
+    """
+
+    def __init__(self, make_calendar, max_workers=8, max_per_calendar=2, min_interval=0.1,
+                 initial_backoff=1, max_backoff=600,
+                 initial_poll_delay=30, max_poll_delay=600,
+                 cache=None, negative_ttl=0, timeout=30):
+        """Create a new scheduler
+
+        make_calendar - Function returning a RemoteCalendar for a URL, with
+                        a timeout keyword argument; called once per calendar
+                        URL.
+        cache         - TimestampCache for negative responses, or None.
+        timeout       - Socket timeout for calendar requests, in seconds; None
+                        for no timeout.
+        """
+        self.make_calendar = make_calendar
+        self.timeout = timeout
+        self.cache = cache
+        self.negative_ttl = negative_ttl
+        self.max_workers = max_workers
+        self.max_per_calendar = max_per_calendar
+        self.min_interval = min_interval
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.initial_poll_delay = initial_poll_delay
+        self.max_poll_delay = max(max_poll_delay, initial_poll_delay)
+
+        self.lock = threading.Lock()
+        self.calendars = {}
+        self.next_request_time = {}
+        self.backoff = {}
+        self.backoff_until = {}
+        self.failure_time = {}
+        self.next_poll_delay = initial_poll_delay
+
+    def __calendar(self, calendar_url):
+        with self.lock:
+            try:
+                return self.calendars[calendar_url]
+            except KeyError:
+                calendar = self.make_calendar(calendar_url, timeout=self.timeout)
+                semaphore = threading.BoundedSemaphore(self.max_per_calendar)
+                self.calendars[calendar_url] = (calendar, semaphore)
+                return (calendar, semaphore)
+
+    def __wait_for_slot(self, calendar_url):
+        """Wait until we're allowed to start a request to the calendar"""
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_request_time.get(calendar_url, now))
+            self.next_request_time[calendar_url] = slot + self.min_interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+    def __record_failure(self, calendar_url):
+        with self.lock:
+            now = time.time()
+            backoff = min(self.backoff.get(calendar_url, self.initial_backoff / 2) * 2, self.max_backoff)
+            self.backoff[calendar_url] = backoff
+            self.backoff_until[calendar_url] = now + backoff
+            self.failure_time[calendar_url] = now
+
+        logging.debug("Calendar %s failed; backing off for %d sec" % (calendar_url, backoff))
+
+    def __record_success(self, calendar_url, start_time):
+        with self.lock:
+            # A request that was already under way when another failed says
+            # nothing about whether the calendar has recovered.
+            if self.failure_time.get(calendar_url, 0) < start_time:
+                self.backoff.pop(calendar_url, None)
+                self.backoff_until.pop(calendar_url, None)
+                self.failure_time.pop(calendar_url, None)
+
+    def is_backing_off(self, calendar_url):
+        """True if requests to a calendar are currently being skipped"""
+        with self.lock:
+            return self.backoff_until.get(calendar_url, 0) > time.time()
+
+    def __fetch(self, request):
+        calendar_url, commitment = request
+        calendar, semaphore = self.__calendar(calendar_url)
+
+        with semaphore:
+            self.__wait_for_slot(calendar_url)
+
+            # The calendar may have failed while we were waiting
+            if self.is_backing_off(calendar_url):
+                logging.debug("Skipping calendar %s: backing off after failure" % calendar_url)
+                return None
+
+            logging.debug("Checking calendar %s for %s" % (calendar_url, b2x(commitment)))
+            start_time = time.time()
+            try:
+                stamp = calendar.get_timestamp(commitment)
+            except opentimestamps.calendar.CommitmentNotFoundError as exp:
+                # The calendar is working fine, it just doesn't have anything
+                # for us yet.
+                logging.warning("Calendar %s: %s" % (calendar_url, exp.reason))
+                self.__record_success(calendar_url, start_time)
+                self.__add_negative(calendar_url, commitment, exp.reason)
+                return None
+            except urllib.error.URLError as exp:
+                logging.warning("Calendar %s: %s" % (calendar_url, exp.reason))
+                self.__record_failure(calendar_url)
+                return None
+
+        self.__record_success(calendar_url, start_time)
+
+        if all(attestation.__class__ == PendingAttestation for msg, attestation in stamp.all_attestations()):
+            self.__add_negative(calendar_url, commitment, 'Pending')
+
+        return stamp
+
+    def __add_negative(self, calendar_url, commitment, reason):
+        if self.cache is not None and self.negative_ttl > 0:
+            self.cache.add_negative(calendar_url, commitment, reason, self.negative_ttl)
+
+    def __get_negative(self, request):
+        """Get the reason for a cached negative response; None if there isn't one"""
+        calendar_url, commitment = request
+        if self.cache is not None and self.negative_ttl > 0:
+            try:
+                return self.cache.get_negative(calendar_url, commitment, self.negative_ttl)
+            except KeyError:
+                pass
+        return None
+
+    def fetch(self, requests, use_negative_cache=True):
+        """Get timestamps for (calendar_url, commitment) pairs
+
+        Requests to calendars that are being backed off from are skipped, as
+        are requests with a cached negative response if use_negative_cache is
+        True. Failures are logged, and omitted from the results.
+
+        Returns a dict of (calendar_url, commitment) -> Timestamp
+        """
+        requests = list(requests)
+
+        if use_negative_cache:
+            uncached_requests = []
+            for request in requests:
+                reason = self.__get_negative(request)
+                if reason is not None:
+                    logging.info("Calendar %s: %s (cached)" % (request[0], reason))
+                else:
+                    uncached_requests.append(request)
+            requests = uncached_requests
+
+        skipped = set(calendar_url for calendar_url, commitment in requests if self.is_backing_off(calendar_url))
+        for calendar_url in skipped:
+            logging.debug("Skipping calendar %s: backing off after failure" % calendar_url)
+        requests = [request for request in requests if request[0] not in skipped]
+
+        if not requests:
+            return {}
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(requests), self.max_workers)) as executor:
+            results = zip(requests, executor.map(self.__fetch, requests))
+            return {request: stamp for request, stamp in results if stamp is not None}
+
+    def poll_delay(self):
+        """Get the delay before the next polling round
+
+        The delay doubles after every call, up to max_poll_delay, until
+        reset_poll_delay() is called.
+        """
+        delay = self.next_poll_delay
+        self.next_poll_delay = min(self.next_poll_delay * 2, self.max_poll_delay)
+        return delay
+
+    def reset_poll_delay(self):
+        """Reset the polling delay, e.g. because progress was made"""
+        self.next_poll_delay = self.initial_poll_delay
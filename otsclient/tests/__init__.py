@@ -0,0 +1,10 @@
+# Copyright (C) 2016 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Client.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Client including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
@@ -0,0 +1,425 @@
+# Copyright (C) 2016 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Client.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Client including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import os
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+from opentimestamps.core.notary import PendingAttestation, BitcoinBlockHeaderAttestation
+from opentimestamps.core.op import OpAppend, OpSHA256
+from opentimestamps.core.timestamp import Timestamp
+
+from otsclient.cache import *
+
+def make_commitment(n):
+    return OpSHA256()(n.to_bytes(4, 'big'))
+
+def make_stamp(n, attestation=None):
+    stamp = Timestamp(make_commitment(n))
+    stamp.ops.add(OpAppend(b'\x01')).attestations.add(attestation or PendingAttestation('http://%d' % n))
+    return stamp
+
+def make_cache_dir(test, version=None):
+    """Make a temporary cache directory, removed once the test is done"""
+    tmp_dir = tempfile.TemporaryDirectory()
+    test.addCleanup(tmp_dir.cleanup)
+    path = tmp_dir.name + '/cache'
+    if version is not None:
+        os.makedirs(path)
+        write_cache_version(path, *version)
+    return path
+
+class BackendTests:
+    """Tests common to every backend"""
+
+    def setUp(self):
+        self.path = make_cache_dir(self)
+        os.makedirs(self.path)
+        self.backend = self.BACKEND(self.path)
+
+    def test_get_put(self):
+        """Getting and setting entries"""
+        for table in ('timestamps', 'negative'):
+            with self.assertRaises(KeyError):
+                self.backend.get(table, make_commitment(1))
+
+            self.backend.put(table, make_commitment(1), table.encode() + b'1')
+            self.assertEqual(self.backend.get(table, make_commitment(1)), table.encode() + b'1')
+
+            self.backend.put(table, make_commitment(1), table.encode() + b'2')
+            self.assertEqual(self.backend.get(table, make_commitment(1)), table.encode() + b'2')
+
+            self.backend.delete(table, make_commitment(1))
+            self.backend.delete(table, make_commitment(1))
+            with self.assertRaises(KeyError):
+                self.backend.get(table, make_commitment(1))
+
+    def test_get_many(self):
+        """Getting many entries at once"""
+        for i in range(10):
+            self.backend.put('timestamps', make_commitment(i), b'%d' % i)
+
+        commitments = [make_commitment(i) for i in range(5, 15)]
+        self.assertEqual(self.backend.get_many('timestamps', commitments),
+                         {make_commitment(i): b'%d' % i for i in range(5, 10)})
+        self.assertEqual(self.backend.get_many('negative', commitments), {})
+        self.assertEqual(self.backend.get_many('timestamps', []), {})
+
+    def test_keys(self):
+        """Iterating over keys, table by table"""
+        for i in range(10):
+            self.backend.put('timestamps', make_commitment(i), b'')
+        self.backend.put('negative', make_commitment(100), b'')
+
+        self.assertEqual(set(self.backend.keys('timestamps')), {make_commitment(i) for i in range(10)})
+        self.assertEqual(set(self.backend.keys('negative')), {make_commitment(100)})
+
+class Test_FileCacheBackend(BackendTests, unittest.TestCase):
+    BACKEND = FileCacheBackend
+
+class Test_SQLiteCacheBackend(BackendTests, unittest.TestCase):
+    BACKEND = SQLiteCacheBackend
+
+    def test_many(self):
+        """Lookups of more keys than fit in one query"""
+        items = [(make_commitment(i), b'%d' % i) for i in range(SQLiteCacheBackend.MAX_VARIABLES * 2 + 1)]
+        self.backend.put_many('timestamps', items)
+        self.assertEqual(self.backend.get_many('timestamps', [key for key, value in items]), dict(items))
+
+    def test_locked_rollback(self):
+        """Writes made while locked are rolled back on error"""
+        with self.assertRaises(ZeroDivisionError):
+            with self.backend.locked('timestamps', [make_commitment(1)]):
+                self.backend.put('timestamps', make_commitment(1), b'')
+                1/0
+
+        with self.assertRaises(KeyError):
+            self.backend.get('timestamps', make_commitment(1))
+
+class TimestampCacheTests:
+    """Tests of TimestampCache common to every backend"""
+
+    def setUp(self):
+        self.path = make_cache_dir(self, (self.BACKEND.MAJOR_VERSION, 0))
+
+    def test_new_cache(self):
+        """New caches use the default backend"""
+        path = make_cache_dir(self)
+        cache = TimestampCache(path)
+        self.assertIsInstance(cache.backend, DEFAULT_BACKEND)
+        self.assertEqual(read_cache_version(path), (DEFAULT_BACKEND.MAJOR_VERSION, 0))
+
+    def test_merge(self):
+        """Merging timestamps into the cache"""
+        cache = TimestampCache(self.path)
+        self.assertIsInstance(cache.backend, self.BACKEND)
+
+        self.assertNotIn(make_commitment(1), cache)
+        cache.merge(make_stamp(1))
+        self.assertEqual(cache[make_commitment(1)], make_stamp(1))
+
+        # Merged with what's already there
+        cache.merge(make_stamp(1, BitcoinBlockHeaderAttestation(1)))
+        expected = make_stamp(1)
+        expected.merge(make_stamp(1, BitcoinBlockHeaderAttestation(1)))
+        self.assertEqual(set(TimestampCache(self.path)[make_commitment(1)].all_attestations()),
+                         set(expected.all_attestations()))
+
+        # The cache returns a new Timestamp every time
+        stamp = cache[make_commitment(1)]
+        stamp.attestations.add(PendingAttestation('changed'))
+        self.assertNotIn(PendingAttestation('changed'), cache[make_commitment(1)].attestations)
+
+    def test_merge_many(self):
+        """Merging and getting many timestamps at once"""
+        cache = TimestampCache(self.path)
+        cache.merge_many([make_stamp(i) for i in range(10)] + [make_stamp(1, BitcoinBlockHeaderAttestation(1))])
+
+        cache = TimestampCache(self.path)
+        stamps = cache.get_many([make_commitment(i) for i in range(5, 15)])
+        self.assertEqual(set(stamps), {make_commitment(i) for i in range(5, 10)})
+        for i in range(5, 10):
+            self.assertEqual(stamps[make_commitment(i)], make_stamp(i))
+
+        self.assertEqual(set(cache[make_commitment(1)].all_attestations()),
+                         {(make_stamp(1).ops[OpAppend(b'\x01')].msg, PendingAttestation('http://1')),
+                          (make_stamp(1).ops[OpAppend(b'\x01')].msg, BitcoinBlockHeaderAttestation(1))})
+
+        # From the LRU the second time
+        cache.lru_hits = 0
+        self.assertEqual(set(cache.get_many([make_commitment(i) for i in range(5, 15)])),
+                         {make_commitment(i) for i in range(5, 10)})
+        self.assertEqual(cache.lru_hits, 10)
+
+    def test_lru(self):
+        """Lookups are remembered by the LRU"""
+        cache = TimestampCache(self.path, lru_size=2)
+        cache.merge_many([make_stamp(i) for i in range(3)])
+
+        cache.lru_hits = cache.lru_misses = 0
+        self.assertIn(make_commitment(2), cache)
+        self.assertNotIn(make_commitment(100), cache)
+        self.assertNotIn(make_commitment(100), cache)
+        self.assertEqual((cache.lru_hits, cache.lru_misses), (2, 1))
+
+        # Only lru_size entries are kept
+        self.assertIn(make_commitment(0), cache)
+        self.assertEqual(cache.lru_misses, 2)
+        self.assertEqual(len(cache.lru), 2)
+
+    def test_corrupt_entry(self):
+        """Corrupt entries are deleted, and replaced by merges"""
+        cache = TimestampCache(self.path, lru_size=0)
+        cache.merge_many([make_stamp(1), make_stamp(2)])
+
+        for i in (1, 2):
+            cache.backend.put('timestamps', make_commitment(i), b'\xff\x00')
+
+        with self.assertLogs(level='WARNING'):
+            self.assertNotIn(make_commitment(1), cache)
+            self.assertEqual(cache.get_many([make_commitment(2)]), {})
+
+        with self.assertRaises(KeyError):
+            cache.backend.get('timestamps', make_commitment(1))
+        with self.assertRaises(KeyError):
+            cache.backend.get('timestamps', make_commitment(2))
+
+        cache.backend.put('timestamps', make_commitment(1), b'\xff\x00')
+        with self.assertLogs(level='WARNING'):
+            cache.merge(make_stamp(1))
+        self.assertEqual(cache[make_commitment(1)], make_stamp(1))
+
+    def test_negative(self):
+        """Negative responses expire after their TTL"""
+        cache = TimestampCache(self.path)
+        now = 1000000
+
+        with unittest.mock.patch('time.time', lambda: now):
+            cache.add_negative('http://a', make_commitment(1), 'Not found', 10)
+            cache.add_negative('http://b', make_commitment(1), 'Pending', 20)
+
+            self.assertEqual(cache.get_negative('http://a', make_commitment(1), 10), 'Not found')
+            self.assertEqual(cache.get_negative('http://b', make_commitment(1), 10), 'Pending')
+            with self.assertRaises(KeyError):
+                cache.get_negative('http://c', make_commitment(1), 10)
+            with self.assertRaises(KeyError):
+                cache.get_negative('http://a', make_commitment(2), 10)
+
+            now += 15
+            with self.assertRaises(KeyError):
+                cache.get_negative('http://a', make_commitment(1), 10)
+            self.assertEqual(cache.get_negative('http://b', make_commitment(1), 20), 'Pending')
+
+            # Replaces the previous response from that calendar, and drops
+            # the expired ones
+            cache.add_negative('http://b', make_commitment(1), 'Still\npending', 10)
+            self.assertEqual(cache.backend.get('negative', make_commitment(1)).count(b'\n'), 1)
+            self.assertEqual(cache.get_negative('http://b', make_commitment(1), 10), 'Still pending')
+
+            now += 10
+            with self.assertRaises(KeyError):
+                cache.get_negative('http://b', make_commitment(1), 10)
+
+    def test_concurrent_merges(self):
+        """Concurrent merges into caches sharing a directory aren't lost"""
+        caches = [TimestampCache(self.path, lru_size=0) for i in range(4)]
+
+        def merge(n):
+            for i in range(20):
+                caches[n].merge(make_stamp(0, PendingAttestation('http://%d/%d' % (n, i))))
+                caches[n].merge(make_stamp(100*n + i))
+
+        threads = [threading.Thread(target=merge, args=(n,)) for n in range(len(caches))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        cache = TimestampCache(self.path, lru_size=0)
+        self.assertEqual(len([attestation for msg, attestation in cache[make_commitment(0)].all_attestations()]),
+                         len(caches) * 20 + 1)
+        for n in range(len(caches)):
+            for i in range(20):
+                self.assertIn(make_commitment(100*n + i), cache)
+
+class Test_TimestampCache_FileCacheBackend(TimestampCacheTests, unittest.TestCase):
+    BACKEND = FileCacheBackend
+
+class Test_TimestampCache_SQLiteCacheBackend(TimestampCacheTests, unittest.TestCase):
+    BACKEND = SQLiteCacheBackend
+
+class Test_migrate_cache(unittest.TestCase):
+    def test_migrate(self):
+        """Migrating a version 1 cache to version 2"""
+        path = make_cache_dir(self, (1, 0))
+        cache = TimestampCache(path)
+        cache.merge_many([make_stamp(i) for i in range(10)])
+        cache.add_negative('http://a', make_commitment(1), 'Not found', 600)
+
+        # Written by an older client, that doesn't update the Bloom filter
+        cache.backend.put('timestamps', make_commitment(10), cache.backend.get('timestamps', make_commitment(1)))
+
+        self.assertEqual(migrate_cache(path), 11)
+        self.assertEqual(read_cache_version(path), (2, 0))
+
+        cache = TimestampCache(path)
+        self.assertIsInstance(cache.backend, SQLiteCacheBackend)
+        for i in range(10):
+            self.assertEqual(cache[make_commitment(i)], make_stamp(i))
+        self.assertIn(make_commitment(10), cache)
+        self.assertEqual(cache.get_negative('http://a', make_commitment(1), 600), 'Not found')
+
+        # Nothing to do the second time
+        self.assertEqual(migrate_cache(path), 0)
+
+    def test_migrate_interrupted(self):
+        """An interrupted migration leaves the old cache usable"""
+        path = make_cache_dir(self, (1, 0))
+        TimestampCache(path).merge(make_stamp(1))
+
+        with unittest.mock.patch.object(SQLiteCacheBackend, 'put_many', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                migrate_cache(path)
+
+        self.assertEqual(read_cache_version(path), (1, 0))
+        self.assertEqual(TimestampCache(path)[make_commitment(1)], make_stamp(1))
+
+class Test_BloomFilter(unittest.TestCase):
+    def setUp(self):
+        self.path = make_cache_dir(self)
+
+        # Small enough to need growing after a couple of hundred commitments
+        patcher = unittest.mock.patch.object(BloomFilter, 'MIN_LOG2_BITS', 11)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lookups(self):
+        """Misses are answered by the filter, without touching the backend"""
+        cache = TimestampCache(self.path, lru_size=0)
+        cache.merge(make_stamp(1))
+
+        with unittest.mock.patch.object(cache.backend, 'get', side_effect=AssertionError):
+            for i in range(2, 100):
+                self.assertNotIn(make_commitment(i), cache)
+
+        self.assertIn(make_commitment(1), cache)
+
+    def test_growth(self):
+        """The filter is rebuilt larger as commitments are added"""
+        cache = TimestampCache(self.path, lru_size=0)
+        log2_bits = cache.bloom.log2_bits
+
+        for i in range(0, 1000, 100):
+            cache.merge_many([make_stamp(j) for j in range(i, i + 100)])
+        self.assertGreater(cache.bloom.log2_bits, log2_bits)
+
+        for i in range(1000):
+            self.assertIn(make_commitment(i), cache.bloom)
+
+        false_positives = sum(make_commitment(i) in cache.bloom for i in range(1000, 2000))
+        self.assertLess(false_positives, 100)
+
+    def test_rebuild(self):
+        """Missing and corrupt filters are rebuilt from the backend"""
+        cache = TimestampCache(self.path, lru_size=0)
+        cache.merge_many([make_stamp(i) for i in range(10)])
+        cache.bloom.close()
+
+        for corrupt in (None, b'', b'OTSBLOOM', b'\x00' * 1000):
+            if corrupt is None:
+                os.remove(self.path + '/bloom')
+            else:
+                with open(self.path + '/bloom', 'wb') as fd:
+                    fd.write(corrupt)
+
+            cache = TimestampCache(self.path, lru_size=0)
+            for i in range(10):
+                self.assertIn(make_commitment(i), cache.bloom)
+            cache.bloom.close()
+
+    def test_shared(self):
+        """Commitments added after another process rebuilt the filter are found"""
+        cache1 = TimestampCache(self.path, lru_size=0)
+        cache2 = TimestampCache(self.path, lru_size=0)
+        cache1.merge(make_stamp(0))
+        self.assertIn(make_commitment(0), cache2)
+
+        # Grown by cache2; cache1 still has the old filter mapped
+        log2_bits = cache1.bloom.log2_bits
+        cache2.merge_many([make_stamp(i) for i in range(1, 1000)])
+        self.assertGreater(cache2.bloom.log2_bits, log2_bits)
+
+        cache2.merge(make_stamp(1000))
+        self.assertIn(make_commitment(1000), cache1.bloom)
+        self.assertEqual(cache1.bloom.log2_bits, cache2.bloom.log2_bits)
+
+        cache1.merge(make_stamp(1001))
+        for i in range(1002):
+            self.assertIn(make_commitment(i), cache1.bloom)
+            self.assertIn(make_commitment(i), cache2.bloom)
+
+    def test_backends(self):
+        """Only caches with a generation use a filter, and only once needed"""
+        cache = TimestampCache(make_cache_dir(self, (1, 0)))
+        cache.merge(make_stamp(1))
+        self.assertIsNone(cache.bloom)
+        self.assertEqual(cache[make_commitment(1)], make_stamp(1))
+        self.assertFalse(os.path.exists(cache.path + '/bloom'))
+
+        cache = TimestampCache(self.path)
+        self.assertFalse(os.path.exists(self.path + '/bloom'))
+        with self.assertRaises(KeyError):
+            cache[make_commitment(1)]
+        self.assertTrue(os.path.exists(self.path + '/bloom'))
+
+    def test_generation(self):
+        """Filters that missed writes to the backend are rebuilt"""
+        cache = TimestampCache(self.path, lru_size=0)
+        cache.merge(make_stamp(1))
+
+        # As if a process crashed between writing to the backend and the
+        # filter
+        cache.backend.put('timestamps', make_commitment(2), cache.backend.get('timestamps', make_commitment(1)))
+        self.assertNotIn(make_commitment(2), cache.bloom)
+
+        cache = TimestampCache(self.path, lru_size=0)
+        self.assertIn(make_commitment(2), cache)
+
+        # Nothing missed, so nothing to rebuild
+        with unittest.mock.patch.object(SQLiteCacheBackend, 'keys', side_effect=AssertionError):
+            TimestampCache(self.path, lru_size=0).bloom
+
+    def test_concurrent_adds(self):
+        """Concurrent adds, and rebuilds, don't lose commitments"""
+        os.makedirs(self.path)
+        filters = [BloomFilter(self.path + '/bloom', SQLiteCacheBackend(self.path)) for i in range(4)]
+
+        # The filters are rebuilt from the backend, so the commitments have to
+        # be written there first, as TimestampCache does.
+        def add(n):
+            for i in range(100):
+                commitment = make_commitment(1000*n + i)
+                filters[n].backend.put('timestamps', commitment, b'')
+                filters[n].add(commitment)
+
+        threads = [threading.Thread(target=add, args=(n,)) for n in range(len(filters))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Checked with one of the filters, as opening a new one would rebuild
+        # it: the adds didn't record the backend's generation.
+        for n in range(len(filters)):
+            for i in range(100):
+                self.assertIn(make_commitment(1000*n + i), filters[0])
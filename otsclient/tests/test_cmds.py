@@ -0,0 +1,224 @@
+# Copyright (C) 2016 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Client.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Client including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+from opentimestamps.calendar import UrlWhitelist
+from opentimestamps.core.notary import PendingAttestation, BitcoinBlockHeaderAttestation
+from opentimestamps.core.op import OpAppend, OpSHA256
+from opentimestamps.core.serialize import BytesSerializationContext, BytesDeserializationContext
+from opentimestamps.core.timestamp import Timestamp, DetachedTimestampFile
+from opentimestamps.timestamp import MerkleTree
+
+from otsclient.cache import TimestampCache
+from otsclient.cmds import *
+from otsclient.tests.test_scheduler import FakeCalendar
+
+def make_args(**kwargs):
+    """Make the arguments the commands expect, with remote calendars disabled"""
+    args = argparse.Namespace(cache=TimestampCache(None), calendar_urls=[], whitelist=None,
+                              wait=False, wait_interval=30, negative_cache_ttl=0, calendar_timeout=30,
+                              use_bitcoin=False)
+    vars(args).update(kwargs)
+    return args
+
+class SubmitCalendar:
+    """Stand-in for a RemoteCalendar that can be told to stall submissions"""
+
+    def __init__(self, url, timeout=None, stalled=False):
+        self.url = url
+        self.timeout = timeout
+        self.stalled = threading.Event() if stalled else None
+
+    def submit(self, digest):
+        if self.stalled is not None:
+            self.stalled.wait()
+        stamp = Timestamp(digest)
+        stamp.ops.add(OpAppend(b'\x01')).attestations.add(PendingAttestation(self.url))
+        return stamp
+
+class Test_create_timestamp(unittest.TestCase):
+    def setUp(self):
+        self.calendars = {}
+
+    def tearDown(self):
+        for calendar in self.calendars.values():
+            if calendar.stalled is not None:
+                calendar.stalled.set()
+
+    def create_timestamp(self, calendar_urls, **kwargs):
+        def make_calendar(url, timeout=None):
+            calendar = SubmitCalendar(url, timeout, stalled=url.startswith('http://stalled'))
+            self.calendars[url] = calendar
+            return calendar
+
+        stamp = Timestamp(b'\x00'*32)
+        with unittest.mock.patch('otsclient.cmds.remote_calendar', make_calendar):
+            start = time.monotonic()
+            result = create_timestamp(stamp, calendar_urls, **kwargs)
+            return (result, stamp, time.monotonic() - start)
+
+    def test_quorum(self):
+        """Returns once m calendars have replied, without waiting for stalled ones"""
+        result, stamp, elapsed = self.create_timestamp(['http://stalled', 'http://a'], m=1, calendar_timeout=60)
+        self.assertTrue(result)
+        self.assertLess(elapsed, 30)
+        self.assertEqual(set(attestation for msg, attestation in stamp.all_attestations()),
+                         {PendingAttestation('http://a')})
+        self.assertEqual(self.calendars['http://stalled'].timeout, 60)
+
+    def test_deadline(self):
+        """Fails if fewer than m calendars reply by the deadline"""
+        with self.assertLogs(level='WARNING') as logs:
+            result, stamp, elapsed = self.create_timestamp(['http://stalled', 'http://a'], m=2, deadline=0.1)
+        self.assertFalse(result)
+        self.assertGreaterEqual(elapsed, 0.1)
+        self.assertLess(elapsed, 30)
+        self.assertIn('Remote calendar http://stalled did not reply within 0.1 sec', '\n'.join(logs.output))
+
+        # Every calendar is waited for by default
+        result, stamp, elapsed = self.create_timestamp(['http://a', 'http://b'])
+        self.assertTrue(result)
+        self.assertEqual(len(list(stamp.all_attestations())), 2)
+
+class Test_stamp_command(unittest.TestCase):
+    def test_jobs_spawn(self):
+        """Stamping with --jobs works with worker processes started by spawn"""
+        executors = []
+        class SpawnProcessPoolExecutor(concurrent.futures.ProcessPoolExecutor):
+            def __init__(self, max_workers=None):
+                super().__init__(max_workers, mp_context=multiprocessing.get_context('spawn'))
+
+            def map(self, *args, **kwargs):
+                executors.append(self)
+                return super().map(*args, **kwargs)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = [os.path.join(tmpdir, str(i)) for i in range(8)]
+            for i, path in enumerate(paths):
+                with open(path, 'wb') as fd:
+                    fd.write(bytes([i]))
+
+            fds = [open(path, 'rb') for path in paths]
+            try:
+                with unittest.mock.patch('concurrent.futures.ProcessPoolExecutor', SpawnProcessPoolExecutor), \
+                     unittest.mock.patch.object(MerkleTree, 'PARALLEL_CHUNK_PAIRS', 1), \
+                     unittest.mock.patch('otsclient.cmds.remote_calendar', SubmitCalendar):
+                    stamp_command(make_args(files=fds, jobs=2, m=1, deadline=None, use_btc_wallet=False,
+                                            calendar_urls=['http://a']))
+            finally:
+                for fd in fds:
+                    fd.close()
+
+            self.assertTrue(executors)
+
+            # Every file's timestamp leads to the same calendar commitment
+            commitments = set()
+            for path in paths:
+                with open(path + '.ots', 'rb') as fd:
+                    stamp = DetachedTimestampFile.deserialize(BytesDeserializationContext(fd.read()))
+                attestations = list(stamp.timestamp.all_attestations())
+                self.assertEqual([attestation for msg, attestation in attestations], [PendingAttestation('http://a')])
+                commitments.add(attestations[0][0])
+            self.assertEqual(len(commitments), 1)
+
+class Test_upgrade_timestamps(unittest.TestCase):
+    def test_deep(self):
+        """Upgrading, verifying and pruning timestamps deeper than Python's recursion limit"""
+        depth = sys.getrecursionlimit() * 2
+        stamp = Timestamp(b'')
+        tip = stamp
+        for i in range(depth):
+            tip = tip.ops.add(OpAppend(b'\x00'))
+        tip.attestations.add(PendingAttestation('http://calendar'))
+
+        args = make_args()
+        self.assertFalse(is_timestamp_complete(stamp, args))
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(upgrade_timestamps([stamp], args), [False])
+
+        tip.attestations.add(BitcoinBlockHeaderAttestation(1))
+        self.assertTrue(is_timestamp_complete(stamp, args))
+
+        # Nothing to upgrade, and Bitcoin is disabled
+        with self.assertLogs(level='WARNING'):
+            self.assertFalse(verify_timestamp(stamp, args))
+
+        self.assertEqual(prune_timestamp(stamp), [((OpAppend(b'\x00'),)*depth, PendingAttestation('http://calendar'))])
+
+    def test_calendars(self):
+        """Only pending attestations that aren't below other attestations are checked"""
+        calendars = {}
+        def make_calendar(url, timeout=None):
+            return calendars.setdefault(url, FakeCalendar(url))
+
+        stamp = Timestamp(b'')
+        a_stamp = stamp.ops.add(OpAppend(b'a'))
+        a_stamp.attestations.add(PendingAttestation('http://good'))
+        a_stamp.ops.add(OpAppend(b'b')).attestations.add(PendingAttestation('http://good'))
+        for i in range(3):
+            stamp.ops.add(OpAppend(bytes([i]))).attestations.add(PendingAttestation('http://evil'))
+
+        make_calendar('http://good').add(b'a', BitcoinBlockHeaderAttestation(1))
+
+        args = make_args(whitelist=UrlWhitelist(['http://good']))
+        with unittest.mock.patch('otsclient.cmds.remote_calendar', make_calendar):
+            with self.assertLogs(level='WARNING') as logs:
+                self.assertEqual(upgrade_timestamps([stamp], args), [True])
+
+        self.assertEqual(calendars['http://good'].commitments, [b'a'])
+        self.assertNotIn('http://evil', calendars)
+
+        # Warned about once, rather than once per timestamp with the attestation
+        self.assertEqual(logs.output, ['WARNING:root:Ignoring attestation from calendar http://evil: Calendar not in whitelist'])
+        self.assertTrue(is_timestamp_complete(stamp, args))
+
+class Test_info_command(unittest.TestCase):
+    def info(self, serialized, **kwargs):
+        with tempfile.TemporaryFile() as fd:
+            fd.write(serialized)
+            fd.seek(0)
+
+            stdout = io.StringIO()
+            with contextlib.redirect_stdout(stdout):
+                info_command(make_args(file=fd, **kwargs))
+            return stdout.getvalue()
+
+    def test_invalid_op(self):
+        """Invalid operations are only detected without --lazy"""
+        ctx = BytesSerializationContext()
+        ctx.write_bytes(DetachedTimestampFile.HEADER_MAGIC)
+        ctx.write_varuint(DetachedTimestampFile.MAJOR_VERSION)
+        OpSHA256().serialize(ctx)
+        ctx.write_bytes(OpSHA256()(b''))
+
+        # Result is longer than the maximum message length
+        OpAppend(b'\x00' * 4096).serialize(ctx)
+        ctx.write_bytes(b'\x00')
+        PendingAttestation('http://calendar').serialize(ctx)
+
+        with self.assertLogs(level='ERROR') as logs:
+            with self.assertRaises(SystemExit):
+                self.info(ctx.getbytes(), lazy=False)
+        self.assertIn('Invalid timestamp file', logs.output[0])
+
+        self.assertIn("verify PendingAttestation('http://calendar')", self.info(ctx.getbytes(), lazy=True))
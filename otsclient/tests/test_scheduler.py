@@ -0,0 +1,241 @@
+# Copyright (C) 2016 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Client.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Client including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+import urllib.error
+
+from opentimestamps.calendar import CommitmentNotFoundError
+from opentimestamps.core.notary import PendingAttestation, BitcoinBlockHeaderAttestation
+from opentimestamps.core.op import OpAppend
+from opentimestamps.core.timestamp import Timestamp
+
+from otsclient.cache import TimestampCache
+from otsclient.scheduler import *
+
+class FakeCalendar:
+    """Stand-in for a RemoteCalendar, recording the requests made to it"""
+
+    def __init__(self, url, timeout=None):
+        self.url = url
+        self.timeout = timeout
+        self.timestamps = {}
+        self.fail = False
+        self.delay = 0
+
+        # Per-commitment overrides of fail and delay
+        self.failing = set()
+        self.delays = {}
+
+        self.lock = threading.Lock()
+        self.commitments = []
+        self.request_times = []
+        self.active = 0
+        self.max_active = 0
+
+    def add(self, commitment, attestation):
+        stamp = Timestamp(commitment)
+        stamp.ops.add(OpAppend(b'\x01')).attestations.add(attestation)
+        self.timestamps[commitment] = stamp
+
+    def get_timestamp(self, commitment):
+        with self.lock:
+            self.commitments.append(commitment)
+            self.request_times.append(time.monotonic())
+            self.active += 1
+            self.max_active = max(self.active, self.max_active)
+
+        try:
+            delay = self.delays.get(commitment, self.delay)
+            if delay:
+                time.sleep(delay)
+
+            if self.fail or commitment in self.failing:
+                raise urllib.error.URLError('Calendar down')
+
+            try:
+                return self.timestamps[commitment]
+            except KeyError:
+                raise CommitmentNotFoundError('Commitment not found')
+
+        finally:
+            with self.lock:
+                self.active -= 1
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000000.0
+
+    def __call__(self):
+        return self.now
+
+class Test_CalendarFetchScheduler(unittest.TestCase):
+    def setUp(self):
+        self.calendars = {}
+
+    def make_calendar(self, url, timeout=None):
+        return self.calendars.setdefault(url, FakeCalendar(url, timeout))
+
+    def make_scheduler(self, **kwargs):
+        kwargs.setdefault('min_interval', 0)
+        return CalendarFetchScheduler(self.make_calendar, **kwargs)
+
+    def test_fetch(self):
+        """Fetching timestamps from several calendars"""
+        scheduler = self.make_scheduler()
+        self.make_calendar('http://a').add(b'\x01', BitcoinBlockHeaderAttestation(1))
+        self.make_calendar('http://b').add(b'\x02', PendingAttestation('http://b'))
+
+        with self.assertLogs(level='WARNING'):
+            stamps = scheduler.fetch([('http://a', b'\x01'), ('http://a', b'\x02'),
+                                      ('http://b', b'\x01'), ('http://b', b'\x02')])
+
+        self.assertEqual(stamps, {('http://a', b'\x01'): self.calendars['http://a'].timestamps[b'\x01'],
+                                  ('http://b', b'\x02'): self.calendars['http://b'].timestamps[b'\x02']})
+
+        # Not found isn't a failure
+        self.assertFalse(scheduler.is_backing_off('http://a'))
+        self.assertFalse(scheduler.is_backing_off('http://b'))
+
+        self.assertEqual(scheduler.fetch([]), {})
+
+        # Calendars are created with the scheduler's timeout
+        with self.assertLogs(level='WARNING'):
+            scheduler.fetch([('http://c', b'\x01')])
+        self.assertEqual(self.calendars['http://c'].timeout, 30)
+
+    def test_backoff(self):
+        """Failing calendars are backed off from exponentially"""
+        clock = FakeClock()
+        scheduler = self.make_scheduler(initial_backoff=1, max_backoff=3)
+        calendar = self.make_calendar('http://a')
+        calendar.add(b'\x01', BitcoinBlockHeaderAttestation(1))
+        calendar.fail = True
+
+        with unittest.mock.patch('time.time', clock):
+            for expected_backoff in (1, 2, 3, 3):
+                with self.assertLogs(level='WARNING'):
+                    self.assertEqual(scheduler.fetch([('http://a', b'\x01')]), {})
+                self.assertEqual(len(calendar.request_times), 1)
+                self.assertTrue(scheduler.is_backing_off('http://a'))
+
+                # Skipped while backing off
+                clock.now += expected_backoff - 0.5
+                self.assertEqual(scheduler.fetch([('http://a', b'\x01')]), {})
+                self.assertEqual(len(calendar.request_times), 1)
+
+                clock.now += 0.5
+                self.assertFalse(scheduler.is_backing_off('http://a'))
+                calendar.request_times.clear()
+
+            # Success resets the backoff
+            calendar.fail = False
+            self.assertEqual(len(scheduler.fetch([('http://a', b'\x01')])), 1)
+
+            calendar.fail = True
+            with self.assertLogs(level='WARNING'):
+                scheduler.fetch([('http://a', b'\x01')])
+            clock.now += 1
+            self.assertFalse(scheduler.is_backing_off('http://a'))
+
+    def test_backoff_mid_round(self):
+        """Requests already queued for a calendar that fails are skipped"""
+        scheduler = self.make_scheduler(max_per_calendar=1)
+        calendar = self.make_calendar('http://a')
+        calendar.fail = True
+
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(scheduler.fetch([('http://a', bytes([i])) for i in range(5)]), {})
+        self.assertEqual(len(calendar.request_times), 1)
+
+    def test_backoff_stale_success(self):
+        """Requests started before a failure don't end the backoff"""
+        scheduler = self.make_scheduler(max_per_calendar=2)
+        calendar = self.make_calendar('http://a')
+        calendar.add(b'\x01', BitcoinBlockHeaderAttestation(1))
+        calendar.delays[b'\x01'] = 0.1
+        calendar.failing.add(b'\x02')
+
+        with self.assertLogs(level='WARNING'):
+            stamps = scheduler.fetch([('http://a', b'\x01'), ('http://a', b'\x02')])
+        self.assertEqual(list(stamps), [('http://a', b'\x01')])
+        self.assertTrue(scheduler.is_backing_off('http://a'))
+
+    def test_rate_limit(self):
+        """Requests to a calendar are spaced out, and limited in number"""
+        scheduler = self.make_scheduler(max_workers=8, max_per_calendar=2, min_interval=0.02)
+        calendar_a = self.make_calendar('http://a')
+        calendar_b = self.make_calendar('http://b')
+        for calendar in (calendar_a, calendar_b):
+            calendar.delay = 0.05
+            for i in range(6):
+                calendar.add(bytes([i]), BitcoinBlockHeaderAttestation(i))
+
+        stamps = scheduler.fetch([(url, bytes([i])) for url in ('http://a', 'http://b') for i in range(6)])
+        self.assertEqual(len(stamps), 12)
+
+        for calendar in (calendar_a, calendar_b):
+            self.assertLessEqual(calendar.max_active, 2)
+
+            request_times = sorted(calendar.request_times)
+            for earlier, later in zip(request_times, request_times[1:]):
+                self.assertGreaterEqual(later - earlier, 0.015)
+
+    def test_negative_cache(self):
+        """Negative responses are cached until they expire"""
+        clock = FakeClock()
+        with tempfile.TemporaryDirectory() as cache_path:
+            cache = TimestampCache(cache_path + '/cache')
+            scheduler = self.make_scheduler(cache=cache, negative_ttl=60)
+            calendar = self.make_calendar('http://a')
+            calendar.add(b'\x02', PendingAttestation('http://a'))
+            calendar.add(b'\x03', BitcoinBlockHeaderAttestation(1))
+
+            requests = [('http://a', bytes([i])) for i in range(1, 4)]
+            with unittest.mock.patch('time.time', clock):
+                with self.assertLogs(level='WARNING'):
+                    self.assertEqual(set(scheduler.fetch(requests)), {('http://a', b'\x02'), ('http://a', b'\x03')})
+                self.assertEqual(cache.get_negative('http://a', b'\x01', 60), 'Commitment not found')
+                self.assertEqual(cache.get_negative('http://a', b'\x02', 60), 'Pending')
+                with self.assertRaises(KeyError):
+                    cache.get_negative('http://a', b'\x03', 60)
+
+                # Only the complete timestamp is asked for again
+                calendar.request_times.clear()
+                self.assertEqual(set(scheduler.fetch(requests)), {('http://a', b'\x03')})
+                self.assertEqual(len(calendar.request_times), 1)
+
+                # Unless the cache isn't to be used
+                calendar.request_times.clear()
+                with self.assertLogs(level='WARNING'):
+                    scheduler.fetch(requests, use_negative_cache=False)
+                self.assertEqual(len(calendar.request_times), 3)
+
+                # Or the negative responses have expired
+                clock.now += 61
+                calendar.request_times.clear()
+                with self.assertLogs(level='WARNING'):
+                    scheduler.fetch(requests)
+                self.assertEqual(len(calendar.request_times), 3)
+
+    def test_poll_delay(self):
+        """Polling delay doubles up to the maximum, until reset"""
+        scheduler = self.make_scheduler(initial_poll_delay=1, max_poll_delay=5)
+        self.assertEqual([scheduler.poll_delay() for i in range(5)], [1, 2, 4, 5, 5])
+        scheduler.reset_poll_delay()
+        self.assertEqual(scheduler.poll_delay(), 1)
+
+        # Never less than the initial delay
+        scheduler = self.make_scheduler(initial_poll_delay=60, max_poll_delay=30)
+        self.assertEqual([scheduler.poll_delay() for i in range(2)], [60, 60])
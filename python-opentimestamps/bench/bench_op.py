@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# Copyright (C) 2016 The OpenTimestamps developers
+#
+# This file is part of python-opentimestamps.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-opentimestamps including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+"""Microbenchmark of operations on large timestamp proofs
+
+Times deserializing, serializing and merging a proof with many thousands of
+operations in it, along with the Op comparisons and hashing those spend much
+of their time in. Run it before and after a change to Op:
+
+    ./bench/bench_op.py [--leaves N] [--repeat N]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from opentimestamps.core.notary import BitcoinBlockHeaderAttestation
+from opentimestamps.core.op import OpAppend, OpPrepend, OpSHA256
+from opentimestamps.core.serialize import BytesDeserializationContext, BytesSerializationContext
+from opentimestamps.core.timestamp import Timestamp, make_merkle_tree
+
+def make_proof(num_leaves):
+    """Make a proof that forks into num_leaves nonced paths to one merkle tree
+
+    Every path ends in a Bitcoin-style path to a block header attestation, so
+    serialized it's a tree of roughly num_leaves * log2(num_leaves) ops.
+    """
+    root = Timestamp(OpSHA256()(b'bench'))
+
+    leaves = []
+    for i in range(num_leaves):
+        leaf = root.ops.add(OpAppend(i.to_bytes(16, 'big')))
+        leaves.append(leaf.ops.add(OpSHA256()))
+
+    tip = make_merkle_tree(leaves)
+    for i in range(12):
+        tip = tip.ops.add(OpPrepend(i.to_bytes(32, 'big')) if i % 2 else OpAppend(i.to_bytes(32, 'big')))
+        tip = tip.ops.add(OpSHA256()).ops.add(OpSHA256())
+    tip.attestations.add(BitcoinBlockHeaderAttestation(400000))
+
+    return root
+
+def serialize(stamp):
+    ctx = BytesSerializationContext()
+    stamp.serialize(ctx)
+    return ctx.getbytes()
+
+def deserialize(serialized, msg):
+    # A stream context, so that nothing is memoized and every serialize()
+    # below actually does the work.
+    return Timestamp.deserialize(BytesDeserializationContext(serialized), msg)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--leaves', type=int, default=2**12,
+                        help='Number of leaves in the proof. Default: %(default)d')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Best of this many runs. Default: %(default)d')
+    args = parser.parse_args()
+
+    proof = make_proof(args.leaves)
+    serialized = serialize(proof)
+    msg = proof.msg
+    print('%d leaves, %d bytes serialized' % (args.leaves, len(serialized)))
+
+    def bench(name, stmt, setup=lambda: None, number=1):
+        def run():
+            state = setup()
+            start = timeit.default_timer()
+            for i in range(number):
+                stmt(state)
+            return timeit.default_timer() - start
+        best = min(run() for i in range(args.repeat))
+        print('%-24s %10.3f ms' % (name, best / number * 1000))
+
+    bench('deserialize', lambda state: deserialize(serialized, msg))
+    bench('serialize', lambda state: serialize(state),
+          setup=lambda: deserialize(serialized, msg))
+    bench('merge', lambda state: state[0].merge(state[1]),
+          setup=lambda: (deserialize(serialized, msg), deserialize(serialized, msg)))
+
+    ops = [OpAppend(i.to_bytes(16, 'big')) for i in range(1000)] + [OpSHA256()] * 1000
+    bench('sort 2000 ops', lambda state: sorted(ops), number=100)
+    bench('hash 2000 ops', lambda state: [hash(op) for op in ops], number=100)
+    bench('construct 1000 OpSHA256', lambda state: [OpSHA256() for i in range(1000)], number=100)
+
+if __name__ == '__main__':
+    main()
@@ -12,7 +12,7 @@
 from bitcoin.core import b2lx
 
 from opentimestamps.core.timestamp import Timestamp, cat_sha256d
-from opentimestamps.core.op import OpAppend, OpPrepend
+from opentimestamps.core.op import OpAppend, OpPrepend, OpSHA256
 from opentimestamps.core.notary import BitcoinBlockHeaderAttestation
 
 
@@ -24,11 +24,17 @@ def __make_btc_block_merkle_tree(blk_txids):
         # The famously broken Satoshi algorithm: if the # of digests at this
         # level is odd, double the last one.
         if len(digests) % 2:
-            digests.append(digests[-1].msg)
+            digests.append(Timestamp(digests[-1].msg))
+
+        # Hash the whole level at once, rather than pair by pair
+        sha256_results = OpSHA256.hash_many([digests[i].msg + digests[i + 1].msg
+                                             for i in range(0, len(digests), 2)])
+        results = OpSHA256.hash_many(sha256_results)
 
         next_level = []
         for i in range(0,len(digests), 2):
-            next_level.append(cat_sha256d(digests[i], digests[i + 1]))
+            next_level.append(cat_sha256d(digests[i], digests[i + 1],
+                                          results[i // 2], sha256_results[i // 2]))
 
         digests = next_level
 
@@ -10,11 +10,17 @@
 # in the LICENSE file.
 
 import binascii
+import http.client
+import io
+import select
+import threading
+import urllib.error
+import urllib.parse
 import urllib.request
 import fnmatch
 
 from opentimestamps.core.timestamp import Timestamp
-from opentimestamps.core.serialize import BytesDeserializationContext
+from opentimestamps.core.serialize import BufferDeserializationContext
 
 def get_sanitised_resp_msg(exp):
     """Get the sanitise response messages from a calendar response
@@ -40,63 +46,271 @@ class CommitmentNotFoundError(KeyError):
         super().__init__(reason)
         self.reason = reason
 
+class ConnectionPool:
+    """Pool of persistent HTTP/1.1 connections
+
+    Connections are kept alive and reused for subsequent requests to the same
+    scheme and host, so only the first request to a calendar pays for the TCP
+    and TLS handshakes. Thread-safe; a connection is only ever used by one
+    request at a time.
+    """
+
+    def __init__(self, max_idle_per_host=4):
+        self.max_idle_per_host = max_idle_per_host
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def get(self, scheme, netloc, timeout=None):
+        """Get a connection to a host
+
+        Returns (conn, reused), where reused is True if the connection was
+        taken from the pool rather than newly created. Idle connections the
+        server has since closed are discarded.
+        """
+        while True:
+            with self.lock:
+                try:
+                    conn = self.idle[(scheme, netloc)].pop()
+                except (KeyError, IndexError):
+                    conn = None
+
+            if conn is None or not self.__is_dropped(conn):
+                break
+            conn.close()
+
+        if conn is not None:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            return (conn, True)
+
+        elif scheme == 'https':
+            return (http.client.HTTPSConnection(netloc, timeout=timeout), False)
+
+        elif scheme == 'http':
+            return (http.client.HTTPConnection(netloc, timeout=timeout), False)
+
+        else:
+            raise ValueError("Unsupported URL scheme %r" % scheme)
+
+    @staticmethod
+    def __is_dropped(conn):
+        """Determine if the server has closed an idle connection
+
+        An idle connection has nothing to read unless the server closed it,
+        or sent something it shouldn't have; either way it can't be used.
+        """
+        if conn.sock is None:
+            return True
+
+        try:
+            readable, writable, errored = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    def put(self, scheme, netloc, conn):
+        """Return a connection to the pool once a response has been fully read"""
+        with self.lock:
+            idle = self.idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append(conn)
+                return
+
+        conn.close()
+
+    def close(self):
+        """Close all idle connections"""
+        with self.lock:
+            idle, self.idle = self.idle, {}
+
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+default_connection_pool = ConnectionPool()
+
 class RemoteCalendar:
-    """Remote calendar server interface"""
+    """Remote calendar server interface
+
+    Requests are made over persistent connections from a ConnectionPool,
+    shared between all RemoteCalendar instances by default; requests that
+    would go through a proxy are made with urlopen() instead. If timeout is
+    set, socket operations that take longer than timeout seconds raise
+    URLError.
+    """
+
+    MAX_RESPONSE_SIZE = 10000
+    """Maximum size of a calendar response, in bytes"""
+
+    MAX_REDIRECTS = 10
+    """Maximum number of redirects followed for a single request, as with urlopen()"""
+
+    REDIRECT_STATUSES = (301, 302, 303, 307, 308)
 
-    def __init__(self, url, user_agent="python-opentimestamps"):
+    def __init__(self, url, user_agent="python-opentimestamps", pool=None, timeout=None):
         if not isinstance(url, str):
             raise TypeError("URL must be a string")
         self.url = url
 
+        parsed_url = urllib.parse.urlparse(url)
+        self.scheme = parsed_url.scheme
+        self.netloc = parsed_url.netloc
+        self.path = parsed_url.path.rstrip('/')
+
+        self.pool = pool if pool is not None else default_connection_pool
+        self.timeout = timeout
+
         self.request_headers = {"Accept": "application/vnd.opentimestamps.v1",
                                 "User-Agent": user_agent}
 
+    def __send(self, method, url, body, headers):
+        """Make a single request over a pooled connection
+
+        Redirects aren't followed. Network errors are raised as URLError.
+
+        If a reused connection turns out to have been closed by the server,
+        GET requests are retried on a new connection. Other requests aren't,
+        as the server may have acted on the request before the connection was
+        closed; retrying a POST to /digest could submit the digest twice.
+        """
+        parsed_url = urllib.parse.urlsplit(url)
+        target = parsed_url.path or '/'
+        if parsed_url.query:
+            target += '?' + parsed_url.query
+
+        while True:
+            conn, reused = self.pool.get(parsed_url.scheme, parsed_url.netloc, timeout=self.timeout)
+            try:
+                conn.request(method, target, body=body, headers=headers)
+                resp = conn.getresponse()
+
+                # Read the entire response - up to the size limit - so the
+                # connection can be reused.
+                resp_bytes = resp.read(self.MAX_RESPONSE_SIZE + 1)
+
+            except (http.client.HTTPException, OSError) as exp:
+                conn.close()
+
+                if (reused and method == 'GET' and
+                        isinstance(exp, (http.client.RemoteDisconnected, ConnectionError))):
+                    # The server closed an idle connection before we used
+                    # it; retry on a fresh connection.
+                    continue
+
+                raise urllib.error.URLError(exp)
+
+            if len(resp_bytes) > self.MAX_RESPONSE_SIZE or not resp.isclosed() or resp.will_close:
+                conn.close()
+            else:
+                self.pool.put(parsed_url.scheme, parsed_url.netloc, conn)
+
+            return (resp.status, resp.reason, resp.headers, resp_bytes)
+
+    def __urlopen(self, method, url, body, headers):
+        """Make a request with urlopen()
+
+        Used when the request has to go through a proxy, which the connection
+        pool doesn't support. urlopen() follows redirects itself.
+        """
+        req = urllib.request.Request(url, data=body, headers=headers, method=method)
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                return (resp.status, resp.reason, resp.headers, resp.read(self.MAX_RESPONSE_SIZE + 1))
+
+        except urllib.error.HTTPError as exp:
+            # Error responses are checked by the caller, as with __send()
+            with exp:
+                return (exp.code, exp.reason, exp.headers, exp.read(self.MAX_RESPONSE_SIZE + 1))
+
+        except urllib.error.URLError:
+            raise
+
+        except (http.client.HTTPException, OSError) as exp:
+            raise urllib.error.URLError(exp)
+
+    @staticmethod
+    def __is_proxied(url):
+        parsed_url = urllib.parse.urlsplit(url)
+        return (parsed_url.scheme in urllib.request.getproxies() and
+                not urllib.request.proxy_bypass(parsed_url.netloc))
+
+    def __request(self, method, path, body=None):
+        """Make a request, returning (status, reason, headers, body)
+
+        Redirects are followed as urlopen() follows them: up to MAX_REDIRECTS
+        of them, to http and https URLs only. A POST redirected by a 301, 302
+        or 303 is turned into a GET, and can't be redirected by a 307 or 308.
+
+        Requests that would go through a proxy are made with urlopen() instead.
+        Network errors are raised as urllib.error.URLError, as urlopen() would.
+        """
+        url = urllib.parse.urlunsplit((self.scheme, self.netloc, self.path + path, '', ''))
+
+        for i in range(self.MAX_REDIRECTS + 1):
+            headers = dict(self.request_headers)
+            if body is not None:
+                headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+            if self.__is_proxied(url):
+                return self.__urlopen(method, url, body, headers)
+
+            status, reason, resp_headers, resp_bytes = self.__send(method, url, body, headers)
+
+            location = resp_headers.get('Location')
+            if status not in self.REDIRECT_STATUSES or location is None:
+                return (status, reason, resp_headers, resp_bytes)
+
+            new_url = urllib.parse.urljoin(url, location)
+            if urllib.parse.urlsplit(new_url).scheme not in ('http', 'https'):
+                raise urllib.error.HTTPError(url, status, "Redirection to url %r is not allowed" % new_url,
+                                             resp_headers, io.BytesIO(resp_bytes))
+
+            if method == 'POST':
+                if status not in (301, 302, 303):
+                    raise urllib.error.HTTPError(url, status, "Can't redirect a POST with a %d" % status,
+                                                 resp_headers, io.BytesIO(resp_bytes))
+                method = 'GET'
+                body = None
+
+            url = new_url
+
+        raise urllib.error.HTTPError(url, status, "Too many redirects", resp_headers, io.BytesIO(resp_bytes))
+
+    def __check_response(self, status, reason, headers, resp_bytes):
+        if status != 200:
+            raise urllib.error.HTTPError(self.url, status, reason, headers, io.BytesIO(resp_bytes))
+
+        # FIXME: Not a particularly nice way of handling this, but it'll do
+        # the job for now.
+        elif len(resp_bytes) > self.MAX_RESPONSE_SIZE:
+            raise Exception("Calendar response exceeded size limit")
+
     def submit(self, digest):
         """Submit a digest to the calendar
 
         Returns a Timestamp committing to that digest
         """
-        req = urllib.request.Request(self.url + '/digest', data=digest, headers=self.request_headers)
-        with urllib.request.urlopen(req) as resp:
-            if resp.status != 200:
-                raise Exception("Unknown response from calendar: %d" % resp.status)
+        status, reason, headers, resp_bytes = self.__request('POST', '/digest', body=digest)
+        self.__check_response(status, reason, headers, resp_bytes)
 
-            # FIXME: Not a particularly nice way of handling this, but it'll do
-            # the job for now.
-            resp_bytes = resp.read(10000)
-            if len(resp_bytes) > 10000:
-                raise Exception("Calendar response exceeded size limit")
-
-            ctx = BytesDeserializationContext(resp_bytes)
-            return Timestamp.deserialize(ctx, digest)
+        ctx = BufferDeserializationContext(resp_bytes)
+        return Timestamp.deserialize(ctx, digest)
 
     def get_timestamp(self, commitment):
         """Get a timestamp for a given commitment
 
         Raises KeyError if the calendar doesn't have that commitment
         """
-        req = urllib.request.Request(self.url + '/timestamp/' + binascii.hexlify(commitment).decode('utf8'),
-                                     headers=self.request_headers)
-        try:
-            with urllib.request.urlopen(req) as resp:
-                if resp.status == 200:
+        status, reason, headers, resp_bytes = self.__request('GET', '/timestamp/' + binascii.hexlify(commitment).decode('utf8'))
 
-                    # FIXME: Not a particularly nice way of handling this, but it'll do
-                    # the job for now.
-                    resp_bytes = resp.read(10000)
-                    if len(resp_bytes) > 10000:
-                        raise Exception("Calendar response exceeded size limit")
+        if status == 404:
+            raise CommitmentNotFoundError(get_sanitised_resp_msg(io.BytesIO(resp_bytes)))
 
-                    ctx = BytesDeserializationContext(resp_bytes)
-                    return Timestamp.deserialize(ctx, commitment)
+        self.__check_response(status, reason, headers, resp_bytes)
 
-                else:
-                    raise Exception("Unknown response from calendar: %d" % resp.status)
-        except urllib.error.HTTPError as exp:
-            if exp.code == 404:
-                raise CommitmentNotFoundError(get_sanitised_resp_msg(exp))
-            else:
-                raise exp
+        ctx = BufferDeserializationContext(resp_bytes)
+        return Timestamp.deserialize(ctx, commitment)
 
 class UrlWhitelist(set):
     """Glob-matching whitelist for URL's"""
@@ -11,9 +11,14 @@
 
 import binascii
 import hashlib
+import io
+import struct
+
+import opentimestamps.core.serialize
 
 from opentimestamps.core.op import CryptOp
-from opentimestamps.core.serialize import StreamSerializationContext, StreamDeserializationContext
+from opentimestamps.core.serialize import StreamSerializationContext, StreamDeserializationContext, DeserializationError
+from opentimestamps.core.timestamp import Timestamp
 
 from opentimestamps.core.packetstream import PacketReader, PacketWriter, PacketMissingError
 
@@ -34,14 +39,105 @@ class TimestampLog:
     HEADER_MAGIC = b'\x00OpenTimestamps\x00\x00Log\x00\xd9\x19\xc5\x3a\x99\xb1\x12\xe9\xa6\xa1\x00'
 
 
+class TimestampLogIndex:
+    """Sidecar index of the entries in a timestamp log
+
+    For every entry in the log, records the length of the log file it
+    timestamps, and the offset of its packet in the timestamp log, as
+    fixed-size records. Finding an entry by number is then a single seek, and
+    by length a binary search, rather than reading the log from the start.
+
+    The index is derived entirely from the log, so unlike the log it isn't
+    append-only: a truncated record at the end is simply discarded, and an
+    index that doesn't match its log is rebuilt by TimestampLogReader.
+    """
+
+    HEADER_MAGIC = b'\x00OpenTimestamps\x00\x00LogIndex\x00\x5c\x8e\x1b\xa4\x03\x97\xd2\x61'
+
+    RECORD_FORMAT = '<QQ'
+    RECORD_LENGTH = struct.calcsize(RECORD_FORMAT)
+
+    def __init__(self, fd):
+        """Open an index, creating it if it's empty
+
+        fd must be both readable and writable. BadMagicError is raised if it
+        isn't empty, and isn't an index.
+        """
+        self.fd = fd
+
+        fd.seek(0, io.SEEK_END)
+        size = fd.tell()
+        if not size:
+            fd.write(self.HEADER_MAGIC)
+            fd.flush()
+
+        else:
+            fd.seek(0)
+            actual_magic = fd.read(len(self.HEADER_MAGIC))
+            if actual_magic != self.HEADER_MAGIC:
+                raise opentimestamps.core.serialize.BadMagicError(self.HEADER_MAGIC, actual_magic)
+
+            # Discard what's left of a truncated write
+            partial = (size - len(self.HEADER_MAGIC)) % self.RECORD_LENGTH
+            if partial:
+                fd.truncate(size - partial)
+
+    def __len__(self):
+        """Number of entries in the index"""
+        self.fd.seek(0, io.SEEK_END)
+        return (self.fd.tell() - len(self.HEADER_MAGIC)) // self.RECORD_LENGTH
+
+    def __getitem__(self, n):
+        """Get the (length, offset) of entry n"""
+        num_entries = len(self)
+        if n < 0:
+            n += num_entries
+        if not 0 <= n < num_entries:
+            raise IndexError("Log index entry out of range")
+
+        self.fd.seek(len(self.HEADER_MAGIC) + n * self.RECORD_LENGTH)
+        return struct.unpack(self.RECORD_FORMAT, self.fd.read(self.RECORD_LENGTH))
+
+    def append(self, length, offset):
+        """Add an entry to the end of the index"""
+        self.fd.seek(0, io.SEEK_END)
+        self.fd.write(struct.pack(self.RECORD_FORMAT, length, offset))
+        self.fd.flush()
+
+    def clear(self):
+        """Remove every entry from the index"""
+        self.fd.truncate(len(self.HEADER_MAGIC))
+        self.fd.flush()
+
+    def bisect(self, length):
+        """Count the entries for log lengths of at most length
+
+        As the log file is append-only, the lengths of later entries are never
+        smaller than those of earlier ones, so the count is found by binary
+        search; the last of those entries is the latest timestamp covering the
+        first length bytes of the log file.
+        """
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid][0] <= length:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
 class TimestampLogReader(TimestampLog):
 
     @classmethod
-    def open(cls, fd):
+    def open(cls, fd, index=None):
         """Open an existing timestamp log
 
         fd must be positioned at the start of the log; the header will be
         immediately read and DeserializationError raised if incorrect.
+
+        If index, a TimestampLogIndex, is given, it's brought up to date with
+        update_index().
         """
         ctx = StreamDeserializationContext(fd)
 
@@ -52,20 +148,33 @@ class TimestampLogReader(TimestampLog):
 
         file_hash_op = CryptOp.deserialize(ctx)
 
-        return cls(fd, file_hash_op)
+        reader = cls(fd, file_hash_op, index=index)
+        if index is not None:
+            reader.update_index()
+
+        return reader
 
 
-    def __init__(self, fd, file_hash_op):
+    def __init__(self, fd, file_hash_op, index=None):
         """Create a timestamp log reader instance
 
+        fd must be positioned at the first entry, just after the header.
+
         You probably want to use TimestampLogReader.open() instead.
         """
         self.fd = fd
         self.file_hash_op = file_hash_op
+        self.index = index
+        self.entries_offset = fd.tell()
 
-    def __iter__(self):
-        """Iterate through all timestamps in the timestamp log"""
+    def _read_entries(self):
+        """Read entries from the current position
+
+        Yields (offset, length, timestamp) for every entry; entries that can't
+        be deserialized are skipped.
+        """
         while True:
+            offset = self.fd.tell()
             try:
                 reader = PacketReader(self.fd)
             except PacketMissingError:
@@ -77,50 +186,139 @@ class TimestampLogReader(TimestampLog):
                 length = ctx.read_varuint()
                 file_hash = ctx.read_bytes(self.file_hash_op.DIGEST_LENGTH)
                 timestamp = Timestamp.deserialize(ctx, file_hash)
-                yield (length, timestamp)
             except DeserializationError as exp:
                 # FIXME: should provide a way to get insight into these errors
-                pass
+                timestamp = None
+
+            # Skip whatever's left of the packet, so the next read starts at
+            # the next packet.
+            reader.read()
+
+            if timestamp is not None:
+                yield (offset, length, timestamp)
+
+    def __iter__(self):
+        """Iterate through the timestamps in the timestamp log
+
+        Starts from the current position; that's the first entry unless seek()
+        has been called.
+
+        Yields (length, timestamp) tuples.
+        """
+        for offset, length, timestamp in self._read_entries():
+            yield (length, timestamp)
+
+    def update_index(self):
+        """Add the entries missing from the index
+
+        Entries appended since the index was last updated - say, by a writer
+        that wasn't given the index - are read and added; the rest of the log
+        isn't read. If the index doesn't match the log it's rebuilt.
+
+        The position in the log is left unchanged.
+        """
+        pos = self.fd.tell()
+
+        start = self.entries_offset
+        if len(self.index):
+            last_length, last_offset = self.index[-1]
+
+            self.fd.seek(last_offset)
+            for offset, length, timestamp in self._read_entries():
+                if (offset, length) == (last_offset, last_length):
+                    start = self.fd.tell()
+                else:
+                    self.index.clear()
+                break
+            else:
+                self.index.clear()
+
+        self.fd.seek(start)
+        for offset, length, timestamp in self._read_entries():
+            self.index.append(length, offset)
+
+        self.fd.seek(pos)
+
+    def seek(self, n):
+        """Move to entry n
+
+        Iteration then starts from that entry. Requires an index.
+        """
+        if self.index is None:
+            raise ValueError("Seeking requires an index")
+
+        length, offset = self.index[n]
+        self.fd.seek(offset)
+
+    def find(self, length):
+        """Find the latest timestamp covering at most length bytes of the log file
+
+        Returns (length, timestamp), or None if every timestamp is for more of
+        the log file than that. Requires an index; only the entry found is
+        read.
+        """
+        if self.index is None:
+            raise ValueError("Finding entries requires an index")
+
+        n = self.index.bisect(length)
+        if not n:
+            return None
+
+        self.seek(n - 1)
+        return next(iter(self), None)
 
 
 
 class TimestampLogWriter(TimestampLog):
 
     @classmethod
-    def open(cls, fd):
+    def open(cls, fd, index=None):
         """Open an existing timestamp log for writing
 
         fd must be both readable and writable, and must be positioned at the
         beginning of the timestamp log file. The header will be immediately
         read, with BadMagicError raised if it's incorrect.
+
+        If index, a TimestampLogIndex, is given, only the entries missing from
+        it are read, rather than the whole log; appended entries are added to
+        it.
         """
 
         # Use the log reader to read the header information
-        reader = TimestampLogReader.open(fd)
+        reader = TimestampLogReader.open(fd, index=index)
+
+        if index is not None:
+            # The reader brought the index up to date, so there's nothing left
+            # to read.
+            fd.seek(0, io.SEEK_END)
 
-        # Parse the entries to find the last one
-        for stamp in reader:
-            pass
+        else:
+            # Parse the entries to find the last one
+            for stamp in reader:
+                pass
 
         # FIXME: pad the end as necessary to deal with trucated writes
 
-        return cls(fd, reader.file_hash_op)
+        return cls(fd, reader.file_hash_op, index=index)
 
     @classmethod
-    def create(cls, fd, file_hash_op):
+    def create(cls, fd, file_hash_op, index=None):
         """Create a new timestamp log
 
-        Writes the header appropriately.
+        Writes the header appropriately. If index is given, it must be empty.
         """
+        if index is not None and len(index):
+            raise ValueError("Index of a new timestamp log must be empty")
+
         ctx = StreamSerializationContext(fd)
 
         ctx.write_bytes(cls.HEADER_MAGIC)
         file_hash_op.serialize(ctx)
 
-        return cls(fd, file_hash_op)
+        return cls(fd, file_hash_op, index=index)
 
 
-    def __init__(self, fd, file_hash_op):
+    def __init__(self, fd, file_hash_op, index=None):
         """Create a new timestamp log writer
 
         You probably want to use the open() or create() methods instead.
@@ -128,14 +326,21 @@ class TimestampLogWriter(TimestampLog):
 
         self.fd = fd
         self.file_hash_op = file_hash_op
+        self.index = index
 
     def append(self, length, timestamp):
         """Add a new timestamp to the log"""
         if len(timestamp.msg) != self.file_hash_op.DIGEST_LENGTH:
             raise ValueError("Timestamp msg length does not match expected digest length; %d != %d" % (len(timestamp.msg), self.file_hash_op.DIGEST_LENGTH))
 
+        offset = self.fd.tell()
         with PacketWriter(self.fd) as packet_fd:
             ctx = StreamSerializationContext(packet_fd)
             ctx.write_varuint(length)
             ctx.write_bytes(timestamp.msg)
             timestamp.serialize(ctx)
+
+        # Only once the entry has been written, so the index is never ahead of
+        # the log.
+        if self.index is not None:
+            self.index.append(length, offset)
@@ -32,7 +32,7 @@ class TimeAttestation:
     def serialize(self, ctx):
         ctx.write_bytes(self.TAG)
 
-        payload_ctx = opentimestamps.core.serialize.BytesSerializationContext()
+        payload_ctx = opentimestamps.core.serialize.BufferSerializationContext()
         self._serialize_payload(payload_ctx)
 
         ctx.write_varbytes(payload_ctx.getbytes())
@@ -69,7 +69,7 @@ class TimeAttestation:
 
         serialized_attestation = ctx.read_varbytes(cls.MAX_PAYLOAD_SIZE)
 
-        payload_ctx = opentimestamps.core.serialize.BytesDeserializationContext(serialized_attestation)
+        payload_ctx = opentimestamps.core.serialize.BufferDeserializationContext(serialized_attestation)
 
         if tag == PendingAttestation.TAG:
             r = PendingAttestation.deserialize(payload_ctx)
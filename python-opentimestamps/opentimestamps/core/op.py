@@ -10,7 +10,12 @@
 # in the LICENSE file.
 
 import binascii
+import errno
+import functools
 import hashlib
+import mmap
+import os
+import stat
 
 import opentimestamps.core.serialize
 
@@ -67,22 +72,30 @@ class Op(tuple):
     for them.
     """
 
+    # Op comparisons are done constantly, by OpSet lookups and by sorting ops
+    # for serialization, so they're written to avoid creating new tuples:
+    # tuple's own comparison methods are used directly.
+
     def __eq__(self, other):
-        if isinstance(other, Op):
-            return self.TAG == other.TAG and tuple(self) == tuple(other)
+        if self is other:
+            return True
+        elif isinstance(other, Op):
+            return self.TAG == other.TAG and tuple.__eq__(self, other)
         else:
             return NotImplemented
 
     def __ne__(self, other):
-        if isinstance(other, Op):
-            return self.TAG != other.TAG or tuple(self) != tuple(other)
+        if self is other:
+            return False
+        elif isinstance(other, Op):
+            return self.TAG != other.TAG or tuple.__ne__(self, other)
         else:
             return NotImplemented
 
     def __lt__(self, other):
         if isinstance(other, Op):
             if self.TAG == other.TAG:
-                return tuple(self) < tuple(other)
+                return tuple.__lt__(self, other)
             else:
                 return self.TAG < other.TAG
         else:
@@ -91,7 +104,7 @@ class Op(tuple):
     def __le__(self, other):
         if isinstance(other, Op):
             if self.TAG == other.TAG:
-                return tuple(self) <= tuple(other)
+                return tuple.__le__(self, other)
             else:
                 return self.TAG < other.TAG
         else:
@@ -100,15 +113,16 @@ class Op(tuple):
     def __gt__(self, other):
         if isinstance(other, Op):
             if self.TAG == other.TAG:
-                return tuple(self) > tuple(other)
+                return tuple.__gt__(self, other)
             else:
                 return self.TAG > other.TAG
         else:
             return NotImplemented
+
     def __ge__(self, other):
         if isinstance(other, Op):
             if self.TAG == other.TAG:
-                return tuple(self) >= tuple(other)
+                return tuple.__ge__(self, other)
             else:
                 return self.TAG > other.TAG
         else:
@@ -173,14 +187,38 @@ class Op(tuple):
         return cls.deserialize_from_tag(ctx, tag)
 
 class UnaryOp(Op):
-    """Operations that act on a single message"""
+    """Operations that act on a single message
+
+    Unary ops have no arguments, so every instance of a given op is the same;
+    they're interned, with only one instance of each created, and compared and
+    hashed by identity.
+    """
     SUBCLS_BY_TAG = {}
 
+    __instances = {}
+
     def __new__(cls):
-        return tuple.__new__(cls)
+        try:
+            return UnaryOp.__instances[cls]
+        except KeyError:
+            return UnaryOp.__instances.setdefault(cls, tuple.__new__(cls))
 
-    def serialize(self, ctx):
-        super().serialize(ctx)
+    def __getnewargs__(self):
+        return ()
+
+    def __eq__(self, other):
+        if isinstance(other, Op):
+            return self is other
+        else:
+            return NotImplemented
+
+    def __ne__(self, other):
+        if isinstance(other, Op):
+            return self is not other
+        else:
+            return NotImplemented
+
+    __hash__ = object.__hash__
 
     @classmethod
     def deserialize_from_tag(cls, ctx, tag):
@@ -202,6 +240,14 @@ class BinaryOp(Op):
             raise OpArgValueError("%s arg too long: %d > %d" % (cls.__name__, len(arg), cls.MAX_RESULT_LENGTH))
         return tuple.__new__(cls, (arg,))
 
+    def __getnewargs__(self):
+        return (self[0],)
+
+    # Hashed as the tuple of the argument, which is cheap as bytes caches its
+    # own hash. OpAppend and OpPrepend with the same argument hash the same,
+    # and are told apart by __eq__().
+    __hash__ = tuple.__hash__
+
     def __repr__(self):
         return '%s(%r)' % (self.__class__.__name__, self[0])
 
@@ -276,6 +322,25 @@ class OpHexlify(UnaryOp):
         return binascii.hexlify(msg)
 
 
+_HASHLIB_CONSTRUCTORS = {}
+
+def _hashlib_constructor(name):
+    """Get the hashlib constructor for an algorithm, with caching
+
+    The named constructors, such as hashlib.sha256, are used where available,
+    as they're faster than hashlib.new()
+    """
+    try:
+        return _HASHLIB_CONSTRUCTORS[name]
+    except KeyError:
+        try:
+            constructor = getattr(hashlib, name)
+        except AttributeError:
+            constructor = functools.partial(hashlib.new, name)
+
+        _HASHLIB_CONSTRUCTORS[name] = constructor
+        return constructor
+
 class CryptOp(UnaryOp):
     """Cryptographic transformations
 
@@ -288,19 +353,115 @@ class CryptOp(UnaryOp):
 
     DIGEST_LENGTH = None
 
+    HASH_MANY_CHUNK_SIZE = 2**12
+    """Batches are split into chunks of this many messages by hash_many()"""
+
     def _do_op_call(self, msg):
-        r = hashlib.new(self.HASHLIB_NAME, bytes(msg)).digest()
+        r = _hashlib_constructor(self.HASHLIB_NAME)(msg).digest()
         assert len(r) == self.DIGEST_LENGTH
         return r
 
-    def hash_fd(self, fd):
+    @classmethod
+    def hash_many(cls, msgs, executor=None):
+        """Hash many messages at once
+
+        Returns a list of the digests of msgs, in order; the same as applying
+        the operation to every message, without the overhead of doing so one
+        message at a time. Messages can be any bytes-like objects, and aren't
+        copied. As with applying the operation, messages longer than
+        MAX_MSG_LENGTH raise MsgValueError.
+
+        If executor is given, batches of more than HASH_MANY_CHUNK_SIZE
+        messages are split into chunks, hashed by the executor in parallel.
+        hashlib only releases the GIL while hashing messages of more than a
+        couple of kilobytes, so for short messages the executor should be a
+        ProcessPoolExecutor, and the messages picklable.
+        """
+        msgs = list(msgs)
+
+        if executor is not None and len(msgs) > cls.HASH_MANY_CHUNK_SIZE:
+            chunks = [msgs[i:i + cls.HASH_MANY_CHUNK_SIZE] for i in range(0, len(msgs), cls.HASH_MANY_CHUNK_SIZE)]
+            return [digest for chunk_digests in executor.map(cls.hash_many, chunks)
+                           for digest in chunk_digests]
+
+        if msgs and max(map(len, msgs)) > cls.MAX_MSG_LENGTH:
+            raise MsgValueError("Message too long; %d > %d" % (max(map(len, msgs)), cls.MAX_MSG_LENGTH))
+
+        new = _hashlib_constructor(cls.HASHLIB_NAME)
+        return [new(msg).digest() for msg in msgs]
+
+    def hash_fd(self, fd, chunk_size=2**20, use_mmap=False):
+        """Hash the contents of a file, from the current position to the end
+
+        The file is read in chunk_size chunks, into a reusable buffer if it
+        supports readinto(). Raises BlockingIOError if fd is non-blocking and
+        has no data available, rather than mistaking that for the end of the
+        file.
+
+        If use_mmap is true, regular files are instead memory-mapped, and
+        hashed without copying their contents. Only do that for files that
+        can't be truncated while they're being hashed: accessing the part of a
+        mapping past the end of a truncated file raises SIGBUS, killing the
+        process.
+
+        On return the file position is at the end of the file.
+        """
         hasher = hashlib.new(self.HASHLIB_NAME)
-        while True:
-            chunk = fd.read(2**20) # 1MB chunks
-            if chunk:
-                hasher.update(chunk)
-            else:
-                break
+
+        fileno = None
+        if use_mmap:
+            try:
+                fileno = fd.fileno()
+            except (AttributeError, OSError):
+                # Not backed by a file descriptor, e.g. io.BytesIO
+                pass
+
+        if fileno is not None and stat.S_ISREG(os.fstat(fileno).st_mode):
+            # Note how tell() takes buffering into account, so the position
+            # is correct even if the caller has already read from fd.
+            pos = fd.tell()
+            size = os.fstat(fileno).st_size
+
+            if size > pos:
+                try:
+                    mapped = mmap.mmap(fileno, size, access=mmap.ACCESS_READ)
+                except (OSError, ValueError):
+                    # Some filesystems don't support mmap, and some files
+                    # claim to be regular yet can't be mapped; fall back to
+                    # reading.
+                    mapped = None
+
+                if mapped is not None:
+                    with mapped:
+                        with memoryview(mapped) as view:
+                            for i in range(pos, size, chunk_size):
+                                hasher.update(view[i:i+chunk_size])
+
+                    fd.seek(size)
+
+                    # The file may have grown while we were hashing it;
+                    # anything past the mapping is read normally.
+
+        if hasattr(fd, 'readinto'):
+            buf = bytearray(chunk_size)
+            with memoryview(buf) as view:
+                while True:
+                    n = fd.readinto(buf)
+                    if n is None:
+                        raise BlockingIOError(errno.EAGAIN, "File is non-blocking; no data available")
+                    elif not n:
+                        break
+                    hasher.update(view[:n])
+
+        else:
+            while True:
+                chunk = fd.read(chunk_size)
+                if chunk is None:
+                    raise BlockingIOError(errno.EAGAIN, "File is non-blocking; no data available")
+                elif chunk:
+                    hasher.update(chunk)
+                else:
+                    break
 
         return hasher.digest()
 
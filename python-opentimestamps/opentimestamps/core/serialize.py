@@ -125,6 +125,22 @@ class DeserializationContext:
         """
         raise NotImplementedError
 
+def encode_varuint(value):
+    """Encode a variable-length unsigned integer
+
+    Returns bytes, in unsigned little-endian base128 format (LEB128).
+    """
+    if value < 0b10000000:
+        # By far the most common case
+        return bytes((value,))
+
+    r = bytearray()
+    while value > 0b01111111:
+        r.append((value & 0b01111111) | 0b10000000)
+        value >>= 7
+    r.append(value)
+    return bytes(r)
+
 class StreamSerializationContext(SerializationContext):
     def __init__(self, fd):
         """Serialize to a stream"""
@@ -141,19 +157,7 @@ class StreamSerializationContext(SerializationContext):
             raise TypeError('Expected bool; got %r' % value.__class__)
 
     def write_varuint(self, value):
-        # unsigned little-endian base128 format (LEB128)
-        if value == 0:
-            self.fd.write(b'\x00')
-
-        else:
-            while value != 0:
-                b = value & 0b01111111
-                if value > 0b01111111:
-                    b |= 0b10000000
-                self.fd.write(bytes([b]))
-                if value <= 0b01111111:
-                    break
-                value >>= 7
+        self.fd.write(encode_varuint(value))
 
     def write_bytes(self, value):
         self.fd.write(value)
@@ -231,9 +235,144 @@ class BytesSerializationContext(StreamSerializationContext):
         """Return the bytes serialized to date"""
         return self.fd.getvalue()
 
+class BufferSerializationContext(SerializationContext):
+    def __init__(self):
+        """Serialize to a bytearray
+
+        Everything is appended to a single bytearray, so there's no per-write
+        stream overhead; use getbytes() to get the result.
+        """
+        self.buf = bytearray()
+
+    def write_bool(self, value):
+        if value is True:
+            self.buf.append(0xff)
+
+        elif value is False:
+            self.buf.append(0x00)
+
+        else:
+            raise TypeError('Expected bool; got %r' % value.__class__)
+
+    def write_varuint(self, value):
+        if 0 <= value < 0b10000000:
+            self.buf.append(value)
+        else:
+            self.buf += encode_varuint(value)
+
+    def write_bytes(self, value):
+        self.buf += value
+
+    def write_varbytes(self, value):
+        self.write_varuint(len(value))
+        self.buf += value
+
+    def getbytes(self):
+        """Return the bytes serialized to date"""
+        return bytes(self.buf)
+
 class BytesDeserializationContext(StreamDeserializationContext):
     def __init__(self, buf):
         """Deserialize from bytes"""
         super().__init__(io.BytesIO(buf))
 
     # FIXME: need to check that there isn't extra crap at end of object
+
+class BufferDeserializationContext(DeserializationContext):
+    def __init__(self, buf):
+        """Deserialize from a buffer
+
+        buf can be bytes, or anything else supporting the buffer protocol,
+        such as a memoryview or an mmap. Parsing is done in place, with an
+        integer cursor, rather than with a read call per field; other than
+        bytes objects, buffers aren't copied, only the values actually
+        returned by read_bytes() and read_varbytes().
+
+        The buffer is referenced until the context is deleted, which matters
+        for mmaps: they can't be closed while exported.
+        """
+        if isinstance(buf, bytes):
+            # Slicing bytes directly is cheaper than slicing a memoryview and
+            # converting the result.
+            self.buf = buf
+        else:
+            self.buf = memoryview(buf).cast('B')
+        self.pos = 0
+
+    def __truncated(self, l):
+        return TruncationError('Tried to read %d bytes but got only %d bytes' % \
+                               (l, max(0, len(self.buf) - self.pos)))
+
+    def read_bool(self):
+        b = self.read_bytes(1)[0]
+        if b == 0xff:
+            return True
+
+        elif b == 0x00:
+            return False
+
+        else:
+            raise DeserializationError('read_bool() expected 0xff or 0x00; got %d' % b)
+
+    def read_varuint(self):
+        # unsigned little-endian base128 format (LEB128)
+        buf = self.buf
+        pos = self.pos
+        value = 0
+        shift = 0
+
+        while True:
+            try:
+                b = buf[pos]
+            except IndexError:
+                raise self.__truncated(1)
+            pos += 1
+            value |= (b & 0b01111111) << shift
+            if not (b & 0b10000000):
+                break
+            shift += 7
+
+        self.pos = pos
+        return value
+
+    def read_bytes(self, expected_length=None):
+        if expected_length is None:
+            expected_length = self.read_varuint()
+
+        # Performance critical, hence the duplication with read_varbytes()
+        pos = self.pos
+        r = self.buf[pos:pos + expected_length]
+        if len(r) != expected_length:
+            raise self.__truncated(expected_length)
+        self.pos = pos + expected_length
+
+        if r.__class__ is not bytes:
+            r = r.tobytes()
+        return r
+
+    def read_varbytes(self, max_len, min_len=0):
+        l = self.read_varuint()
+        if l > max_len:
+            raise DeserializationError('varbytes max length exceeded; %d > %d' % (l, max_len))
+        if l < min_len:
+            raise DeserializationError('varbytes min length not met; %d < %d' % (l, min_len))
+
+        pos = self.pos
+        r = self.buf[pos:pos + l]
+        if len(r) != l:
+            raise self.__truncated(l)
+        self.pos = pos + l
+
+        if r.__class__ is not bytes:
+            r = r.tobytes()
+        return r
+
+    def assert_magic(self, expected_magic):
+        actual_magic = self.buf[self.pos:self.pos + len(expected_magic)]
+        if expected_magic != actual_magic:
+            raise BadMagicError(expected_magic, bytes(actual_magic))
+        self.pos += len(expected_magic)
+
+    def assert_eof(self):
+        if self.pos < len(self.buf):
+            raise TrailingGarbageError("Trailing garbage found after end of deserialized data")
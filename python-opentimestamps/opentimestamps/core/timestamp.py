@@ -11,17 +11,44 @@
 
 import binascii
 import hashlib
+import weakref
 
-from opentimestamps.core.op import Op, UnaryOp, CryptOp, OpSHA256, OpAppend, OpPrepend, MsgValueError
-from opentimestamps.core.notary import TimeAttestation
+from opentimestamps.core.op import Op, UnaryOp, BinaryOp, CryptOp, OpSHA256, OpAppend, OpPrepend, MsgValueError
+from opentimestamps.core.notary import TimeAttestation, UnknownAttestation
 
 import opentimestamps.core.serialize
 
+def _path_ops(path):
+    """Convert a path to a tuple of ops
+
+    When walking trees, paths are kept as linked lists of (parent path, op)
+    tuples, with None for the root, so that they only need to be turned into
+    tuples for the few timestamps that need them.
+    """
+    ops = []
+    while path is not None:
+        path, op = path
+        ops.append(op)
+    return tuple(reversed(ops))
+
+
 class OpSet(dict):
-    """Set of operations"""
-    __slots__ = ['__make_timestamp']
-    def __init__(self, make_timestamp_func):
+    """Set of operations
+
+    If the set belongs to a timestamp, that timestamp is notified of every
+    change, so it can forget its memoized serialization, and update any
+    TimestampIndex it's part of.
+    """
+    __slots__ = ['__make_timestamp', '__owner_ref']
+    def __init__(self, make_timestamp_func, owner_ref=None):
         self.__make_timestamp = make_timestamp_func
+        self.__owner_ref = owner_ref
+
+    def __modified(self, added=None, removed=None):
+        if self.__owner_ref is not None:
+            owner = self.__owner_ref()
+            if owner is not None:
+                owner._modified(added, removed)
 
     def add(self, key):
         """Add key
@@ -36,16 +63,152 @@ class OpSet(dict):
             return value
 
     def __setitem__(self, op, new_timestamp):
+        owner_ref = self.__owner_ref
+        existing_timestamp = self.get(op)
+        if existing_timestamp is None:
+            dict.__setitem__(self, op, new_timestamp)
+
+        else:
+            if existing_timestamp is new_timestamp:
+                return
+
+            if existing_timestamp.msg != new_timestamp.msg:
+                raise ValueError("Can't change existing result timestamp: timestamps are for different messages")
+
+            dict.__setitem__(self, op, new_timestamp)
+
+            if owner_ref is not None:
+                existing_timestamp._remove_parent(owner_ref)
+
+        if owner_ref is not None:
+            new_timestamp._add_parent(owner_ref)
+        self.__modified(new_timestamp, existing_timestamp)
+
+    def __delitem__(self, op):
+        existing_timestamp = self[op]
+        dict.__delitem__(self, op)
+
+        if self.__owner_ref is not None:
+            existing_timestamp._remove_parent(self.__owner_ref)
+        self.__modified(removed=existing_timestamp)
+
+    def pop(self, op, *default):
         try:
             existing_timestamp = self[op]
         except KeyError:
-            dict.__setitem__(self, op, new_timestamp)
-            return
+            if default:
+                return default[0]
+            raise
+
+        del self[op]
+        return existing_timestamp
+
+    def popitem(self):
+        for op in reversed(self):
+            return (op, self.pop(op))
+        raise KeyError('popitem(): OpSet is empty')
+
+    def clear(self):
+        for op in tuple(self):
+            del self[op]
+
+    def setdefault(self, op, default):
+        try:
+            return self[op]
+        except KeyError:
+            self[op] = default
+            return default
+
+    def update(self, *args, **kwargs):
+        for op, timestamp in dict(*args, **kwargs).items():
+            self[op] = timestamp
+
+
+class AttestationSet(set):
+    """Set of attestations
+
+    As with OpSet, the timestamp the set belongs to is notified of every
+    change.
+    """
+    __slots__ = ['__owner_ref']
+    def __init__(self, owner_ref=None):
+        self.__owner_ref = owner_ref
+
+    def __modified(self):
+        if self.__owner_ref is not None:
+            owner = self.__owner_ref()
+            if owner is not None:
+                owner._modified()
+
+    def add(self, attestation):
+        if attestation not in self:
+            set.add(self, attestation)
+            self.__modified()
+
+    def remove(self, attestation):
+        set.remove(self, attestation)
+        self.__modified()
+
+    def discard(self, attestation):
+        if attestation in self:
+            self.remove(attestation)
+
+    def pop(self):
+        attestation = set.pop(self)
+        self.__modified()
+        return attestation
+
+    def clear(self):
+        if self:
+            set.clear(self)
+            self.__modified()
+
+    def update(self, *others):
+        old_len = len(self)
+        set.update(self, *others)
+        if len(self) != old_len:
+            self.__modified()
+
+    def difference_update(self, *others):
+        old_len = len(self)
+        set.difference_update(self, *others)
+        if len(self) != old_len:
+            self.__modified()
+
+    def intersection_update(self, *others):
+        old_len = len(self)
+        set.intersection_update(self, *others)
+        if len(self) != old_len:
+            self.__modified()
+
+    def symmetric_difference_update(self, other):
+        set.symmetric_difference_update(self, other)
+        self.__modified()
+
+    def __ior__(self, other):
+        if not isinstance(other, (set, frozenset)):
+            return NotImplemented
+        self.update(other)
+        return self
+
+    def __iand__(self, other):
+        if not isinstance(other, (set, frozenset)):
+            return NotImplemented
+        self.intersection_update(other)
+        return self
+
+    def __isub__(self, other):
+        if not isinstance(other, (set, frozenset)):
+            return NotImplemented
+        self.difference_update(other)
+        return self
 
-        if existing_timestamp.msg != new_timestamp.msg:
-            raise ValueError("Can't change existing result timestamp: timestamps are for different messages")
+    def __ixor__(self, other):
+        if not isinstance(other, (set, frozenset)):
+            return NotImplemented
+        self.symmetric_difference_update(other)
+        return self
 
-        dict.__setitem__(self, op, new_timestamp)
 
 class Timestamp:
     """Proof that one or more attestations commit to a message
@@ -54,12 +217,23 @@ class Timestamp:
     edges being operations acting on those messages. The leafs of the tree are
     attestations that attest to the time that messages in the tree existed prior.
     """
-    __slots__ = ['__msg', 'attestations', 'ops']
+    __slots__ = ['__msg', '__attestations', 'ops', '__ref', '__parents', '__serialized', '__indexes', '__weakref__']
 
     @property
     def msg(self):
         return self.__msg
 
+    @property
+    def attestations(self):
+        return self.__attestations
+
+    @attestations.setter
+    def attestations(self, attestations):
+        new_attestations = AttestationSet(self.__ref)
+        set.update(new_attestations, attestations)
+        self.__attestations = new_attestations
+        self._modified()
+
     def __init__(self, msg):
         if not isinstance(msg, bytes):
             raise TypeError("Expected msg to be bytes; got %r" % msg.__class__)
@@ -68,66 +242,333 @@ class Timestamp:
             raise ValueError("Message exceeds Op length limit; %d > %d" % (len(msg), Op.MAX_MSG_LENGTH))
 
         self.__msg = bytes(msg)
-        self.attestations = set()
-        self.ops = OpSet(lambda op: Timestamp(op(msg)))
+        self._init_state(lambda op: Timestamp(op(msg)))
 
-    def __eq__(self, other):
-        if isinstance(other, Timestamp):
-            return self.__msg == other.__msg and self.ops == other.ops
+    def _init_state(self, make_timestamp_func):
+        """Initialize everything but the message
+
+        For subclasses; make_timestamp_func is used by the OpSet to create
+        result timestamps.
+        """
+        self.__ref = weakref.ref(self)
+        self.__parents = None
+        self.__serialized = None
+        self.__indexes = None
+        self.__attestations = AttestationSet(self.__ref)
+        self.ops = OpSet(make_timestamp_func, self.__ref)
+
+    def _add_parent(self, parent_ref):
+        """Record that this timestamp is the result of an op of another"""
+        # Almost every timestamp has a single parent, so that's stored as-is,
+        # rather than in a list of its own.
+        parents = self.__parents
+        if parents is None:
+            self.__parents = parent_ref
+            return
+
+        elif not isinstance(parents, list):
+            self.__parents = [parents, parent_ref]
+            return
+
+        # A timestamp can be shared by many short-lived parents, such as the
+        # tip of a MerkleTree; forget the ones that are gone every time the
+        # number of parents doubles.
+        if len(parents) >= 8 and not len(parents) & (len(parents) - 1):
+            parents[:] = [ref for ref in parents if ref() is not None]
+        parents.append(parent_ref)
+
+    def _remove_parent(self, parent_ref):
+        parents = self.__parents
+        if parents is parent_ref:
+            self.__parents = None
+
+        elif isinstance(parents, list):
+            for i, ref in enumerate(parents):
+                if ref is parent_ref:
+                    del parents[i]
+                    break
+
+    def _iter_parents(self):
+        parents = self.__parents
+        if parents is None:
+            return ()
+        elif isinstance(parents, list):
+            return parents
+        else:
+            return (parents,)
+
+    def _add_index(self, index_ref):
+        """Record that this timestamp is part of a TimestampIndex"""
+        if self.__indexes is None:
+            self.__indexes = [index_ref]
         else:
+            # Indexes are only weakly referenced; forget the ones that are gone
+            self.__indexes[:] = [ref for ref in self.__indexes if ref() is not None]
+            self.__indexes.append(index_ref)
+
+    def _remove_index(self, index_ref):
+        for i, ref in enumerate(self.__indexes or ()):
+            if ref is index_ref:
+                del self.__indexes[i]
+                break
+        if not self.__indexes:
+            self.__indexes = None
+
+    def _modified(self, added=None, removed=None):
+        """Called on every change to the ops or attestations of this timestamp
+
+        added and removed are the result timestamps added to, or removed from,
+        the ops, if any.
+        """
+        if self.__serialized is not None:
+            self._invalidate()
+
+        if self.__indexes is not None:
+            for ref in tuple(self.__indexes):
+                index = ref()
+                if index is not None:
+                    index._update(self, added, removed)
+                else:
+                    self._remove_index(ref)
+
+    def _invalidate(self):
+        """Forget the memoized serialization of this timestamp
+
+        Along with those of every timestamp that leads to it. Timestamps are
+        only ever memoized along with everything they lead to, so there's no
+        need to go further up than the first one that isn't memoized.
+        """
+        if self.__serialized is None:
+            return
+
+        stack = [self]
+        while stack:
+            stamp = stack.pop()
+            if stamp.__serialized is not None:
+                stamp.__serialized = None
+                for ref in stamp._iter_parents():
+                    parent = ref()
+                    if parent is not None:
+                        stack.append(parent)
+
+    def __eq__(self, other):
+        if not isinstance(other, Timestamp):
             return False
 
+        # Equivalent to comparing msg and ops, but iterative, so there's no
+        # limit on the depth of timestamp that can be compared.
+        stack = [(self, other)]
+        while stack:
+            stamp, other_stamp = stack.pop()
+            if stamp is other_stamp:
+                continue
+
+            if stamp.msg != other_stamp.msg or stamp.ops.keys() != other_stamp.ops.keys():
+                return False
+
+            for op, op_stamp in stamp.ops.items():
+                stack.append((op_stamp, other_stamp.ops[op]))
+
+        return True
+
     def __repr__(self):
-        return 'Timestamp(<%s>)' % binascii.hexlify(self.__msg).decode('utf8')
+        return 'Timestamp(<%s>)' % binascii.hexlify(self.msg).decode('utf8')
 
     def merge(self, other):
         """Add all operations and attestations from another timestamp to this one
 
+        Returns the attestations that were new to this timestamp, as a list
+        of (ops, attestation) tuples, as all_attestation_paths() does; after
+        an upgrade that's all the caller needs to look at, rather than the
+        attestations of the whole tree.
+
+        The trees are walked iteratively, so there's no limit on the depth of
+        timestamp that can be merged.
+
         Raises ValueError if the other timestamp isn't for the same message
         """
         if not isinstance(other, Timestamp):
             raise TypeError("Can only merge Timestamps together")
 
-        if self.__msg != other.__msg:
+        if self.msg != other.msg:
             raise ValueError("Can't merge timestamps for different messages together")
 
-        self.attestations.update(other.attestations)
+        new_attestations = []
+        stack = [(None, self, other)]
+        while stack:
+            path, stamp, other_stamp = stack.pop()
+            if stamp is other_stamp:
+                # Nothing to add, e.g. merging a timestamp into itself
+                continue
 
-        for other_op, other_op_stamp in other.ops.items():
-            our_op_stamp = self.ops.add(other_op)
-            our_op_stamp.merge(other_op_stamp)
+            if not other_stamp.attestations <= stamp.attestations:
+                ops = _path_ops(path)
+                for attestation in other_stamp.attestations - stamp.attestations:
+                    new_attestations.append((ops, attestation))
+                stamp.attestations.update(other_stamp.attestations)
 
-    def serialize(self, ctx):
-        if not len(self.attestations) and not len(self.ops):
-            raise ValueError("An empty timestamp can't be serialized")
+            for other_op, other_op_stamp in other_stamp.ops.items():
+                stack.append(((path, other_op), stamp.ops.add(other_op), other_op_stamp))
 
-        sorted_attestations = sorted(self.attestations)
-        if len(sorted_attestations) > 1:
-            for attestation in sorted_attestations[0:-1]:
-                ctx.write_bytes(b'\xff\x00')
-                attestation.serialize(ctx)
+        return new_attestations
+
+    def prune(self, keep):
+        """Remove everything that doesn't lead to the attestations in keep
+
+        Every path from this timestamp to an attestation in keep is kept;
+        every other attestation is removed, along with every operation that
+        no longer leads to an attestation. For instance, once a timestamp is
+        complete, pruning it down to a single Bitcoin attestation drops the
+        calendar paths to pending attestations that verification doesn't need.
+
+        Returns the attestations that were removed, as a list of (ops,
+        attestation) tuples, as merge() does for those it adds.
+        """
+        keep = set(keep)
+
+        removed = []
+        leads_to_kept = {} # by id() of every timestamp pruned
+        stack = [(None, self, False)]
+        while stack:
+            path, stamp, results_pruned = stack.pop()
+            if id(stamp) in leads_to_kept:
+                # Reached again through another path
+                continue
+
+            if not results_pruned:
+                # Results are pruned before the timestamps they're results of,
+                # so that we know which ops lead anywhere.
+                stack.append((path, stamp, True))
+                for op, result in stamp.ops.items():
+                    stack.append(((path, op), result, False))
+                continue
+
+            unkept = [attestation for attestation in stamp.attestations if attestation not in keep]
+            if unkept:
+                ops = _path_ops(path)
+                for attestation in unkept:
+                    removed.append((ops, attestation))
+                stamp.attestations.difference_update(unkept)
+
+            for op, result in tuple(stamp.ops.items()):
+                if not leads_to_kept[id(result)]:
+                    del stamp.ops[op]
+
+            leads_to_kept[id(stamp)] = bool(stamp.attestations or stamp.ops)
+
+        return removed
+
+    def serialize(self, ctx, memoize=False):
+        """Serialize
+
+        The tree is walked iteratively, with an explicit stack, so there's no
+        limit on the depth of timestamp that can be serialized.
+
+        If memoize is true, the serialization of every timestamp in the tree
+        is memoized until it, or anything it leads to, is modified.
+        Serializing again after a small change - say, an upgrade - only
+        encodes the timestamps on the path to the change; everything else is
+        copied as-is. The memoized serializations keep a copy of the whole
+        serialization alive for as long as any of them is, so only memoize
+        timestamps that are going to be serialized again.
+
+        Serializations that are already memoized are used either way.
+        """
+        if self.__serialized is not None:
+            ctx.write_bytes(self.__serialized)
+            return
+
+        buf_ctx = opentimestamps.core.serialize.BufferSerializationContext()
+        buf = buf_ctx.buf
 
-        if len(self.ops) == 0:
-            ctx.write_bytes(b'\x00')
-            sorted_attestations[-1].serialize(ctx)
+        # (timestamp, start, end) of every timestamp encoded below.
+        spans = []
 
-        elif len(self.ops) > 0:
-            if len(sorted_attestations) > 0:
-                ctx.write_bytes(b'\xff\x00')
-                sorted_attestations[-1].serialize(ctx)
+        # Timestamps still to be serialized, along with the op leading to
+        # them, and whether or not that op needs a \xff prefix. Entries with
+        # a start position instead mark where a timestamp with ops ends.
+        stack = [(False, None, self, None)]
+        while stack:
+            prefix, op, stamp, start = stack.pop()
+            if start is not None:
+                spans.append((stamp, start, len(buf)))
+                continue
 
-            sorted_ops = sorted(self.ops.items(), key=lambda item: item[0])
-            for op, stamp in sorted_ops[0:-1]:
-                ctx.write_bytes(b'\xff')
-                op.serialize(ctx)
-                stamp.serialize(ctx)
+            if prefix:
+                buf_ctx.write_bytes(b'\xff')
+            if op is not None:
+                op.serialize(buf_ctx)
 
-            last_op, last_stamp = sorted_ops[-1]
-            last_op.serialize(ctx)
-            last_stamp.serialize(ctx)
+            if stamp.__serialized is not None:
+                buf_ctx.write_bytes(stamp.__serialized)
+                continue
+
+            start = len(buf) if memoize else None
+
+            attestations = stamp.attestations
+            ops = stamp.ops
+            if not attestations and not ops:
+                raise ValueError("An empty timestamp can't be serialized")
+
+            if len(attestations) <= 1:
+                sorted_attestations = tuple(attestations)
+            else:
+                sorted_attestations = sorted(attestations)
+
+            for attestation in sorted_attestations[0:-1]:
+                buf_ctx.write_bytes(b'\xff\x00')
+                attestation.serialize(buf_ctx)
+
+            if not ops:
+                buf_ctx.write_bytes(b'\x00')
+                sorted_attestations[-1].serialize(buf_ctx)
+                if memoize:
+                    spans.append((stamp, start, len(buf)))
+
+            else:
+                if sorted_attestations:
+                    buf_ctx.write_bytes(b'\xff\x00')
+                    sorted_attestations[-1].serialize(buf_ctx)
+
+                if memoize:
+                    stack.append((None, None, stamp, start))
+
+                # Pushed in reverse order, so the first op is serialized
+                # first; all but the last are prefixed with \xff.
+                if len(ops) == 1:
+                    sorted_ops = tuple(ops.items())
+                else:
+                    sorted_ops = sorted(ops.items(), key=lambda item: item[0])
+
+                last_op, last_stamp = sorted_ops[-1]
+                stack.append((False, last_op, last_stamp, None))
+                for op, op_stamp in reversed(sorted_ops[0:-1]):
+                    stack.append((True, op, op_stamp, None))
+
+        # Only memoized once everything has been serialized successfully;
+        # the memoized serializations all share the one buffer.
+        serialized = buf_ctx.getbytes()
+        if spans:
+            serialized_view = memoryview(serialized)
+            for stamp, start, end in spans:
+                stamp.__serialized = serialized_view[start:end]
+
+        ctx.write_bytes(serialized)
+
+    def serialized_size(self):
+        """Length of the serialized timestamp, in bytes
+
+        Free if the serialization is memoized; see serialize().
+        """
+        if self.__serialized is not None:
+            return len(self.__serialized)
+
+        ctx = opentimestamps.core.serialize.BufferSerializationContext()
+        self.serialize(ctx)
+        return len(ctx.getbytes())
 
     @classmethod
-    def deserialize(cls, ctx, initial_msg, _recursion_limit=256):
+    def deserialize(cls, ctx, initial_msg, recursion_limit=256, lazy=False, memoize=False):
         """Deserialize
 
         Because the serialization format doesn't include the message that the
@@ -137,78 +578,527 @@ class Timestamp:
         The message you provide is assumed to be correct; if it causes a op to
         raise MsgValueError when the results are being calculated (done
         immediately, not lazily) DeserializationError is raised instead.
+
+        Timestamps nested more than recursion_limit operations deep raise
+        RecursionLimitError. The tree is parsed iteratively, with an explicit
+        stack, so the limit isn't bound by Python's own recursion limit.
+
+        If lazy is True, the results of operations are only calculated when
+        their msg is first accessed; see LazyTimestamp. The attestations, and
+        the operations leading to them, can be inspected without calculating
+        anything.
+
+        If memoize is True, and ctx is a BufferDeserializationContext over
+        bytes, the serializations of the timestamps are memoized, so
+        serializing them again, or after a small change, is cheap; see
+        serialize(). That is only done for timestamps that are serialized
+        exactly the way serialize() would do it. Checking that makes
+        deserialization slower, so only ask for it if the timestamp is going
+        to be serialized again.
         """
 
-        # FIXME: The recursion limit is arguably a bit of a hack given that
-        # it's relatively easily avoided with a different implementation. On
-        # the other hand, it has the advantage of being a very simple
-        # solution to the problem, and the limit isn't likely to be reached by
-        # nearly all timestamps anyway.
-        #
         # FIXME: Corresponding code to detect this condition is missing from
         # the serialization/__init__() code.
-        if not _recursion_limit:
+        if not recursion_limit:
             raise opentimestamps.core.serialize.RecursionLimitError("Reached timestamp recursion depth limit while deserializing")
 
-        # FIXME: note how a lazy implementation would have different behavior
-        # with respect to deserialization errors; is this a good design?
-
         self = cls(initial_msg)
 
-        def do_tag_or_attestation(tag):
+        memoize = (memoize and
+                   isinstance(ctx, opentimestamps.core.serialize.BufferDeserializationContext) and
+                   isinstance(ctx.buf, bytes))
+        if memoize:
+            buf_view = memoryview(ctx.buf)
+
+            # Canonical encoding of every distinct attestation seen, shared by
+            # all the spans; proofs repeat the same few attestations.
+            canonical_attestations = {}
+
+        # Timestamps that are still being deserialized, the remaining
+        # recursion limit for their children, and if memoizing, a
+        # _SerializedSpan for the timestamp.
+        stack = [(self, recursion_limit - 1, _SerializedSpan(self, ctx.pos, None, False) if memoize else None)]
+        while stack:
+            stamp, child_recursion_limit, span = stack[-1]
+
+            # Every tag but the last is preceded by \xff; once we get to the
+            # last one this timestamp is finished, although its last op's
+            # result timestamp may still need deserializing.
+            tag = ctx.read_bytes(1)
+            if tag == b'\xff':
+                tag = ctx.read_bytes(1)
+                last = False
+            else:
+                stack.pop()
+                last = True
+
+            if span is not None:
+                item_start = ctx.pos
+
             if tag == b'\x00':
                 attestation = TimeAttestation.deserialize(ctx)
-                self.attestations.add(attestation)
+                stamp.attestations.add(attestation)
+
+                if span is not None:
+                    span.add_attestation(attestation, buf_view[item_start:ctx.pos], canonical_attestations)
+                    if last:
+                        span.end(buf_view, ctx.pos)
 
             else:
                 op = Op.deserialize_from_tag(ctx, tag)
 
-                try:
-                    result = op(initial_msg)
-                except MsgValueError as exp:
-                    raise opentimestamps.core.serialize.DeserializationError("Invalid timestamp; message invalid for op %r: %r" % (op, exp))
+                if lazy:
+                    result_stamp = LazyTimestamp(stamp, op)
 
-                stamp = Timestamp.deserialize(ctx, result, _recursion_limit=_recursion_limit-1)
-                self.ops[op] = stamp
+                else:
+                    try:
+                        result = op(stamp.msg)
+                    except MsgValueError as exp:
+                        raise opentimestamps.core.serialize.DeserializationError("Invalid timestamp; message invalid for op %r: %r" % (op, exp))
 
-        tag = ctx.read_bytes(1)
-        while tag == b'\xff':
-            do_tag_or_attestation(ctx.read_bytes(1))
+                    result_stamp = Timestamp(result)
 
-            tag = ctx.read_bytes(1)
+                if not child_recursion_limit:
+                    raise opentimestamps.core.serialize.RecursionLimitError("Reached timestamp recursion depth limit while deserializing")
 
-        do_tag_or_attestation(tag)
+                stamp.ops[op] = result_stamp
+
+                result_span = None
+                if span is not None:
+                    span.add_op(op, ctx.pos - item_start + 1)
+                    result_span = _SerializedSpan(result_stamp, ctx.pos, span, last)
+
+                stack.append((result_stamp, child_recursion_limit - 1, result_span))
 
         return self
 
+    @classmethod
+    def scan(cls, ctx, recursion_limit=256):
+        """Scan a serialized timestamp for attestations
+
+        Yields every attestation in the serialized timestamp, in the order
+        they're serialized, without deserializing the timestamp itself: no
+        Timestamp or Op objects are created, and nothing is hashed. The same
+        attestation may be yielded more than once.
+
+        Deserialization errors, including the recursion limit, are the same as
+        those of deserialize(), except for messages being invalid for their
+        ops; as with lazy deserialization, those aren't detected.
+        """
+        if not recursion_limit:
+            raise opentimestamps.core.serialize.RecursionLimitError("Reached timestamp recursion depth limit while deserializing")
+
+        # Remaining recursion limit for the children of every timestamp still
+        # being scanned.
+        stack = [recursion_limit - 1]
+        while stack:
+            child_recursion_limit = stack[-1]
+
+            tag = ctx.read_bytes(1)
+            if tag == b'\xff':
+                tag = ctx.read_bytes(1)
+            else:
+                stack.pop()
+
+            if tag == b'\x00':
+                yield TimeAttestation.deserialize(ctx)
+
+            else:
+                if tag in UnaryOp.SUBCLS_BY_TAG:
+                    pass
+                elif tag in BinaryOp.SUBCLS_BY_TAG:
+                    ctx.read_varbytes(BinaryOp.SUBCLS_BY_TAG[tag].MAX_RESULT_LENGTH, min_len=1)
+                else:
+                    raise opentimestamps.core.serialize.DeserializationError("Unknown operation tag 0x%0x" % tag[0])
+
+                if not child_recursion_limit:
+                    raise opentimestamps.core.serialize.RecursionLimitError("Reached timestamp recursion depth limit while deserializing")
+
+                stack.append(child_recursion_limit - 1)
+
+    def _memoize(self, serialized):
+        """Memoize a serialization; for _SerializedSpan"""
+        self.__serialized = serialized
+
     def all_attestations(self):
         """Iterate over all attestations recursively
 
+        The tree is walked iteratively, so there's no limit on the depth of
+        timestamp that can be iterated over.
+
         Returns iterable of (msg, attestation)
         """
-        for attestation in self.attestations:
-            yield (self.msg, attestation)
+        stack = [self]
+        while stack:
+            stamp = stack.pop()
+            for attestation in stamp.attestations:
+                yield (stamp.msg, attestation)
+
+            # Reversed, so the ops are walked in order
+            stack.extend(reversed(tuple(stamp.ops.values())))
+
+    def all_attestation_paths(self):
+        """Iterate over all attestations, with the operations leading to them
+
+        Unlike all_attestations() no messages are needed, so for a
+        LazyTimestamp nothing is calculated.
+
+        Returns iterable of (ops, attestation), where ops is a tuple of the
+        operations from this timestamp to the attestation.
+        """
+        stack = [((), self)]
+        while stack:
+            path, stamp = stack.pop()
+            for attestation in stamp.attestations:
+                yield (path, attestation)
 
-        for op_stamp in self.ops.values():
-            yield from op_stamp.all_attestations()
+            for op, op_stamp in stamp.ops.items():
+                stack.append((path + (op,), op_stamp))
 
     def str_tree(self, indent=0):
         """Convert to tree (for debugging)"""
 
-        r = ""
-        if len(self.attestations) > 0:
-            for attestation in self.attestations:
-                r += " "*indent + "verify %s" % str(attestation) + "\n"
+        r = []
+
+        # Timestamps still to be converted, along with their indentation;
+        # strings are lines to be output once they're popped.
+        stack = [(self, indent)]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                r.append(item)
+                continue
+
+            stamp, indent = item
+            for attestation in stamp.attestations:
+                r.append(" "*indent + "verify %s" % str(attestation) + "\n")
+
+            if len(stamp.ops) > 1:
+                for op, timestamp in reversed(tuple(stamp.ops.items())):
+                    stack.append((timestamp, indent+4))
+                    stack.append(" "*indent + " -> " + "%s"%str(op) + "\n")
+            elif len(stamp.ops) > 0:
+                op, timestamp = next(iter(stamp.ops.items()))
+                r.append(" "*indent + "%s\n" % str(op))
+                stack.append((timestamp, indent))
+
+        return "".join(r)
+
+
+class _SerializedSpan:
+    """Part of a buffer that a timestamp is being deserialized from
+
+    Used by Timestamp.deserialize() to memoize the serializations of the
+    timestamps it creates. A timestamp's serialization is only memoized if it's
+    canonical: attestations and ops in sorted order, and encoded exactly the
+    way serialize() would encode them. Anything else, say a non-minimal
+    varuint, would otherwise be preserved by re-serialization.
+    """
+    __slots__ = ['stamp', 'start', 'parent', 'ends_parent', 'canonical', 'last_attestation', 'last_op']
+
+    def __init__(self, stamp, start, parent, ends_parent):
+        """Create a new span
+
+        parent is the span of the timestamp whose op leads to this one, and
+        ends_parent is True if that was its last op; the parent ends when this
+        timestamp does.
+        """
+        self.stamp = stamp
+        self.start = start
+        self.parent = parent
+        self.ends_parent = ends_parent
+        self.canonical = True
+        self.last_attestation = None
+        self.last_op = None
+
+    def add_attestation(self, attestation, encoded, canonical_attestations):
+        """Add an attestation, encoded as encoded
+
+        canonical_attestations is a dict of attestation -> canonical encoding,
+        filled in as attestations are first seen, so each distinct
+        attestation is only encoded once.
+        """
+        prev = self.last_attestation
+        if self.last_op is not None:
+            # attestations are serialized before ops
+            self.canonical = False
+
+        elif prev is not None and not (prev.__class__ is attestation.__class__ and
+                                       prev.__class__ is not UnknownAttestation and
+                                       prev < attestation):
+            self.canonical = False
+
+        elif self.canonical:
+            try:
+                canonical = canonical_attestations[attestation]
+            except KeyError:
+                ctx = opentimestamps.core.serialize.BufferSerializationContext()
+                attestation.serialize(ctx)
+                canonical = canonical_attestations[attestation] = ctx.getbytes()
+
+            if encoded != canonical:
+                self.canonical = False
+
+        self.last_attestation = attestation
+
+    def add_op(self, op, encoded_len):
+        """Add an op, encoded_len bytes long including its tag"""
+        if self.last_op is not None and not self.last_op < op:
+            self.canonical = False
+
+        elif isinstance(op, BinaryOp):
+            # tag, minimal varuint length, then the argument itself
+            arg_len = len(op[0])
+            if encoded_len != 1 + max(1, (arg_len.bit_length() + 6) // 7) + arg_len:
+                self.canonical = False
+
+        self.last_op = op
+
+    def end(self, buf_view, end):
+        """End the span, along with every parent span that it ends"""
+        span = self
+        while True:
+            if span.canonical:
+                span.stamp._memoize(buf_view[span.start:end])
+            elif span.parent is not None:
+                span.parent.canonical = False
+
+            if not span.ends_parent:
+                break
+            span = span.parent
+
+
+class LazyTimestamp(Timestamp):
+    """Timestamp whose message is calculated on first use
+
+    Created by Timestamp.deserialize(lazy=True); the message is the result of
+    an operation on the parent timestamp's message, and is only calculated -
+    along with any uncalculated parent messages - when msg is accessed. After
+    that the timestamp behaves like any other.
+
+    Since the calculation is deferred, messages that are invalid for their
+    operation aren't detected at deserialization time; DeserializationError
+    is raised when msg is accessed instead.
+    """
+    __slots__ = ['__lazy_msg', '__parent', '__op']
+
+    @property
+    def msg(self):
+        if self.__lazy_msg is None:
+            # Find the nearest ancestor with a known message, then calculate
+            # downwards from there, without recursion.
+            uncalculated = [self]
+            stamp = self.__parent
+            while isinstance(stamp, LazyTimestamp) and stamp.__lazy_msg is None:
+                uncalculated.append(stamp)
+                stamp = stamp.__parent
+
+            msg = stamp.msg
+            for stamp in reversed(uncalculated):
+                try:
+                    msg = stamp.__op(msg)
+                except MsgValueError as exp:
+                    raise opentimestamps.core.serialize.DeserializationError("Invalid timestamp; message invalid for op %r: %r" % (stamp.__op, exp))
+
+                stamp.__lazy_msg = msg
+                stamp.__parent = None
+
+        return self.__lazy_msg
+
+    def __init__(self, parent, op):
+        self.__lazy_msg = None
+        self.__parent = parent
+        self.__op = op
+        self._init_state(lambda op: LazyTimestamp(self, op))
 
-        if len(self.ops) > 1:
-            for op, timestamp in self.ops.items():
-                r += " "*indent + " -> " + "%s"%str(op) + "\n"
-                r += timestamp.str_tree(indent+4)
-        elif len(self.ops) > 0:
-            r += " "*indent + "%s\n" % str(tuple(self.ops.keys())[0])
-            r += tuple(self.ops.values())[0].str_tree(indent)
+    def __repr__(self):
+        if self.__lazy_msg is None:
+            return 'LazyTimestamp(<%r>)' % self.__op
+        else:
+            return 'LazyTimestamp(<%s>)' % binascii.hexlify(self.__lazy_msg).decode('utf8')
+
+
+class TimestampIndex:
+    """Index of the messages and attestations in a timestamp
+
+    Maps every message in the timestamp to the timestamps for it, and every
+    attestation to the timestamps it's on, so finding either doesn't need a
+    walk of the whole tree. The index is kept up to date as the timestamp
+    changes - by ops.add(), merge() and so on - at a cost proportional to the
+    change, not the tree.
+
+    Timestamps only hold weak references to the indexes they're part of, so an
+    index that's no longer needed can simply be dropped.
+
+    Building an index calculates the message of every timestamp in the tree;
+    for a LazyTimestamp that's all the work a non-lazy deserialization does.
+    """
+
+    def __init__(self, timestamp):
+        self.timestamp = timestamp
+
+        self.__ref = weakref.ref(self)
+
+        # id() of every timestamp in the tree to [timestamp, parents,
+        # attestations]. parents are the timestamps in the tree it's the
+        # result of, once per op, or None for the root; a timestamp is only
+        # removed once it has none. attestations are the ones indexed, or None.
+        self.__entries = {}
+        self.__by_msg = {}
+        self.__by_attestation = {}
+
+        self.__add(timestamp, None)
+
+    def __len__(self):
+        """Number of timestamps in the tree"""
+        return len(self.__entries)
+
+    def __contains__(self, msg):
+        return msg in self.__by_msg
+
+    def msgs(self):
+        """Every message in the tree"""
+        return self.__by_msg.keys()
+
+    def find(self, msg):
+        """Find the timestamps for a message
+
+        Returns a tuple, empty if there are none; there's more than one if
+        different parts of the tree lead to the same message, and the
+        timestamps for it haven't been merged.
+        """
+        return tuple(self.__by_msg.get(msg, ()))
+
+    def attestations(self):
+        """Every attestation in the tree"""
+        return self.__by_attestation.keys()
+
+    def find_attestation(self, attestation):
+        """Find the timestamps with an attestation
+
+        Returns a tuple, empty if there are none.
+        """
+        return tuple(self.__by_attestation.get(attestation, {}).values())
+
+    def attestation_paths(self, attestation):
+        """Find the paths to an attestation
 
-        return r
+        Returns a list of tuples of the operations leading from the root
+        timestamp to the attestation, as all_attestation_paths() does. Only the
+        paths to the attestation are walked, upwards, rather than the tree.
+        """
+        paths = []
+        for stamp in self.find_attestation(attestation):
+            stack = [(stamp, ())]
+            while stack:
+                stamp, path = stack.pop()
+
+                parents = {}
+                for parent in self.__entries[id(stamp)][1]:
+                    parents[id(parent)] = parent
+
+                for parent in parents.values():
+                    if parent is None:
+                        paths.append(path)
+                    else:
+                        for op, result in parent.ops.items():
+                            if result is stamp:
+                                stack.append((parent, (op,) + path))
+        return paths
+
+    def is_directly_attested(self, stamp):
+        """Determine if a timestamp in the tree is directly attested
+
+        That is, if there's a path from the root timestamp to it that doesn't
+        go through any other timestamp with attestations. Only the paths to
+        the timestamp are walked, upwards, rather than the tree.
+        """
+        stack = [stamp]
+        visited = set()
+        while stack:
+            stamp = stack.pop()
+            for parent in self.__entries[id(stamp)][1]:
+                if parent is None:
+                    return True
+                elif not parent.attestations and id(parent) not in visited:
+                    visited.add(id(parent))
+                    stack.append(parent)
+        return False
+
+    def __add(self, stamp, parent):
+        stack = [(stamp, parent)]
+        while stack:
+            stamp, parent = stack.pop()
+
+            entry = self.__entries.get(id(stamp))
+            if entry is not None:
+                entry[1].append(parent)
+                continue
+
+            self.__entries[id(stamp)] = [stamp, [parent], None]
+            stamp._add_index(self.__ref)
+            self.__by_msg.setdefault(stamp.msg, []).append(stamp)
+            self.__update_attestations(stamp)
+
+            for result in stamp.ops.values():
+                stack.append((result, stamp))
+
+    def __remove(self, stamp, parent):
+        stack = [(stamp, parent)]
+        while stack:
+            stamp, parent = stack.pop()
+
+            entry = self.__entries[id(stamp)]
+            parents = entry[1]
+            for i, other_parent in enumerate(parents):
+                if other_parent is parent:
+                    del parents[i]
+                    break
+            if parents:
+                continue
+
+            del self.__entries[id(stamp)]
+            stamp._remove_index(self.__ref)
+
+            stamps = self.__by_msg[stamp.msg]
+            for i, other_stamp in enumerate(stamps):
+                if other_stamp is stamp:
+                    del stamps[i]
+                    break
+            if not stamps:
+                del self.__by_msg[stamp.msg]
+
+            for attestation in entry[2] or ():
+                self.__remove_attestation(stamp, attestation)
+
+            for result in stamp.ops.values():
+                stack.append((result, stamp))
+
+    def __remove_attestation(self, stamp, attestation):
+        stamps = self.__by_attestation[attestation]
+        del stamps[id(stamp)]
+        if not stamps:
+            del self.__by_attestation[attestation]
+
+    def __update_attestations(self, stamp):
+        entry = self.__entries[id(stamp)]
+        old_attestations = entry[2] or frozenset()
+        new_attestations = frozenset(stamp.attestations)
+
+        for attestation in new_attestations - old_attestations:
+            self.__by_attestation.setdefault(attestation, {})[id(stamp)] = stamp
+        for attestation in old_attestations - new_attestations:
+            self.__remove_attestation(stamp, attestation)
+
+        entry[2] = new_attestations or None
+
+    def _update(self, stamp, added, removed):
+        """Called by timestamps in the tree when they change"""
+        if removed is not None:
+            self.__remove(removed, stamp)
+        if added is not None:
+            self.__add(added, stamp)
+        self.__update_attestations(stamp)
 
 
 class DetachedTimestampFile:
@@ -256,8 +1146,12 @@ class DetachedTimestampFile:
                 self.timestamp == other.timestamp)
 
     @classmethod
-    def from_fd(cls, file_hash_op, fd):
-        fd_hash = file_hash_op.hash_fd(fd)
+    def from_fd(cls, file_hash_op, fd, use_mmap=False):
+        """Create a timestamp file for the contents of a file
+
+        use_mmap is passed to hash_fd(); see there for when it's safe to use.
+        """
+        fd_hash = file_hash_op.hash_fd(fd, use_mmap=use_mmap)
         return cls(file_hash_op, Timestamp(fd_hash))
 
     def serialize(self, ctx):
@@ -272,7 +1166,7 @@ class DetachedTimestampFile:
         self.timestamp.serialize(ctx)
 
     @classmethod
-    def deserialize(cls, ctx):
+    def __deserialize_header(cls, ctx):
         ctx.assert_magic(cls.HEADER_MAGIC)
 
         major = ctx.read_varuint() # FIXME: max-int limit
@@ -281,20 +1175,61 @@ class DetachedTimestampFile:
 
         file_hash_op = CryptOp.deserialize(ctx)
         file_hash = ctx.read_bytes(file_hash_op.DIGEST_LENGTH)
-        timestamp = Timestamp.deserialize(ctx, file_hash)
+        return (file_hash_op, file_hash)
+
+    @classmethod
+    def deserialize(cls, ctx, lazy=False, memoize=False):
+        """Deserialize
+
+        If lazy is True, the timestamp is deserialized lazily, and if memoize
+        is True its serialization is memoized; see Timestamp.deserialize().
+        """
+        file_hash_op, file_hash = cls.__deserialize_header(ctx)
+        timestamp = Timestamp.deserialize(ctx, file_hash, lazy=lazy, memoize=memoize)
 
         ctx.assert_eof()
 
         return DetachedTimestampFile(file_hash_op, timestamp)
 
+    @classmethod
+    def scan(cls, ctx):
+        """Scan a serialized detached timestamp file for attestations
+
+        See Timestamp.scan()
+        """
+        file_hash_op, file_hash = cls.__deserialize_header(ctx)
+        yield from Timestamp.scan(ctx)
+
+        ctx.assert_eof()
+
+
+def _add_op(stamp, op, result=None):
+    """Add an op to a timestamp, as stamp.ops.add() does
+
+    If result is given, it's used as the result of the op if a new timestamp
+    needs to be created, rather than being calculated.
+    """
+    if result is None:
+        return stamp.ops.add(op)
+
+    try:
+        return stamp.ops[op]
+    except KeyError:
+        result_stamp = Timestamp(result)
+        stamp.ops[op] = result_stamp
+        return result_stamp
+
 
-def cat_then_unary_op(unary_op_cls, left, right):
+def cat_then_unary_op(unary_op_cls, left, right, result=None):
     """Concatenate left and right, then perform a unary operation on them
 
     left and right can be either timestamps or bytes.
 
     Appropriate intermediary append/prepend operations will be created as
     needed for left and right.
+
+    If the result of the unary operation has already been calculated, say in
+    bulk with CryptOp.hash_many(), it can be given as result; it isn't checked.
     """
     if not isinstance(left, Timestamp):
         left = Timestamp(left)
@@ -309,16 +1244,21 @@ def cat_then_unary_op(unary_op_cls, left, right):
     # of the left to the right.
     left.ops[OpAppend(right.msg)] = right_prepend_stamp
 
-    return right_prepend_stamp.ops.add(unary_op_cls())
+    return _add_op(right_prepend_stamp, unary_op_cls(), result)
 
 
-def cat_sha256(left, right):
-    return cat_then_unary_op(OpSHA256, left, right)
+def cat_sha256(left, right, result=None):
+    return cat_then_unary_op(OpSHA256, left, right, result)
 
 
-def cat_sha256d(left, right):
-    sha256_timestamp = cat_sha256(left, right)
-    return sha256_timestamp.ops.add(OpSHA256())
+def cat_sha256d(left, right, result=None, sha256_result=None):
+    """Concatenate left and right, then SHA256 them twice
+
+    As with cat_then_unary_op() the results of the second and first SHA256 can
+    be given if they've already been calculated.
+    """
+    sha256_timestamp = cat_sha256(left, right, sha256_result)
+    return _add_op(sha256_timestamp, OpSHA256(), result)
 
 
 def make_merkle_tree(timestamps, binop=cat_sha256):
@@ -342,17 +1282,22 @@ def make_merkle_tree(timestamps, binop=cat_sha256):
         except StopIteration:
             raise ValueError("Need at least one timestamp")
 
-        next_stamps = []
+        pairs = []
         for stamp in stamps:
             if prev_stamp is not None:
-                next_stamps.append(cat_sha256(prev_stamp, stamp))
+                pairs.append((prev_stamp, stamp))
                 prev_stamp = None
             else:
                 prev_stamp = stamp
 
-        if not next_stamps:
+        if not pairs:
             return prev_stamp
 
+        # The whole level is hashed at once, which is much faster than one
+        # pair at a time; the tree itself is built exactly the same way.
+        results = OpSHA256.hash_many([left.msg + right.msg for left, right in pairs])
+        next_stamps = [cat_sha256(left, right, result) for (left, right), result in zip(pairs, results)]
+
         if prev_stamp is not None:
             next_stamps.append(prev_stamp)
 
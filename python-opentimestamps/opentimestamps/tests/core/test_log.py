@@ -12,6 +12,8 @@
 import io
 import unittest
 
+import opentimestamps.core.serialize
+
 from opentimestamps.core.timestamp import *
 from opentimestamps.core.log import *
 from opentimestamps.core.op import *
@@ -56,3 +58,110 @@ class Test_TimestampLogWriter(unittest.TestCase):
                                  bytes.fromhex('e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855') + # sha256 of b'' +
                                  b'\x00' + bytes.fromhex('83dfe30d2ef90c8e' + '07' + '06') + b'foobar' + # attestation
                              b'\x00') # end of packet
+
+def make_log_stamp(length):
+    stamp = Timestamp(OpSHA256()(bytes([length % 256])))
+    stamp.attestations.add(PendingAttestation('http://%d' % length))
+    return stamp
+
+class Test_TimestampLogReader(unittest.TestCase):
+    def test_read(self):
+        """Read every timestamp back from the log"""
+        with io.BytesIO() as fd:
+            writer = TimestampLogWriter.create(fd, OpSHA256())
+            for length in (0, 10, 10, 300):
+                writer.append(length, make_log_stamp(length))
+
+            fd.seek(0)
+            reader = TimestampLogReader.open(fd)
+            self.assertEqual(list(reader), [(length, make_log_stamp(length)) for length in (0, 10, 10, 300)])
+
+class Test_TimestampLogIndex(unittest.TestCase):
+    def test_index(self):
+        """Seek and find log entries with an index"""
+        lengths = (0, 10, 10, 300, 5000)
+        with io.BytesIO() as fd, io.BytesIO() as index_fd:
+            index = TimestampLogIndex(index_fd)
+            writer = TimestampLogWriter.create(fd, OpSHA256(), index=index)
+            for length in lengths:
+                writer.append(length, make_log_stamp(length))
+            self.assertEqual([entry[0] for entry in (index[n] for n in range(len(index)))], list(lengths))
+
+            fd.seek(0)
+            reader = TimestampLogReader.open(fd, index=TimestampLogIndex(index_fd))
+            self.assertEqual(len(reader.index), len(lengths))
+
+            reader.seek(3)
+            self.assertEqual(list(reader), [(length, make_log_stamp(length)) for length in lengths[3:]])
+            reader.seek(-1)
+            self.assertEqual(list(reader), [(5000, make_log_stamp(5000))])
+
+            self.assertEqual(reader.find(0), (0, make_log_stamp(0)))
+            self.assertEqual(reader.find(10)[0], 10)
+            self.assertEqual(reader.find(299)[0], 10)
+            self.assertEqual(reader.find(10**6), (5000, make_log_stamp(5000)))
+
+            with self.assertRaises(IndexError):
+                reader.seek(len(lengths))
+
+        # No entry for that little of the file
+        with io.BytesIO() as fd, io.BytesIO() as index_fd:
+            writer = TimestampLogWriter.create(fd, OpSHA256(), index=TimestampLogIndex(index_fd))
+            writer.append(10, make_log_stamp(10))
+            fd.seek(0)
+            self.assertIsNone(TimestampLogReader.open(fd, index=TimestampLogIndex(index_fd)).find(9))
+
+    def test_bad_index(self):
+        """Invalid and non-empty indexes are rejected"""
+        with self.assertRaises(opentimestamps.core.serialize.BadMagicError):
+            TimestampLogIndex(io.BytesIO(b'not an index'))
+
+        index = TimestampLogIndex(io.BytesIO())
+        index.append(0, 0)
+        with self.assertRaises(ValueError):
+            TimestampLogWriter.create(io.BytesIO(), OpSHA256(), index=index)
+
+    def test_update(self):
+        """Index catches up with entries appended without it"""
+        with io.BytesIO() as fd, io.BytesIO() as index_fd:
+            writer = TimestampLogWriter.create(fd, OpSHA256(), index=TimestampLogIndex(index_fd))
+            writer.append(1, make_log_stamp(1))
+
+            # Appended without the index
+            fd.seek(0)
+            writer = TimestampLogWriter.open(fd)
+            writer.append(2, make_log_stamp(2))
+            writer.append(3, make_log_stamp(3))
+
+            # Along with a truncated index record
+            index_fd.seek(0, io.SEEK_END)
+            index_fd.write(b'\xff' * 5)
+
+            fd.seek(0)
+            index = TimestampLogIndex(index_fd)
+            writer = TimestampLogWriter.open(fd, index=index)
+            self.assertEqual([index[n][0] for n in range(len(index))], [1, 2, 3])
+
+            # Writer is positioned at the end
+            writer.append(4, make_log_stamp(4))
+
+            fd.seek(0)
+            reader = TimestampLogReader.open(fd, index=index)
+            self.assertEqual([length for length, stamp in reader], [1, 2, 3, 4])
+            self.assertEqual(len(index), 4)
+
+    def test_rebuild(self):
+        """Index that doesn't match the log is rebuilt"""
+        with io.BytesIO() as fd, io.BytesIO() as index_fd:
+            writer = TimestampLogWriter.create(fd, OpSHA256())
+            for length in (1, 2, 3):
+                writer.append(length, make_log_stamp(length))
+
+            index = TimestampLogIndex(index_fd)
+            index.append(7, 1234)
+
+            fd.seek(0)
+            reader = TimestampLogReader.open(fd, index=index)
+            self.assertEqual([index[n][0] for n in range(len(index))], [1, 2, 3])
+            reader.seek(1)
+            self.assertEqual(next(iter(reader)), (2, make_log_stamp(2)))
@@ -9,6 +9,13 @@
 # modified, propagated, or distributed except according to the terms contained
 # in the LICENSE file.
 
+import concurrent.futures
+import copy
+import hashlib
+import io
+import os
+import pickle
+import tempfile
 import unittest
 
 from opentimestamps.core.op import *
@@ -97,7 +104,114 @@ class Test_Op(unittest.TestCase):
         self.assertNotEqual(OpAppend(b'foo'), OpAppend(b'bar'))
         self.assertNotEqual(OpAppend(b'foo'), OpPrepend(b'foo'))
 
+        self.assertEqual(len({OpAppend(b'foo'), OpAppend(b'foo'), OpPrepend(b'foo'), OpSHA256(), OpSHA256()}), 3)
+
     def test_ordering(self):
         """Operation ordering"""
         self.assertTrue(OpSHA1() < OpRIPEMD160())
-        # FIXME: more tests
+
+        # By tag, then by argument
+        ops = [OpSHA1(), OpRIPEMD160(), OpSHA256(), OpAppend(b'a'), OpAppend(b'b'), OpPrepend(b'a')]
+        self.assertEqual(sorted(reversed(ops)), ops)
+        self.assertTrue(OpAppend(b'a') <= OpAppend(b'a') < OpAppend(b'aa') <= OpPrepend(b'a'))
+        self.assertTrue(OpPrepend(b'a') > OpAppend(b'b') >= OpAppend(b'b'))
+        self.assertFalse(OpSHA256() < OpSHA256())
+
+    def test_unary_interned(self):
+        """Unary operations are interned"""
+        self.assertIs(OpSHA256(), OpSHA256())
+        self.assertIsNot(OpSHA256(), OpSHA1())
+        self.assertIs(copy.deepcopy(OpSHA256()), OpSHA256())
+        self.assertIs(pickle.loads(pickle.dumps(OpSHA256())), OpSHA256())
+
+        self.assertEqual(pickle.loads(pickle.dumps(OpAppend(b'foo'))), OpAppend(b'foo'))
+        self.assertEqual(copy.copy(OpPrepend(b'foo')), OpPrepend(b'foo'))
+
+class Test_CryptOp(unittest.TestCase):
+    def test_hash_fd(self):
+        """Hashing files and file-like objects"""
+        data = os.urandom(10000)
+        expected = hashlib.sha256(data).digest()
+
+        class ReadOnly:
+            def __init__(self, data):
+                self.fd = io.BytesIO(data)
+            def read(self, l):
+                return self.fd.read(l)
+
+        for chunk_size in (1, 7, 4096, 2**20):
+            self.assertEqual(OpSHA256().hash_fd(io.BytesIO(data), chunk_size=chunk_size), expected)
+            self.assertEqual(OpSHA256().hash_fd(ReadOnly(data), chunk_size=chunk_size), expected)
+
+        for use_mmap in (False, True):
+            with tempfile.TemporaryFile() as fd:
+                fd.write(data)
+                fd.seek(0)
+                self.assertEqual(OpSHA256().hash_fd(fd, chunk_size=4096, use_mmap=use_mmap), expected)
+                self.assertEqual(fd.tell(), len(data))
+
+                # Hashing starts at the current position
+                fd.seek(100)
+                self.assertEqual(OpSHA256().hash_fd(fd, use_mmap=use_mmap), hashlib.sha256(data[100:]).digest())
+
+                # Already at the end
+                self.assertEqual(OpSHA256().hash_fd(fd, use_mmap=use_mmap), hashlib.sha256(b'').digest())
+
+            with tempfile.TemporaryFile() as fd:
+                # Empty files can't be memory-mapped
+                self.assertEqual(OpSHA256().hash_fd(fd, use_mmap=use_mmap), hashlib.sha256(b'').digest())
+
+        # Neither read() nor readinto() is buffered
+        with tempfile.TemporaryFile(buffering=0) as fd:
+            fd.write(data)
+            fd.seek(0)
+            self.assertEqual(OpSHA256().hash_fd(fd, chunk_size=4096), expected)
+
+        # Text files don't have readinto(), and read() returns str
+        with tempfile.TemporaryFile('w+') as fd:
+            fd.write('foo')
+            fd.seek(0)
+            with self.assertRaises(TypeError):
+                OpSHA256().hash_fd(fd)
+
+    def test_hash_fd_nonblocking(self):
+        """Non-blocking files with no data available aren't mistaken for EOF"""
+        r, w = os.pipe()
+        try:
+            os.set_blocking(r, False)
+            os.write(w, b'foo')
+            with open(r, 'rb', buffering=0, closefd=False) as fd:
+                with self.assertRaises(BlockingIOError):
+                    OpSHA256().hash_fd(fd)
+
+            os.write(w, b'bar')
+            with open(r, 'rb', closefd=False) as fd:
+                with self.assertRaises(BlockingIOError):
+                    OpSHA256().hash_fd(fd)
+        finally:
+            os.close(r)
+            os.close(w)
+
+    def test_hash_many(self):
+        """Hashing many messages at once"""
+        msgs = [os.urandom(i) for i in range(100)]
+        for op_cls in (OpSHA1, OpRIPEMD160, OpSHA256):
+            self.assertEqual(op_cls.hash_many(msgs), [op_cls()(msg) for msg in msgs])
+
+        self.assertEqual(OpSHA256.hash_many([]), [])
+
+        # Any bytes-like object will do
+        self.assertEqual(OpSHA256.hash_many([bytearray(b'foo'), memoryview(b'foobar')[3:]]),
+                         [OpSHA256()(b'foo'), OpSHA256()(b'bar')])
+
+        with self.assertRaises(MsgValueError):
+            OpSHA256.hash_many([b'', b'.'*4097])
+
+        class SmallChunkOpSHA256(OpSHA256):
+            HASH_MANY_CHUNK_SIZE = 7
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            self.assertEqual(SmallChunkOpSHA256.hash_many(msgs, executor), OpSHA256.hash_many(msgs))
+
+            with self.assertRaises(MsgValueError):
+                SmallChunkOpSHA256.hash_many(msgs + [b'.'*4097], executor)
@@ -22,3 +22,83 @@ class Test_serialization(unittest.TestCase):
         with self.assertRaises(TrailingGarbageError):
             ctx = BytesDeserializationContext(b'b')
             ctx.assert_eof()
+
+class Test_BufferDeserializationContext(unittest.TestCase):
+    def test_same_as_stream(self):
+        """Buffer deserialization matches stream deserialization"""
+        ctx = BytesSerializationContext()
+        ctx.write_bytes(b'magic')
+        ctx.write_bool(True)
+        ctx.write_bool(False)
+        for i in (0, 1, 0x7f, 0x80, 0x3fff, 0x4000, 2**64):
+            ctx.write_varuint(i)
+        ctx.write_varbytes(b'')
+        ctx.write_varbytes(b'foobar')
+        ctx.write_bytes(b'baz')
+        serialized = ctx.getbytes()
+
+        for buf in (serialized, bytearray(serialized), memoryview(serialized)):
+            for ctx in (BytesDeserializationContext(serialized), BufferDeserializationContext(buf)):
+                ctx.assert_magic(b'magic')
+                self.assertIs(ctx.read_bool(), True)
+                self.assertIs(ctx.read_bool(), False)
+                for i in (0, 1, 0x7f, 0x80, 0x3fff, 0x4000, 2**64):
+                    self.assertEqual(ctx.read_varuint(), i)
+                self.assertEqual(ctx.read_varbytes(0), b'')
+                self.assertEqual(ctx.read_varbytes(6), b'foobar')
+                r = ctx.read_bytes(3)
+                self.assertEqual(r, b'baz')
+                self.assertIs(r.__class__, bytes)
+                ctx.assert_eof()
+
+    def test_errors(self):
+        """Buffer deserialization errors"""
+        with self.assertRaises(BadMagicError):
+            BufferDeserializationContext(b'mag').assert_magic(b'magic')
+        with self.assertRaises(BadMagicError):
+            BufferDeserializationContext(b'magik').assert_magic(b'magic')
+
+        with self.assertRaises(TruncationError):
+            BufferDeserializationContext(b'').read_bool()
+        with self.assertRaises(DeserializationError):
+            BufferDeserializationContext(b'\x01').read_bool()
+
+        with self.assertRaises(TruncationError):
+            BufferDeserializationContext(b'\x80\x80').read_varuint()
+
+        with self.assertRaises(TruncationError):
+            BufferDeserializationContext(b'\x06fooba').read_varbytes(6)
+        with self.assertRaises(DeserializationError):
+            BufferDeserializationContext(b'\x06foobar').read_varbytes(5)
+        with self.assertRaises(DeserializationError):
+            BufferDeserializationContext(b'\x00').read_varbytes(5, min_len=1)
+
+        with self.assertRaises(TrailingGarbageError):
+            ctx = BufferDeserializationContext(b'ab')
+            ctx.read_bytes(1)
+            ctx.assert_eof()
+
+class Test_BufferSerializationContext(unittest.TestCase):
+    def test_same_as_stream(self):
+        """Buffer serialization matches stream serialization"""
+        for ctx in (BytesSerializationContext(), BufferSerializationContext()):
+            ctx.write_bool(True)
+            ctx.write_bool(False)
+            for i in (0, 1, 0x7f, 0x80, 0x3fff, 0x4000, 2**64):
+                ctx.write_varuint(i)
+            ctx.write_varbytes(b'')
+            ctx.write_varbytes(b'foobar')
+            ctx.write_bytes(b'baz')
+            self.assertEqual(ctx.getbytes(),
+                             b'\xff\x00' +
+                             b'\x00\x01\x7f\x80\x01\xff\x7f\x80\x80\x01' +
+                             b'\x80\x80\x80\x80\x80\x80\x80\x80\x80\x02' +
+                             b'\x00\x06foobarbaz')
+
+    def test_errors(self):
+        """Buffer serialization errors"""
+        ctx = BufferSerializationContext()
+        with self.assertRaises(TypeError):
+            ctx.write_bool(1)
+        with self.assertRaises(ValueError):
+            ctx.write_varuint(-1)
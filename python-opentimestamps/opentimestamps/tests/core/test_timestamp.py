@@ -9,6 +9,7 @@
 # modified, propagated, or distributed except according to the terms contained
 # in the LICENSE file.
 
+import sys
 import unittest
 
 from opentimestamps.core.notary import *
@@ -56,10 +57,87 @@ class Test_Timestamp(unittest.TestCase):
         t2 = Timestamp(b'a')
         t2.attestations.add(PendingAttestation('foobar'))
 
-        t1.merge(t2)
+        self.assertEqual(t1.merge(t2), [((), PendingAttestation('foobar'))])
         self.assertEqual(t1, t2)
 
-        # FIXME: more tests
+    def test_merge_delta(self):
+        """Merging returns the attestations that were new"""
+        t1 = Timestamp(b'a')
+        t1.attestations.add(PendingAttestation('foobar'))
+        t1.ops.add(OpAppend(b'b')).attestations.add(PendingAttestation('foobar'))
+
+        t2 = Timestamp(b'a')
+        t2.attestations.add(PendingAttestation('foobar'))
+        t2.ops.add(OpAppend(b'b')).ops.add(OpSHA256()).attestations.add(BitcoinBlockHeaderAttestation(1))
+        t2.ops.add(OpPrepend(b'c')).attestations.add(PendingAttestation('foobar'))
+        t2.ops.add(OpPrepend(b'c')).attestations.add(PendingAttestation('barfoo'))
+
+        expected = {((OpAppend(b'b'), OpSHA256()), BitcoinBlockHeaderAttestation(1)),
+                    ((OpPrepend(b'c'),), PendingAttestation('foobar')),
+                    ((OpPrepend(b'c'),), PendingAttestation('barfoo'))}
+        delta = t1.merge(t2)
+        self.assertEqual(len(delta), 3)
+        self.assertEqual(set(delta), expected)
+        self.assertEqual(set(t1.all_attestation_paths()), expected | {((), PendingAttestation('foobar')),
+                                                                      ((OpAppend(b'b'),), PendingAttestation('foobar'))})
+
+        # Nothing new the second time, or merging with itself
+        self.assertEqual(t1.merge(t2), [])
+        self.assertEqual(t1.merge(t1), [])
+
+    def test_merge_deep(self):
+        """Merging timestamps deeper than Python's recursion limit"""
+        depth = sys.getrecursionlimit() * 2
+        t1 = Timestamp(b'')
+        t2 = Timestamp(b'')
+        tip = t2
+        for i in range(depth):
+            tip = tip.ops.add(OpAppend(b'\x00'))
+        tip.attestations.add(PendingAttestation('foobar'))
+
+        self.assertEqual(t1.merge(t2), [((OpAppend(b'\x00'),)*depth, PendingAttestation('foobar'))])
+
+    def test_prune(self):
+        """Pruning timestamps"""
+        stamp = Timestamp(b'a')
+        stamp.attestations.add(PendingAttestation('foo'))
+        b_stamp = stamp.ops.add(OpAppend(b'b'))
+        b_stamp.attestations.add(PendingAttestation('bar'))
+        b_stamp.ops.add(OpSHA256()).attestations.add(BitcoinBlockHeaderAttestation(2))
+        b_stamp.ops.add(OpAppend(b'c')).attestations.add(BitcoinBlockHeaderAttestation(1))
+        stamp.ops.add(OpPrepend(b'd')).ops.add(OpSHA256()).attestations.add(PendingAttestation('baz'))
+
+        removed = stamp.prune({BitcoinBlockHeaderAttestation(1)})
+        self.assertEqual(sorted(removed, key=repr),
+                         sorted([((), PendingAttestation('foo')),
+                                 ((OpAppend(b'b'),), PendingAttestation('bar')),
+                                 ((OpAppend(b'b'), OpSHA256()), BitcoinBlockHeaderAttestation(2)),
+                                 ((OpPrepend(b'd'), OpSHA256()), PendingAttestation('baz'))], key=repr))
+        self.assertEqual(list(stamp.all_attestation_paths()),
+                         [((OpAppend(b'b'), OpAppend(b'c')), BitcoinBlockHeaderAttestation(1))])
+        self.assertEqual(list(stamp.ops), [OpAppend(b'b')])
+        self.assertEqual(list(b_stamp.ops), [OpAppend(b'c')])
+
+        # Nothing left to remove
+        self.assertEqual(stamp.prune({BitcoinBlockHeaderAttestation(1)}), [])
+
+    def test_prune_shared(self):
+        """Pruning timestamps with results shared by several paths"""
+        tip = Timestamp(OpSHA256()(b'abc'))
+        tip.attestations.add(BitcoinBlockHeaderAttestation(1))
+        tip.ops.add(OpSHA256()).attestations.add(PendingAttestation('foo'))
+
+        stamp = Timestamp(b'a')
+        stamp.ops.add(OpAppend(b'bc')).ops[OpSHA256()] = tip
+        stamp.ops.add(OpAppend(b'b')).attestations.add(PendingAttestation('bar'))
+        stamp.ops[OpAppend(b'b')].ops.add(OpAppend(b'c')).ops[OpSHA256()] = tip
+
+        index = TimestampIndex(stamp)
+        self.assertEqual(len(stamp.prune({BitcoinBlockHeaderAttestation(1)})), 2)
+        self.assertEqual(sorted(path for path, attestation in stamp.all_attestation_paths()),
+                         [(OpAppend(b'b'), OpAppend(b'c'), OpSHA256()),
+                          (OpAppend(b'bc'), OpSHA256())])
+        self.assertEqual(set(index.attestations()), {BitcoinBlockHeaderAttestation(1)})
 
     def test_serialization(self):
         """Timestamp serialization/deserialization"""
@@ -114,7 +192,7 @@ class Test_Timestamp(unittest.TestCase):
             # Not ok, result would be 4097 bytes long
             Timestamp.deserialize(BytesDeserializationContext(serialized), b'.'*4096)
 
-    def test_deserialization_invalid_op_msg(self):
+    def test_deserialization_recursion_limit(self):
         """Deserialization of a timestamp that exceeds the recursion limit"""
         serialized = (b'\x08'*256 + # OpSHA256, 256 times
                       b'\x00' + bytes.fromhex('83dfe30d2ef90c8e' + '07' + '06') + b'barfoo') # perfectly valid pending attestation
@@ -122,6 +200,357 @@ class Test_Timestamp(unittest.TestCase):
         with self.assertRaises(RecursionLimitError):
             Timestamp.deserialize(BytesDeserializationContext(serialized), b'')
 
+        # One less is fine
+        Timestamp.deserialize(BytesDeserializationContext(serialized[1:]), b'')
+
+        with self.assertRaises(RecursionLimitError):
+            Timestamp.deserialize(BytesDeserializationContext(serialized[-21:]), b'', recursion_limit=4)
+
+    def test_deserialization_deep(self):
+        """Deserialization of a timestamp deeper than Python's recursion limit"""
+        depth = sys.getrecursionlimit() * 2
+        serialized = (b'\xf0\x01\x00'*depth + # OpAppend(b'\x00')
+                      b'\x00' + bytes.fromhex('83dfe30d2ef90c8e' + '07' + '06') + b'barfoo')
+
+        stamp = Timestamp.deserialize(BytesDeserializationContext(serialized), b'', recursion_limit=depth+1)
+
+        for i in range(depth):
+            self.assertEqual(list(stamp.ops.keys()), [OpAppend(b'\x00')])
+            stamp = stamp.ops[OpAppend(b'\x00')]
+
+        self.assertEqual(stamp.msg, b'\x00'*depth)
+        self.assertEqual(stamp.attestations, {PendingAttestation('barfoo')})
+
+    def test_serialization_deep(self):
+        """Serialization of a timestamp deeper than Python's recursion limit"""
+        depth = sys.getrecursionlimit() * 2
+        stamp = Timestamp(b'')
+        tip = stamp
+        for i in range(depth):
+            tip = tip.ops.add(OpAppend(b'\x00'))
+        tip.attestations.add(PendingAttestation('barfoo'))
+
+        for ctx in (BytesSerializationContext(), BufferSerializationContext()):
+            stamp.serialize(ctx)
+            self.assertEqual(ctx.getbytes(),
+                             b'\xf0\x01\x00'*depth + b'\x00' + bytes.fromhex('83dfe30d2ef90c8e' + '07' + '06') + b'barfoo')
+
+    def test_deep(self):
+        """Walking timestamps deeper than Python's recursion limit"""
+        depth = sys.getrecursionlimit() * 2
+        serialized = (b'\xf0\x01\x00'*depth + # OpAppend(b'\x00')
+                      b'\x00' + bytes.fromhex('83dfe30d2ef90c8e' + '07' + '06') + b'barfoo')
+
+        for lazy in (False, True):
+            stamp = Timestamp.deserialize(BytesDeserializationContext(serialized), b'',
+                                          recursion_limit=depth+1, lazy=lazy)
+
+            self.assertEqual(stamp.str_tree(),
+                             (str(OpAppend(b'\x00')) + '\n')*depth + 'verify %s\n' % PendingAttestation('barfoo'))
+            self.assertEqual(list(stamp.all_attestations()), [(b'\x00'*depth, PendingAttestation('barfoo'))])
+
+        stamp2 = Timestamp.deserialize(BytesDeserializationContext(serialized), b'', recursion_limit=depth+1)
+        self.assertEqual(stamp, stamp2)
+
+        tip = stamp2
+        while tip.ops:
+            tip = tip.ops[OpAppend(b'\x00')]
+        tip.ops.add(OpSHA256())
+        self.assertNotEqual(stamp, stamp2)
+
+    def test_deserialization_multiple_ops(self):
+        """Deserialization of a timestamp with ops nested inside non-final ops"""
+        stamp = Timestamp(b'')
+        stamp.attestations.add(PendingAttestation('root'))
+        stamp.ops.add(OpAppend(b'\x01')).ops.add(OpAppend(b'\x02')).attestations.add(PendingAttestation('a'))
+        stamp.ops[OpAppend(b'\x01')].ops.add(OpSHA256()).attestations.add(PendingAttestation('b'))
+        stamp.ops.add(OpPrepend(b'\x03')).attestations.add(PendingAttestation('c'))
+
+        ctx = BytesSerializationContext()
+        stamp.serialize(ctx)
+        serialized = ctx.getbytes()
+
+        self.assertEqual(Timestamp.deserialize(BytesDeserializationContext(serialized), b''), stamp)
+
+        # Truncation anywhere is an error
+        for i in range(len(serialized)):
+            with self.assertRaises(DeserializationError):
+                Timestamp.deserialize(BytesDeserializationContext(serialized[:i]), b'')
+
+    def test_lazy_deserialization(self):
+        """Lazy deserialization"""
+        stamp = Timestamp(b'')
+        stamp.ops.add(OpAppend(b'\x01')).ops.add(OpSHA256()).attestations.add(PendingAttestation('a'))
+        stamp.ops[OpAppend(b'\x01')].attestations.add(PendingAttestation('b'))
+        stamp.ops.add(OpPrepend(b'\x02')).attestations.add(BitcoinBlockHeaderAttestation(1))
+
+        ctx = BytesSerializationContext()
+        stamp.serialize(ctx)
+        serialized = ctx.getbytes()
+
+        lazy_stamp = Timestamp.deserialize(BytesDeserializationContext(serialized), b'', lazy=True)
+        self.assertEqual(sorted(lazy_stamp.all_attestation_paths()),
+                         sorted(stamp.all_attestation_paths()))
+        self.assertEqual(sorted(lazy_stamp.all_attestation_paths()),
+                         [((OpAppend(b'\x01'),), PendingAttestation('b')),
+                          ((OpAppend(b'\x01'), OpSHA256()), PendingAttestation('a')),
+                          ((OpPrepend(b'\x02'),), BitcoinBlockHeaderAttestation(1))])
+
+        # Messages are calculated on demand
+        self.assertEqual(lazy_stamp, stamp)
+        self.assertEqual(lazy_stamp.ops[OpAppend(b'\x01')].ops[OpSHA256()].msg,
+                         bytes.fromhex('4bf5122f344554c53bde2ebb8cd2b7e3d1600ad631c385a5d7cce23c7785459a'))
+
+    def test_lazy_deserialization_invalid_op_msg(self):
+        """Lazy deserialization when message is invalid for op"""
+        serialized = (b'\xf0\x01\x00' + # OpAppend(b'\x00')
+                      b'\x00' + bytes.fromhex('83dfe30d2ef90c8e' + '07' + '06') + b'barfoo')
+
+        # Not detected until the message is needed
+        stamp = Timestamp.deserialize(BytesDeserializationContext(serialized), b'.'*4096, lazy=True)
+        self.assertEqual(list(stamp.all_attestation_paths()), [((OpAppend(b'\x00'),), PendingAttestation('barfoo'))])
+
+        with self.assertRaises(DeserializationError):
+            stamp.ops[OpAppend(b'\x00')].msg
+
+    def test_serialization_unmemoized(self):
+        """Serializations are only memoized when asked for"""
+        stamp = Timestamp(b'')
+        leaf = stamp.ops.add(OpAppend(b'\x01'))
+        leaf.attestations.add(PendingAttestation('foobar'))
+
+        ctx = BytesSerializationContext()
+        stamp.serialize(ctx)
+        self.assertEqual(stamp.serialized_size(), len(ctx.getbytes()))
+        self.assertIsNone(stamp._Timestamp__serialized)
+        self.assertIsNone(leaf._Timestamp__serialized)
+
+        # Already memoized serializations are still used
+        leaf.serialize(BytesSerializationContext(), memoize=True)
+        self.assertIsNotNone(leaf._Timestamp__serialized)
+        ctx2 = BytesSerializationContext()
+        stamp.serialize(ctx2)
+        self.assertEqual(ctx2.getbytes(), ctx.getbytes())
+        self.assertIsNone(stamp._Timestamp__serialized)
+
+    def test_serialization_memoized(self):
+        """Memoized serializations are invalidated by changes"""
+        def serialize(stamp, memoize=True):
+            ctx = BytesSerializationContext()
+            stamp.serialize(ctx, memoize=memoize)
+            return ctx.getbytes()
+
+        def serialize_unmemoized(stamp):
+            # Deserializing from a stream doesn't memoize anything
+            return serialize(Timestamp.deserialize(BytesDeserializationContext(serialize(stamp)), stamp.msg), memoize=False)
+
+        stamp = Timestamp(b'')
+        leaf = stamp.ops.add(OpAppend(b'\x01')).ops.add(OpSHA256())
+        leaf.attestations.add(PendingAttestation('foobar'))
+        other_leaf = stamp.ops.add(OpPrepend(b'\x01'))
+        other_leaf.attestations.add(PendingAttestation('foobar'))
+
+        serialized = serialize(stamp)
+        self.assertEqual(serialize(stamp), serialized)
+        self.assertEqual(stamp.serialized_size(), len(serialized))
+
+        def check(expected_changed=True):
+            nonlocal serialized
+            new_serialized = serialize(stamp)
+            self.assertEqual(new_serialized, serialize_unmemoized(stamp))
+            self.assertEqual(stamp.serialized_size(), len(new_serialized))
+            self.assertEqual(new_serialized != serialized, expected_changed)
+            serialized = new_serialized
+
+        leaf.attestations.add(BitcoinBlockHeaderAttestation(1))
+        check()
+        leaf.attestations.add(BitcoinBlockHeaderAttestation(1))
+        check(expected_changed=False)
+        leaf.attestations.discard(BitcoinBlockHeaderAttestation(1))
+        check()
+        leaf.attestations |= {PendingAttestation('barfoo')}
+        check()
+        leaf.attestations = {BitcoinBlockHeaderAttestation(2)}
+        check()
+        leaf.ops.add(OpSHA256()).attestations.add(BitcoinBlockHeaderAttestation(3))
+        check()
+        del leaf.ops[OpSHA256()]
+        check()
+
+        new_stamp = Timestamp(b'')
+        new_stamp.ops.add(OpPrepend(b'\x01')).attestations.add(BitcoinBlockHeaderAttestation(4))
+        stamp.merge(new_stamp)
+        check()
+        stamp.merge(new_stamp)
+        check(expected_changed=False)
+
+        # Replacing a result timestamp
+        stamp.ops[OpPrepend(b'\x01')] = new_stamp.ops[OpPrepend(b'\x01')]
+        check()
+
+        # Deserialized timestamps are memoized too, if asked for
+        stamp = Timestamp.deserialize(BufferDeserializationContext(serialized), b'', memoize=True)
+        self.assertEqual(serialize(stamp), serialized)
+        stamp.ops[OpPrepend(b'\x01')].attestations.add(BitcoinBlockHeaderAttestation(5))
+        check()
+
+    def test_deserialization_memoized_non_canonical(self):
+        """Non-canonical serializations aren't memoized"""
+        pending = b'\x00' + bytes.fromhex('83dfe30d2ef90c8e' + '07' + '06') + b'barfoo'
+        non_canonical_pending = b'\x00' + bytes.fromhex('83dfe30d2ef90c8e' + '8700' + '06') + b'barfoo'
+        for serialized, canonical in (
+                # ops out of order
+                (b'\xff\xf0\x01\x00' + pending + b'\x08' + pending,
+                 b'\xff\x08' + pending + b'\xf0\x01\x00' + pending),
+
+                # duplicate ops
+                (b'\xff\x08' + pending + b'\x08' + pending,
+                 b'\x08' + pending),
+
+                # non-minimal varuint length
+                (b'\xf0\x81\x00\x00' + pending,
+                 b'\xf0\x01\x00' + pending),
+
+                # the same, in an attestation
+                (non_canonical_pending,
+                 pending),
+
+                # and after a canonical encoding of the same attestation
+                (b'\xff\x08' + pending + b'\xf0\x01\x00' + non_canonical_pending,
+                 b'\xff\x08' + pending + b'\xf0\x01\x00' + pending)):
+
+            for memoize in (False, True):
+                stamp = Timestamp.deserialize(BufferDeserializationContext(serialized), b'', memoize=memoize)
+                ctx = BytesSerializationContext()
+                stamp.serialize(ctx)
+                self.assertEqual(ctx.getbytes(), canonical)
+
+class Test_TimestampIndex(unittest.TestCase):
+    def assertIndexed(self, index):
+        """Check an index against a walk of the tree"""
+        stamps = []
+        stack = [index.timestamp]
+        while stack:
+            stamp = stack.pop()
+            if not any(stamp is other for other in stamps):
+                stamps.append(stamp)
+                stack.extend(stamp.ops.values())
+
+        self.assertEqual(len(index), len(stamps))
+        self.assertEqual(set(index.msgs()), set(stamp.msg for stamp in stamps))
+        for stamp in stamps:
+            self.assertTrue(any(stamp is found for found in index.find(stamp.msg)))
+
+        paths = list(index.timestamp.all_attestation_paths())
+        self.assertEqual(set(index.attestations()), set(attestation for path, attestation in paths))
+        for attestation in index.attestations():
+            self.assertEqual(sorted(index.attestation_paths(attestation)),
+                             sorted(path for path, other in paths if other == attestation))
+
+    def test_index(self):
+        """Indexing a timestamp"""
+        stamp = Timestamp(b'a')
+        stamp.attestations.add(PendingAttestation('foo'))
+        b_stamp = stamp.ops.add(OpAppend(b'b'))
+        b_stamp.ops.add(OpSHA256()).attestations.add(PendingAttestation('bar'))
+
+        index = TimestampIndex(stamp)
+        self.assertIndexed(index)
+        self.assertTrue(b'ab' in index)
+        self.assertFalse(b'b' in index)
+        self.assertEqual(index.find(b'ab'), (b_stamp,))
+        self.assertEqual(index.find(b'b'), ())
+        self.assertEqual(index.find_attestation(PendingAttestation('foo')), (stamp,))
+        self.assertEqual(index.attestation_paths(PendingAttestation('bar')), [(OpAppend(b'b'), OpSHA256())])
+        self.assertEqual(index.attestation_paths(PendingAttestation('baz')), [])
+
+    def test_incremental(self):
+        """Indexes are updated as the timestamp changes"""
+        stamp = Timestamp(b'a')
+        index = TimestampIndex(stamp)
+
+        c_stamp = stamp.ops.add(OpAppend(b'b')).ops.add(OpAppend(b'c'))
+        self.assertIndexed(index)
+        self.assertEqual(index.find(b'abc'), (c_stamp,))
+
+        c_stamp.attestations.add(PendingAttestation('foo'))
+        self.assertEqual(index.find_attestation(PendingAttestation('foo')), (c_stamp,))
+        c_stamp.attestations = [PendingAttestation('bar')]
+        self.assertIndexed(index)
+
+        other = Timestamp(b'ab')
+        other.ops.add(OpSHA256()).attestations.add(BitcoinBlockHeaderAttestation(1))
+        other.ops.add(OpAppend(b'c')).attestations.add(PendingAttestation('baz'))
+        stamp.ops[OpAppend(b'b')].merge(other)
+        self.assertIndexed(index)
+
+        # Replacing and removing subtrees
+        stamp.ops[OpAppend(b'b')] = other
+        self.assertIndexed(index)
+        self.assertIsNone(c_stamp._Timestamp__indexes)
+        del stamp.ops[OpAppend(b'b')]
+        self.assertIndexed(index)
+        self.assertEqual(len(index), 1)
+
+        # Changes to a removed subtree don't affect the index
+        other.attestations.add(PendingAttestation('removed'))
+        self.assertIndexed(index)
+
+    def test_shared(self):
+        """Timestamps shared by several parts of the tree, and several trees"""
+        tip = Timestamp(OpSHA256()(b'\x00\x01'))
+        stamps = [Timestamp(b'\x00'), Timestamp(b'\x01')]
+        stamps[0].ops.add(OpAppend(b'\x01')).ops[OpSHA256()] = tip
+        stamps[1].ops.add(OpPrepend(b'\x00')).ops[OpSHA256()] = tip
+
+        root = Timestamp(b'')
+        root.ops[OpAppend(b'\x00')] = stamps[0]
+        root.ops[OpAppend(b'\x01')] = stamps[1]
+
+        indexes = [TimestampIndex(stamp) for stamp in stamps + [root]]
+        tip.ops.add(OpSHA256()).attestations.add(PendingAttestation('foo'))
+        for index in indexes:
+            self.assertIndexed(index)
+        self.assertEqual(sorted(indexes[2].attestation_paths(PendingAttestation('foo'))),
+                         [(OpAppend(b'\x00'), OpAppend(b'\x01'), OpSHA256(), OpSHA256()),
+                          (OpAppend(b'\x01'), OpPrepend(b'\x00'), OpSHA256(), OpSHA256())])
+
+        # The tip is still reachable another way
+        del root.ops[OpAppend(b'\x00')]
+        self.assertIndexed(indexes[2])
+        self.assertEqual(indexes[2].find(tip.msg), (tip,))
+
+        # Dropped indexes are forgotten
+        del indexes[0]
+        tip.attestations.add(PendingAttestation('bar'))
+        self.assertEqual(len(tip._Timestamp__indexes), 2)
+        for index in indexes:
+            self.assertIndexed(index)
+
+    def test_is_directly_attested(self):
+        """Timestamps not below other attestations"""
+        stamp = Timestamp(b'')
+        self.assertTrue(TimestampIndex(stamp).is_directly_attested(stamp))
+
+        a_stamp = stamp.ops.add(OpAppend(b'a'))
+        b_stamp = a_stamp.ops.add(OpAppend(b'b'))
+        c_stamp = stamp.ops.add(OpPrepend(b'a'))
+        index = TimestampIndex(stamp)
+        self.assertTrue(index.is_directly_attested(b_stamp))
+
+        a_stamp.attestations.add(PendingAttestation('foo'))
+        self.assertTrue(index.is_directly_attested(a_stamp))
+        self.assertFalse(index.is_directly_attested(b_stamp))
+
+        # Reachable another way
+        c_stamp.ops[OpSHA256()] = b_stamp
+        self.assertTrue(index.is_directly_attested(b_stamp))
+        stamp.attestations.add(PendingAttestation('bar'))
+        self.assertTrue(index.is_directly_attested(stamp))
+        self.assertFalse(index.is_directly_attested(a_stamp))
+        self.assertFalse(index.is_directly_attested(b_stamp))
+
+
 class Test_DetachedTimestampFile(unittest.TestCase):
     def test_create_from_file(self):
         file_stamp = DetachedTimestampFile.from_fd(OpSHA256(), io.BytesIO(b''))
@@ -171,6 +600,31 @@ class Test_DetachedTimestampFile(unittest.TestCase):
                 ctx = BytesDeserializationContext(serialized)
                 DetachedTimestampFile.deserialize(ctx)
 
+            with self.assertRaises(expected_error):
+                ctx = BytesDeserializationContext(serialized)
+                list(DetachedTimestampFile.scan(ctx))
+
+    def test_scan(self):
+        """Scanning for attestations"""
+        stamp = Timestamp(bytes.fromhex('e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'))
+        stamp.attestations.add(PendingAttestation('foobar'))
+        stamp.ops.add(OpAppend(b'\x01')).ops.add(OpSHA256()).attestations.add(BitcoinBlockHeaderAttestation(42))
+        stamp.ops[OpAppend(b'\x01')].ops.add(OpRIPEMD160()).attestations.add(PendingAttestation('foobaz'))
+        detached = DetachedTimestampFile(OpSHA256(), stamp)
+
+        ctx = BytesSerializationContext()
+        detached.serialize(ctx)
+        serialized = ctx.getbytes()
+
+        attestations = list(DetachedTimestampFile.scan(BytesDeserializationContext(serialized)))
+        self.assertEqual(sorted(attestations, key=repr), sorted((attestation for msg, attestation in stamp.all_attestations()), key=repr))
+
+        # Same limits as deserialization
+        serialized = (b'\x08'*256 + b'\x00' + bytes.fromhex('83dfe30d2ef90c8e' + '07' + '06') + b'barfoo')
+        with self.assertRaises(RecursionLimitError):
+            list(Timestamp.scan(BytesDeserializationContext(serialized)))
+        self.assertEqual(list(Timestamp.scan(BytesDeserializationContext(serialized[1:]))), [PendingAttestation('barfoo')])
+
 
 class Test_cat_sha256(unittest.TestCase):
     def test(self):
@@ -193,8 +647,13 @@ class Test_make_merkle_tree(unittest.TestCase):
 
             self.assertEqual(tip.msg, expected_merkle_root)
 
+            tip.attestations.add(PendingAttestation('foobar'))
             for root in roots:
-                pass # FIXME: check all roots lead to same timestamp
+                # Deserializing recalculates every result along the way
+                ctx = BytesSerializationContext()
+                root.serialize(ctx)
+                root = Timestamp.deserialize(BytesDeserializationContext(ctx.getbytes()), root.msg)
+                self.assertEqual(list(root.all_attestations()), [(tip.msg, PendingAttestation('foobar'))])
 
         # Returned unchanged!
         T(1, bytes.fromhex('00'))
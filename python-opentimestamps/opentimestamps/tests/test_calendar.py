@@ -9,9 +9,279 @@
 # modified, propagated, or distributed except according to the terms contained
 # in the LICENSE file.
 
+import binascii
+import http.server
+import os
+import select
+import socketserver
+import threading
 import unittest
+import unittest.mock
+import urllib.error
+import urllib.parse
 
 from opentimestamps.calendar import *
+from opentimestamps.core.notary import PendingAttestation
+from opentimestamps.core.op import OpAppend
+from opentimestamps.core.serialize import BytesSerializationContext
+from opentimestamps.core.timestamp import Timestamp
+
+class StandInCalendarServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Local stand-in for a remote calendar server"""
+    daemon_threads = True
+
+    def __init__(self):
+        self.connections = 0
+        self.timestamps = {}
+
+        # Requests for paths under /moved/<status> are redirected to the rest
+        # of the path with that status, and under /moved-to-ftp/<status> to
+        # the rest of the path on an FTP server; /status/<status> just returns
+        # that status.
+        self.proxied_requests = 0
+
+        # Digests submitted, whether or not they were replied to. While
+        # drop_posts is non-zero, POSTs are read, then the connection is
+        # closed without a reply; while close_idle is set, connections are
+        # closed after every reply, without telling the client.
+        self.submissions = 0
+        self.drop_posts = 0
+        self.close_idle = False
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(handler):
+                self.connections += 1
+                super(Handler, handler).setup()
+
+            def log_message(handler, *args):
+                pass
+
+            def send(handler, status, body):
+                handler.send_response(status)
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def handle_one_request(handler):
+                super(Handler, handler).handle_one_request()
+                if self.close_idle:
+                    handler.close_connection = True
+
+            def parse_request(handler):
+                if not super(Handler, handler).parse_request():
+                    return False
+
+                # Requests made through a proxy have an absolute URL
+                parsed_path = urllib.parse.urlsplit(handler.path)
+                if parsed_path.scheme:
+                    self.proxied_requests += 1
+                    handler.path = parsed_path.path
+
+                body_length = int(handler.headers.get('Content-Length', 0))
+                handler.body = handler.rfile.read(body_length)
+
+                parts = handler.path.split('/', 3)
+                if parts[1] in ('moved', 'moved-to-ftp'):
+                    handler.send_response(int(parts[2]))
+                    location = '/' + parts[3]
+                    if parts[1] == 'moved-to-ftp':
+                        location = 'ftp://127.0.0.1' + location
+                    handler.send_header('Location', location)
+                    handler.send_header('Content-Length', '0')
+                    handler.end_headers()
+                    return False
+
+                elif parts[1] == 'status':
+                    handler.send(int(parts[2]), b'')
+                    return False
+
+                return True
+
+            def do_POST(handler):
+                digest = handler.body
+                if handler.path != '/digest':
+                    handler.send(404, b'')
+                    return
+
+                self.submissions += 1
+                if self.drop_posts:
+                    self.drop_posts -= 1
+                    handler.close_connection = True
+                    return
+
+                stamp = Timestamp(digest)
+                commitment_stamp = stamp.ops.add(OpAppend(b'\x01'))
+                commitment_stamp.attestations.add(PendingAttestation('http://localhost'))
+                self.timestamps[commitment_stamp.msg] = commitment_stamp
+
+                ctx = BytesSerializationContext()
+                stamp.serialize(ctx)
+                handler.send(200, ctx.getbytes())
+
+            def do_GET(handler):
+                if not handler.path.startswith('/timestamp/'):
+                    handler.send(404, b'')
+                    return
+                commitment = binascii.unhexlify(handler.path[len('/timestamp/'):])
+                if commitment in self.timestamps:
+                    ctx = BytesSerializationContext()
+                    self.timestamps[commitment].serialize(ctx)
+                    handler.send(200, ctx.getbytes())
+                else:
+                    handler.send(404, b'Commitment not found\n')
+
+        super().__init__(('127.0.0.1', 0), Handler)
+
+        self.netloc = '127.0.0.1:%d' % self.server_address[1]
+        self.url = 'http://' + self.netloc
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+class Test_RemoteCalendar(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInCalendarServer()
+        self.pool = ConnectionPool()
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_submit_and_get_timestamp(self):
+        """Submit a digest, then get the timestamp for the commitment"""
+        calendar = RemoteCalendar(self.server.url, pool=self.pool)
+
+        stamp = calendar.submit(b'\x00'*32)
+        self.assertEqual(stamp.msg, b'\x00'*32)
+
+        commitment = stamp.ops[OpAppend(b'\x01')].msg
+        upgraded_stamp = calendar.get_timestamp(commitment)
+        self.assertEqual(upgraded_stamp.msg, commitment)
+        self.assertEqual(set(upgraded_stamp.attestations), set([PendingAttestation('http://localhost')]))
+
+    def test_commitment_not_found(self):
+        """Unknown commitments raise CommitmentNotFoundError"""
+        calendar = RemoteCalendar(self.server.url, pool=self.pool)
+
+        with self.assertRaises(CommitmentNotFoundError) as cm:
+            calendar.get_timestamp(b'\xff'*32)
+        self.assertEqual(cm.exception.reason, 'Commitment not found_')
+
+    def test_connection_reuse(self):
+        """Requests reuse a single keep-alive connection"""
+        for i in range(10):
+            calendar = RemoteCalendar(self.server.url, pool=self.pool)
+            stamp = calendar.submit(bytes([i])*32)
+            calendar.get_timestamp(stamp.ops[OpAppend(b'\x01')].msg)
+
+        self.assertEqual(self.server.connections, 1)
+
+    def test_connection_error(self):
+        """Network errors are raised as URLError"""
+        calendar = RemoteCalendar(self.server.url, pool=self.pool)
+        self.tearDown()
+
+        with self.assertRaises(urllib.error.URLError):
+            calendar.submit(b'\x00'*32)
+
+        self.setUp()
+
+    def test_connection_dropped(self):
+        """Submissions aren't retried, but idle connections closed by the server aren't used"""
+        calendar = RemoteCalendar(self.server.url, pool=self.pool)
+        calendar.submit(b'\x00'*32)
+
+        # The server got the digest, so submitting it again on a new
+        # connection would submit it twice.
+        self.server.drop_posts = 1
+        with self.assertRaises(urllib.error.URLError):
+            calendar.submit(b'\x01'*32)
+        self.assertEqual(self.server.submissions, 2)
+
+        # Connections closed while idle are noticed before they're used
+        self.server.close_idle = True
+        calendar.submit(b'\x02'*32)
+        idle_conn, = self.pool.idle[('http', self.server.netloc)]
+        select.select([idle_conn.sock], [], [], 5)
+        calendar.submit(b'\x03'*32)
+        self.assertEqual(self.server.submissions, 4)
+        self.assertEqual(self.server.connections, 3)
+
+    def test_redirect(self):
+        """Redirects are followed"""
+        calendar = RemoteCalendar(self.server.url, pool=self.pool)
+        stamp = calendar.submit(b'\x00'*32)
+
+        commitment = stamp.ops[OpAppend(b'\x01')].msg
+        for status in (301, 302, 303, 307, 308):
+            calendar = RemoteCalendar(self.server.url + '/moved/%d' % status, pool=self.pool)
+            self.assertEqual(calendar.get_timestamp(commitment).msg, commitment)
+
+            # Nested redirects
+            calendar = RemoteCalendar(self.server.url + '/moved/%d/moved/301' % status, pool=self.pool)
+            self.assertEqual(calendar.get_timestamp(commitment).msg, commitment)
+
+        # As with urlopen(), a POST redirected with a 301 becomes a GET, which
+        # isn't a submission, and one redirected with a 307 isn't followed.
+        calendar = RemoteCalendar(self.server.url + '/moved/301', pool=self.pool)
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            calendar.submit(b'\x00'*32)
+        self.assertEqual(cm.exception.code, 404)
+
+        calendar = RemoteCalendar(self.server.url + '/moved/307', pool=self.pool)
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            calendar.submit(b'\x00'*32)
+        self.assertEqual(cm.exception.code, 307)
+
+        # Too many redirects
+        calendar = RemoteCalendar(self.server.url + '/moved/301' * (RemoteCalendar.MAX_REDIRECTS + 1), pool=self.pool)
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            calendar.get_timestamp(commitment)
+        self.assertEqual(cm.exception.code, 301)
+
+    def test_redirect_scheme(self):
+        """Redirects to anything but http and https are refused"""
+        calendar = RemoteCalendar(self.server.url + '/moved-to-ftp/302', pool=self.pool)
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            calendar.get_timestamp(b'\x00'*32)
+        self.assertEqual(cm.exception.code, 302)
+
+    def test_unknown_status(self):
+        """Unexpected statuses are raised as HTTPError"""
+        for status in (202, 204, 300, 304, 418, 500):
+            calendar = RemoteCalendar(self.server.url + '/status/%d' % status, pool=self.pool)
+            with self.assertRaises(urllib.error.HTTPError) as cm:
+                calendar.get_timestamp(b'\x00'*32)
+            self.assertEqual(cm.exception.code, status)
+
+        # Redirects without somewhere to redirect to
+        calendar = RemoteCalendar(self.server.url + '/status/301', pool=self.pool)
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            calendar.submit(b'\x00'*32)
+        self.assertEqual(cm.exception.code, 301)
+
+    def test_proxy(self):
+        """Requests go through the proxy, if one is set"""
+        # The stand-in server doubles as the proxy
+        environ = {'http_proxy': self.server.url, 'no_proxy': ''}
+        with unittest.mock.patch.dict(os.environ, environ):
+            calendar = RemoteCalendar('http://calendar.invalid', pool=self.pool)
+            stamp = calendar.submit(b'\x00'*32)
+
+            calendar = RemoteCalendar('http://calendar.invalid/moved/307', pool=self.pool)
+            calendar.get_timestamp(stamp.ops[OpAppend(b'\x01')].msg)
+
+            with self.assertRaises(CommitmentNotFoundError):
+                calendar.get_timestamp(b'\xff'*32)
+
+        # Redirects are followed by urlopen()
+        self.assertEqual(self.server.proxied_requests, 5)
+
+        with unittest.mock.patch.dict(os.environ, dict(environ, no_proxy='calendar.invalid')):
+            calendar = RemoteCalendar('http://calendar.invalid', pool=self.pool)
+            with self.assertRaises(urllib.error.URLError):
+                calendar.submit(b'\x00'*32)
 
 class Test_UrlWhitelist(unittest.TestCase):
     def test_empty(self):
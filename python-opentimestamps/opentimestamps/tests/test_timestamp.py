@@ -0,0 +1,106 @@
+# Copyright (C) 2016 The OpenTimestamps developers
+#
+# This file is part of python-opentimestamps.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-opentimestamps including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import concurrent.futures
+import unittest
+
+from opentimestamps.core.notary import *
+from opentimestamps.core.op import *
+from opentimestamps.core.serialize import *
+from opentimestamps.core.timestamp import *
+from opentimestamps.timestamp import *
+
+class Test_MerkleTree(unittest.TestCase):
+    def test_same_as_make_merkle_tree(self):
+        """MerkleTree builds the same tree as make_merkle_tree()"""
+        def serialize(stamp):
+            ctx = BytesSerializationContext()
+            stamp.serialize(ctx)
+            return ctx.getbytes()
+
+        for n in range(1, 70):
+            digests = [OpSHA256()(bytes([i])) for i in range(n)]
+
+            stamps = [Timestamp(digest) for digest in digests]
+            tip = make_merkle_tree(stamps)
+            tip.attestations.add(PendingAttestation('foobar'))
+
+            merkle_tree = MerkleTree(digests)
+            self.assertEqual(len(merkle_tree), n)
+            self.assertEqual(merkle_tree.tip_digest, tip.msg)
+
+            shared_tip = Timestamp(merkle_tree.tip_digest)
+            shared_tip.attestations.add(PendingAttestation('foobar'))
+            for i, stamp in enumerate(stamps):
+                self.assertEqual(merkle_tree.digest(i), digests[i])
+                self.assertEqual(serialize(merkle_tree.leaf_timestamp(i, shared_tip)), serialize(stamp))
+
+                # Without a tip, the path ends in a new timestamp for the tip
+                path_stamp = merkle_tree.leaf_timestamp(i)
+                while path_stamp.ops:
+                    (path_stamp,) = path_stamp.ops.values()
+                self.assertEqual(path_stamp.msg, tip.msg)
+                self.assertEqual(path_stamp.attestations, set())
+
+    def test_parallel(self):
+        """Hashing levels in parallel gives the same tree"""
+        class SmallChunkMerkleTree(MerkleTree):
+            PARALLEL_CHUNK_PAIRS = 2
+
+        for executor_cls in (concurrent.futures.ThreadPoolExecutor, concurrent.futures.ProcessPoolExecutor):
+            with executor_cls(max_workers=2) as executor:
+                for n in (1, 2, 5, 8, 9, 33, 100):
+                    # Leaves needn't be SHA256 digests
+                    digests = [OpRIPEMD160()(bytes([i])) for i in range(n)]
+
+                    stamps = [Timestamp(digest) for digest in digests]
+                    tip = make_merkle_tree(stamps)
+
+                    merkle_tree = SmallChunkMerkleTree(digests, executor=executor)
+                    self.assertEqual(merkle_tree.tip_digest, tip.msg)
+                    for i, stamp in enumerate(stamps):
+                        self.assertEqual(merkle_tree.leaf_timestamp(i, tip), stamp)
+
+    def test_shared_tip(self):
+        """Leaf timestamps share the tip they're given"""
+        merkle_tree = MerkleTree([b'\x00'*32, b'\x01'*32, b'\x02'*32])
+        tip = Timestamp(merkle_tree.tip_digest)
+
+        leaf_stamps = [merkle_tree.leaf_timestamp(i, tip) for i in range(3)]
+        tip.attestations.add(PendingAttestation('foobar'))
+        for leaf_stamp in leaf_stamps:
+            self.assertEqual(list(leaf_stamp.all_attestations()),
+                             [(merkle_tree.tip_digest, PendingAttestation('foobar'))])
+
+        # With only one leaf, the leaf is the tip
+        merkle_tree = MerkleTree([b'\x00'*32])
+        tip = Timestamp(b'\x00'*32)
+        self.assertIs(merkle_tree.leaf_timestamp(0, tip), tip)
+        self.assertEqual(merkle_tree.leaf_timestamp(0), Timestamp(b'\x00'*32))
+
+    def test_errors(self):
+        """MerkleTree errors"""
+        with self.assertRaises(ValueError):
+            MerkleTree([])
+        with self.assertRaises(ValueError):
+            MerkleTree([b'\x00'*32, b'\x00'*20])
+        with self.assertRaises(TypeError):
+            MerkleTree(['foo'])
+
+        merkle_tree = MerkleTree([b'\x00'*32, b'\x01'*32])
+        with self.assertRaises(IndexError):
+            merkle_tree.leaf_timestamp(2)
+        with self.assertRaises(IndexError):
+            merkle_tree.leaf_timestamp(-1)
+        with self.assertRaises(IndexError):
+            merkle_tree.digest(3)
+        with self.assertRaises(ValueError):
+            merkle_tree.leaf_timestamp(0, Timestamp(b'\x00'*32))
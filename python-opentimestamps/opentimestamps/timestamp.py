@@ -11,11 +11,217 @@
 
 """Convenience functions for creating timestamps"""
 
+import array
+import itertools
 import os
 
-from opentimestamps.core.op import OpAppend, OpSHA256
+from opentimestamps.core.op import OpAppend, OpPrepend, OpSHA256
+from opentimestamps.core.timestamp import Timestamp
 
 def nonce_timestamp(private_timestamp, crypt_op=OpSHA256(), length=16):
     """Create a nonced version of a timestamp for privacy"""
     stamp2 = private_timestamp.ops.add(OpAppend(os.urandom(length)))
     return stamp2.ops.add(crypt_op)
+
+
+
+def _sha256_pairs(digests, pair_length):
+    """SHA256 every pair_length bytes of digests
+
+    Returns the concatenated digests. Used by MerkleTree; at module level so
+    that it can be run by a ProcessPoolExecutor.
+    """
+    block_length = OpSHA256.HASH_MANY_CHUNK_SIZE * pair_length
+    pair_digests = bytearray()
+    with memoryview(digests) as view:
+        # In blocks, so there's never more than a block's worth of pairs in
+        # memory at once.
+        for i in range(0, len(view), block_length):
+            block = view[i:i + block_length]
+            pair_digests += b''.join(OpSHA256.hash_many([block[j:j + pair_length]
+                                                         for j in range(0, len(block), pair_length)]))
+    return bytes(pair_digests)
+
+
+class MerkleTree:
+    """Merkle tree of digests, stored compactly
+
+    Builds exactly the same tree as make_merkle_tree() does with cat_sha256(),
+    but rather than a Timestamp per node the tree is stored as flat arrays: the
+    digest of every node, along with the index of its parent and of its
+    sibling. That's about a hundred bytes per leaf, rather than a few
+    kilobytes, which matters when timestamping millions of digests at once.
+
+    Timestamps for the path from a leaf to the tip are created on demand by
+    leaf_timestamp().
+
+    Nodes are indexed with the leaves first, in order, followed by the inner
+    nodes in the order they were created; the tip is the last node.
+    """
+
+    PARALLEL_CHUNK_PAIRS = 2**14
+    """Levels are split into chunks of this many pairs to be hashed in parallel"""
+
+    def __init__(self, leaf_digests, executor=None):
+        """Build the tree
+
+        leaf_digests must all be the same length.
+
+        The tree is hashed a level at a time. If executor is given, levels
+        wider than PARALLEL_CHUNK_PAIRS are split into chunks, hashed by the
+        executor in parallel. As hashlib only releases the GIL for large
+        messages, this should be a ProcessPoolExecutor.
+        """
+        leaf_digests = list(leaf_digests)
+        if not leaf_digests:
+            raise ValueError("Need at least one digest")
+
+        self.leaf_length = len(leaf_digests[0])
+        for leaf_digest in leaf_digests:
+            if not isinstance(leaf_digest, bytes):
+                raise TypeError("Expected digest to be bytes; got %r" % leaf_digest.__class__)
+            if len(leaf_digest) != self.leaf_length:
+                raise ValueError("All leaf digests must be the same length")
+
+        self.num_leaves = len(leaf_digests)
+        num_nodes = 2*self.num_leaves - 1
+
+        # Leaf digests are stored separately, as they can be any length; inner
+        # nodes are all SHA256 digests.
+        self.__leaf_digests = b''.join(leaf_digests)
+        del leaf_digests
+        self.__inner_digests = bytearray(OpSHA256.DIGEST_LENGTH * (self.num_leaves - 1))
+
+        # Parent of every node, -1 for the tip. The sibling of a left node is
+        # stored as is, and of a right node as its ones' complement, so the
+        # side a node is on doesn't need to be stored separately.
+        self.__parents = array.array('q', [-1]) * num_nodes
+        self.__siblings = array.array('q', [-1]) * num_nodes
+
+        # Same algorithm as make_merkle_tree(), a level at a time. The nodes
+        # of every level are a contiguous run of nodes - the ones created by
+        # the previous level, or the leaves - possibly followed by a node left
+        # over from an earlier level, so the run can be hashed in one go.
+        next_index = self.num_leaves
+        run_start = 0
+        run_length = self.num_leaves
+        left_over = None
+        while run_length + (left_over is not None) > 1:
+            num_pairs = run_length // 2
+
+            if run_start < self.num_leaves:
+                run_digests = self.__leaf_digests
+                pair_length = 2 * self.leaf_length
+                run_offset = 0
+            else:
+                run_digests = self.__inner_digests
+                pair_length = 2 * OpSHA256.DIGEST_LENGTH
+                run_offset = (run_start - self.num_leaves) * OpSHA256.DIGEST_LENGTH
+
+            with memoryview(run_digests) as run_view:
+                pair_digests = self.__hash_pairs(run_view[run_offset:run_offset + num_pairs * pair_length],
+                                                 pair_length, executor)
+
+            offset = (next_index - self.num_leaves) * OpSHA256.DIGEST_LENGTH
+            self.__inner_digests[offset:offset + len(pair_digests)] = pair_digests
+
+            run_end = run_start + 2 * num_pairs
+            self.__parents[run_start:run_end:2] = array.array('q', range(next_index, next_index + num_pairs))
+            self.__parents[run_start + 1:run_end:2] = self.__parents[run_start:run_end:2]
+            self.__siblings[run_start:run_end:2] = array.array('q', range(run_start + 1, run_end, 2))
+            self.__siblings[run_start + 1:run_end:2] = array.array('q', range(~run_start, ~run_end, -2))
+
+            next_run_start = next_index
+            next_index += num_pairs
+
+            if run_length % 2:
+                odd_index = run_start + run_length - 1
+                if left_over is None:
+                    left_over = odd_index
+
+                else:
+                    self.__add_parent(odd_index, left_over, next_index)
+                    next_index += 1
+                    left_over = None
+
+            run_start = next_run_start
+            run_length = next_index - next_run_start
+
+        assert next_index == num_nodes
+
+    def __hash_pairs(self, digests, pair_length, executor):
+        """Hash every pair of digests in a contiguous buffer"""
+        chunk_length = self.PARALLEL_CHUNK_PAIRS * pair_length
+        if executor is None or len(digests) <= chunk_length:
+            return _sha256_pairs(digests, pair_length)
+
+        chunks = [bytes(digests[i:i + chunk_length]) for i in range(0, len(digests), chunk_length)]
+        return b''.join(executor.map(_sha256_pairs, chunks, itertools.repeat(pair_length)))
+
+    def __add_parent(self, left_index, right_index, parent_index):
+        digest = OpSHA256()(self.digest(left_index) + self.digest(right_index))
+        offset = (parent_index - self.num_leaves) * OpSHA256.DIGEST_LENGTH
+        self.__inner_digests[offset:offset + OpSHA256.DIGEST_LENGTH] = digest
+
+        self.__parents[left_index] = parent_index
+        self.__parents[right_index] = parent_index
+        self.__siblings[left_index] = right_index
+        self.__siblings[right_index] = ~left_index
+
+    def __len__(self):
+        """Number of leaves"""
+        return self.num_leaves
+
+    def digest(self, index):
+        """Digest of a node"""
+        if index < 0:
+            raise IndexError("Node index out of range")
+
+        elif index < self.num_leaves:
+            offset = index * self.leaf_length
+            return self.__leaf_digests[offset:offset + self.leaf_length]
+
+        else:
+            offset = (index - self.num_leaves) * OpSHA256.DIGEST_LENGTH
+            if offset >= len(self.__inner_digests):
+                raise IndexError("Node index out of range")
+            return bytes(self.__inner_digests[offset:offset + OpSHA256.DIGEST_LENGTH])
+
+    @property
+    def tip_digest(self):
+        """Digest of the tip of the tree"""
+        return self.digest(len(self.__parents) - 1)
+
+    def leaf_timestamp(self, index, tip=None):
+        """Create the timestamp for a leaf
+
+        Returns a new Timestamp for the leaf's digest, with the operations
+        leading from it to the tip. If tip is given, it's used as the timestamp
+        for the tip itself, rather than a new one; the timestamps of every leaf
+        can then share one tip, as they do with make_merkle_tree().
+        """
+        if not 0 <= index < self.num_leaves:
+            raise IndexError("Leaf index out of range")
+
+        if tip is not None and tip.msg != self.tip_digest:
+            raise ValueError("Tip timestamp is for a different message")
+
+        if tip is not None and self.num_leaves == 1:
+            return tip
+
+        leaf_stamp = Timestamp(self.digest(index))
+        stamp = leaf_stamp
+        while self.__parents[index] != -1:
+            sibling = self.__siblings[index]
+            if sibling >= 0:
+                stamp = stamp.ops.add(OpAppend(self.digest(sibling)))
+            else:
+                stamp = stamp.ops.add(OpPrepend(self.digest(~sibling)))
+
+            index = self.__parents[index]
+            if tip is not None and self.__parents[index] == -1:
+                stamp.ops[OpSHA256()] = tip
+            else:
+                stamp = stamp.ops.add(OpSHA256())
+
+        return leaf_stamp